@@ -0,0 +1,384 @@
+"""
+Asyncio runtime for the bot.
+
+This is an alternative to main.py that doesn't use python-telegram-bot's
+threaded Updater. Updates are long-polled on one connection and each command
+runs as its own task, so thousands of chats can be served by one thread.
+Commands that need the database, or could compute for long, run in a thread
+pool, and replies are queued and sent by several tasks with their own
+persistent connections, so a slow send doesn't hold up anything else. Each
+chat's replies always go through the same sender, so they stay in order, and
+sends Telegram flood limits are retried when it says to.
+
+Usage: python aiobot.py
+
+The API URL can be changed with FOXROLLBOT_API_URL, for instance to point the
+bot at a local test server.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import ssl
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+from commands import COMMANDS, open_saved_roll_manager, may_block
+
+API_URL = "https://api.telegram.org"
+"""str: Default base URL of the Bot API"""
+
+
+class TelegramError(Exception):
+    """
+    Error returned by the Bot API.
+
+    Attributes:
+        error_code (int): HTTP-style error code
+        retry_after (int): Seconds to wait before retrying, if flood limited
+    """
+
+    def __init__(self, description, error_code=None, retry_after=None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.retry_after = retry_after
+
+
+class HTTPConnection:
+    """Minimal keep-alive HTTP/1.1 client connection for JSON POST requests."""
+
+    def __init__(self, url):
+        """
+        Create an HTTPConnection instance. It connects on the first request.
+
+        Args:
+            url (str): Base URL, with scheme, host and optionally port
+        """
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.secure = parts.scheme == "https"
+        self.port = parts.port or (443 if self.secure else 80)
+
+        self._reader = None
+        self._writer = None
+
+    async def _connect(self):
+        context = ssl.create_default_context() if self.secure else None
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port, ssl=context
+        )
+
+    async def post(self, path, payload):
+        """
+        Send a POST request and read the whole response.
+
+        A request on a connection the server has closed in the meantime is
+        retried once on a new connection.
+
+        Args:
+            path (str): Path to request
+            payload (bytes): JSON body
+
+        Returns:
+            tuple: Status code and body of the response
+        """
+        for attempt in range(2):
+            fresh = self._writer is None
+            if fresh:
+                await self._connect()
+            try:
+                return await self._request(path, payload)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if fresh or attempt:
+                    raise
+
+    async def _request(self, path, payload):
+        head = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: {self.host}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: keep-alive\r\n"
+            "\r\n"
+        )
+        self._writer.write(head.encode("latin-1") + payload)
+        await self._writer.drain()
+
+        status = int((await self._reader.readuntil(b"\r\n")).split()[1])
+        headers = {}
+        while True:
+            line = (await self._reader.readuntil(b"\r\n")).decode("latin-1")
+            if line == "\r\n":
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await self._reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                chunk = await self._reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                body += chunk[:-2]
+        else:
+            body = await self._reader.readexactly(int(headers["content-length"]))
+
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, body
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class TelegramClient:
+    """Bot API client using a single persistent connection."""
+
+    def __init__(self, token, base_url=API_URL):
+        """
+        Create a TelegramClient instance.
+
+        Args:
+            token (str): Bot token
+            base_url (str): Base URL of the Bot API
+        """
+        self._connection = HTTPConnection(base_url)
+        self._path = f"{urlsplit(base_url).path.rstrip('/')}/bot{token}/"
+
+    async def call(self, method, **params):
+        """
+        Call a Bot API method.
+
+        Args:
+            method (str): Name of method, such as sendMessage
+            **params: Parameters of the method
+
+        Returns:
+            The method's result
+        """
+        return await self.call_encoded(method, json.dumps(params).encode())
+
+    async def call_encoded(self, method, payload):
+        """
+        Call a Bot API method with parameters already encoded.
+
+        Args:
+            method (str): Name of method, such as sendMessage
+            payload (bytes): Parameters of the method as a JSON object
+
+        Returns:
+            The method's result
+        """
+        status, body = await self._connection.post(self._path + method, payload)
+        response = json.loads(body)
+        if not response.get("ok"):
+            raise TelegramError(
+                response.get("description", f"HTTP {status}"),
+                response.get("error_code", status),
+                response.get("parameters", {}).get("retry_after"),
+            )
+        return response["result"]
+
+    def close(self):
+        self._connection.close()
+
+
+def message_from_json(data):
+    """Wrap a message from the Bot API in the attributes commands use."""
+    return SimpleNamespace(
+        chat_id=data["chat"]["id"],
+        message_id=data["message_id"],
+        from_user=SimpleNamespace(id=data.get("from", {}).get("id")),
+        text=data.get("text", ""),
+    )
+
+
+class AsyncBot:
+    """
+    Bot that serves commands from commands.py on an asyncio event loop.
+
+    Attributes:
+        srm (SavedRollManager): Manager for saved rolls
+        username (str): Bot's username, known once it's running
+    """
+
+    SENDERS = 8
+    """int: Number of tasks, each with its own connection, sending replies"""
+
+    POLL_TIMEOUT = 30
+    """int: Seconds for getUpdates to wait for updates"""
+
+    MAX_RETRIES = 5
+    """int: Number of times a flood-limited send is retried"""
+
+    def __init__(
+        self,
+        token,
+        srm,
+        base_url=API_URL,
+        senders=SENDERS,
+        poll_timeout=POLL_TIMEOUT,
+        executor=None,
+    ):
+        """
+        Create an AsyncBot instance.
+
+        Args:
+            token (str): Bot token
+            srm (SavedRollManager): Manager for saved rolls
+            base_url (str): Base URL of the Bot API
+            senders (int): Number of concurrent reply senders
+            poll_timeout (int): Seconds for getUpdates to wait for updates
+            executor (Executor): Executor for commands that may block;
+                by default, a thread pool as big as the connection pool
+        """
+        self.srm = srm
+        self.username = None
+
+        self._token = token
+        self._base_url = base_url
+        self._senders = senders
+        self._poll_timeout = poll_timeout
+        self._executor = executor or ThreadPoolExecutor(srm.pool.size)
+
+        self._outboxes = None
+        self._tasks = set()
+
+    async def run(self):
+        """Poll for updates and handle them until cancelled."""
+        # One queue per sender; each chat is always sent to by the same one.
+        self._outboxes = [asyncio.Queue() for _ in range(self._senders)]
+        poller = TelegramClient(self._token, self._base_url)
+        senders = [
+            asyncio.ensure_future(self._send_replies(outbox))
+            for outbox in self._outboxes
+        ]
+
+        try:
+            self.username = (await poller.call("getMe"))["username"]
+            offset = None
+            while True:
+                try:
+                    updates = await poller.call(
+                        "getUpdates", offset=offset, timeout=self._poll_timeout
+                    )
+                except (OSError, TelegramError) as e:
+                    logging.error(e)
+                    await asyncio.sleep(1)
+                    continue
+
+                for update in updates:
+                    offset = update["update_id"] + 1
+                    self.dispatch(update)
+        finally:
+            for task in senders + list(self._tasks):
+                task.cancel()
+            poller.close()
+
+    def dispatch(self, update):
+        """
+        Start handling an update if it's a command this bot knows.
+
+        Args:
+            update (dict): Update from the Bot API
+        """
+        if "message" not in update:
+            return
+        message = message_from_json(update["message"])
+        if not message.text.startswith("/"):
+            return
+
+        words = message.text.split()
+        name, _, username = words[0][1:].partition("@")
+        if username and username.lower() != (self.username or "").lower():
+            return
+
+        command = COMMANDS.get(name.lower())
+        if command is not None:
+            task = asyncio.ensure_future(self.handle(command, message, words[1:]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def handle(self, command, message, args):
+        """
+        Run a command and queue its reply.
+
+        Args:
+            command (callable): Command function from COMMANDS
+            message: Message the command was sent in
+            args (list): Arguments of the command
+        """
+        try:
+            if may_block(command, args):
+                loop = asyncio.get_running_loop()
+                reply = await loop.run_in_executor(
+                    self._executor, command, message, args, self.srm
+                )
+            else:
+                reply = command(message, args, self.srm)
+        except Exception:
+            logging.exception("Error handling %s", message.text)
+            return
+
+        self._outboxes[reply["chat_id"] % len(self._outboxes)].put_nowait(reply)
+
+    async def _send_replies(self, outbox):
+        client = TelegramClient(self._token, self._base_url)
+        try:
+            while True:
+                await self._send(client, await outbox.get())
+        finally:
+            client.close()
+
+    async def _send(self, client, reply):
+        """
+        Send a reply, retrying if Telegram says to wait first.
+
+        Args:
+            client (TelegramClient): Client to send it with
+            reply (dict): Keyword arguments for sendMessage
+        """
+        payload = getattr(reply, "payload", None)
+        for attempt in range(self.MAX_RETRIES + 1):
+            try:
+                if payload is None:
+                    await client.call("sendMessage", **reply)
+                else:
+                    await client.call_encoded("sendMessage", payload)
+                return
+            except TelegramError as e:
+                if e.retry_after is None or attempt == self.MAX_RETRIES:
+                    logging.error(e)
+                    return
+                logging.warning("Retrying send in %ss: %s", e.retry_after, e)
+                await asyncio.sleep(e.retry_after)
+            except OSError as e:
+                logging.error(e)
+                return
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(name)s %(levelname)s: %(message)s",
+    )
+
+    with open("token.txt") as token_file:
+        token = token_file.read().strip()
+
+    srm = open_saved_roll_manager()
+    bot = AsyncBot(token, srm, os.environ.get("FOXROLLBOT_API_URL", API_URL))
+
+    print("Starting bot...")
+    try:
+        asyncio.run(bot.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srm.close()
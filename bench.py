@@ -0,0 +1,603 @@
+"""
+Micro-benchmarks for foxrollbot's hot paths.
+
+Run with `python bench.py [benchmark ...] [--rows N] [--users N]`.
+
+The "suite" benchmark times a fixed set of cases and can save the timings as
+JSON, or compare them with timings saved earlier:
+
+    python bench.py suite --output baseline.json
+    python bench.py suite --baseline baseline.json
+
+Comparing exits with status 1 if any case got slower by more than the
+threshold.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from itertools import islice
+
+import bundle
+import rng
+from db import SavedRollManager
+from inline import InlineRoller
+from roll import Dice, Roll, RollCommand
+from errors import *
+
+# A sample of expressions as they're actually sent to the bot.
+CORPUS = [
+    "1d20",
+    "1d20+5",
+    "1d20+7",
+    "1d20-1",
+    "2d6",
+    "2d6+3",
+    "1d8+1d6+4",
+    "4d6",
+    "8d6",
+    "1d100",
+    "1d12+2d6+5",
+    "3d8+1d4-2",
+    "1d20+4d6+5-2",
+    "10d10",
+    "2d20+1d4+1d6+3",
+    "100d1000",
+]
+
+
+def regex_roll_from_str(roll_str):
+    """The regex pipeline Roll.from_str used before RollParser, for comparison."""
+    if not Roll.SYNTAX.fullmatch(roll_str):
+        raise InvalidSyntaxException()
+
+    components = re.sub(r"([+-])", r" \g<1>", "+" + roll_str).split()
+    rolls = []
+    modifiers = []
+
+    for comp in components:
+        if Dice.SYNTAX.match(comp):
+            sign = comp[0]
+            match = Dice.SYNTAX.fullmatch(comp[1:])
+            if not match:
+                raise InvalidSyntaxException()
+            quantity = int(match.group(1))
+            die = int(match.group(2))
+            rolls.append(Dice(quantity, die, sign == "-"))
+        else:
+            modifiers.append(int(comp))
+
+    if len(rolls) == 0:
+        raise InvalidSyntaxException()
+
+    return Roll(rolls, modifiers)
+
+
+def parse_corpus(parse):
+    for expression in CORPUS:
+        parse(expression)
+
+
+def bench(func, number=2000, repeat=5):
+    """Return the best time per call of func, in seconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def bench_parse():
+    regex = bench(lambda: parse_corpus(regex_roll_from_str))
+    parser = bench(lambda: parse_corpus(Roll.from_str))
+
+    for name, seconds in (("regex", regex), ("RollParser", parser)):
+        rate = len(CORPUS) / seconds
+        print(f"Roll.from_str ({name}): {rate:,.0f} expressions/s")
+    print(f"Speedup: {regex / parser:.2f}x")
+
+
+RESULT_ROLLS = [
+    ("1d20", Roll.NORMAL),
+    ("1d20+5", Roll.ADVANTAGE),
+    ("1d8+1d6+4", Roll.NORMAL),
+    ("2d20+1d4+1d6+3", Roll.DISADVANTAGE),
+]
+
+
+class DictDiceResult:
+    """DiceResult as it was before it had slots, for comparison."""
+
+    def __init__(self, dice, results, negative):
+        self.dice = dice
+        self.negative = negative
+        self.results = results
+
+    def __str__(self):
+        sep = " | " if len(self.results) > 1 else ""
+        if len(self.results) > 1:
+            ind_results = ", ".join(str(r) for r in self.results)
+        else:
+            ind_results = ""
+        return f"{self.dice}: {sum(self.results)}{sep}{ind_results}"
+
+
+class DictRollResult:
+    """RollResult as it was before it had slots, for comparison."""
+
+    def __init__(self, rolls, modifiers, losing):
+        self.rolls = rolls
+
+        self.roll_total = 0
+        for roll in self.rolls:
+            subtotal = sum(roll.results)
+            if not roll.negative:
+                self.roll_total += subtotal
+            else:
+                self.roll_total -= subtotal
+
+        self.modifiers = modifiers
+        self.mod_total = sum(self.modifiers)
+        self.total = self.roll_total + self.mod_total
+
+        self.losing = losing
+
+    def __str__(self):
+        output = ""
+
+        roll_count = len(self.rolls)
+        mod_count = len(self.modifiers)
+        if roll_count == 1 and mod_count == 0 and self.losing is None:
+            return str(self.rolls[0])
+
+        total = f"Total: {self.total}\n" if roll_count + mod_count > 1 else ""
+        roll = "\n".join(str(r) for r in self.rolls)
+
+        if len(self.modifiers) == 0:
+            output += total + roll
+        elif len(self.modifiers) == 1:
+            output += total + roll
+            output += f"\nModifier: {self.mod_total}"
+        else:
+            modifiers = ", ".join(str(m) for m in self.modifiers)
+            output += total + roll
+            output += f"\nModifiers: {self.mod_total} | {modifiers}"
+
+        if self.losing is None:
+            return output
+        else:
+            return output + f"\nOther roll: {self.losing}"
+
+
+def dict_roll(roll):
+    """Roll a Roll into the unslotted result classes, the way it used to be."""
+    values = iter(rng.backend.roll(roll.sides()))
+
+    def attempt():
+        return [
+            DictDiceResult(dice, list(islice(values, dice.quantity)), dice.negative)
+            for dice in roll.rolls
+        ]
+
+    results = attempt()
+    if roll.advantage is Roll.NORMAL:
+        return DictRollResult(results, roll.modifiers, None)
+
+    other_results = attempt()
+    totals = [sum(r.results) for r in results]
+    other_totals = [sum(r.results) for r in other_results]
+    if roll.advantage is Roll.ADVANTAGE:
+        other_wins = other_totals > totals
+    else:
+        other_wins = other_totals < totals
+    if other_wins:
+        results, other_results = other_results, results
+    losing = sum(sum(r.results) for r in other_results)
+    return DictRollResult(results, roll.modifiers, losing)
+
+
+def result_memory(roll, count=10_000):
+    """Return the bytes allocated per result that are still held afterwards."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    results = [roll() for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(results)
+
+
+def bench_results():
+    for roll_str, advantage in RESULT_ROLLS:
+        roll = Roll.from_str(roll_str, advantage)
+        print(f"{roll}:")
+
+        timings = {}
+        for name, make in (("dict", lambda: dict_roll(roll)), ("slots", roll.roll)):
+            size = result_memory(make)
+            timings[name] = bench(lambda: str(make()), number=5000)
+            rate = 1 / timings[name]
+            print(f"  {name}: {size:,.0f} bytes/roll, {rate:,.0f} rolls/s (formatted)")
+        print(f"  Speedup: {timings['dict'] / timings['slots']:.2f}x")
+
+
+def fill_saved_rolls(srm, rows, users=1000):
+    """Insert rows saved rolls, spread evenly across users."""
+    with srm.pool.connection() as connection:
+        connection.executemany(
+            srm.sql["save"],
+            (
+                {"name": f"roll{i // users}", "args": "1d20+5 adv", "user": i % users}
+                for i in range(rows)
+            ),
+        )
+        connection.commit()
+
+
+def storage_latency(srm, rows, users=1000, count=2000, repeat=1):
+    """
+    Return get, save and delete latency in seconds on a table of rows rolls,
+    the best of repeat passes.
+    """
+    fill_saved_rolls(srm, rows, users)
+    # Keys of rows as fill_saved_rolls numbers them.
+    indexes = [random.randrange(rows) for _ in range(count)]
+    keys = [(f"roll{i // users}", i % users) for i in indexes]
+    # Every delete has to find a roll, so each key is only deleted once.
+    unique_keys = list(set(keys))
+
+    def timed(method, keys, *args):
+        start = time.perf_counter()
+        for name, user in keys:
+            method(name, *args, user)
+        return (time.perf_counter() - start) / len(keys)
+
+    latencies = []
+    for _ in range(repeat):
+        get = timed(srm.get, keys)
+        save = timed(srm.save, keys, ["2d6+3"])
+        delete = timed(srm.delete, unique_keys)
+        latencies.append((get, save, delete))
+
+        # Put the deleted rolls back for the next pass.
+        for name, user in unique_keys:
+            srm.save(name, ["2d6+3"], user)
+
+    return tuple(min(times) for times in zip(*latencies))
+
+
+def bench_storage(rows):
+    with tempfile.TemporaryDirectory() as directory:
+        setups = (
+            (
+                "in-memory",
+                lambda: SavedRollManager("file:bench?mode=memory&cache=shared"),
+            ),
+            (
+                "untuned file",
+                lambda: SavedRollManager(os.path.join(directory, "untuned.db")),
+            ),
+            (
+                "durable file",
+                lambda: SavedRollManager(
+                    os.path.join(directory, "bench.db"), durable=True
+                ),
+            ),
+        )
+        for name, setup in setups:
+            srm = setup()
+            get, save, delete = storage_latency(srm, rows)
+            srm.close()
+            print(
+                f"SavedRollManager ({name}, {rows:,} rows): "
+                f"get {get * 1e6:,.1f} us, save {save * 1e6:,.1f} us, "
+                f"delete {delete * 1e6:,.1f} us"
+            )
+
+
+def bench_transfer(rows):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "export.jsonl")
+        srm = SavedRollManager(os.path.join(directory, "source.db"), durable=True)
+        fill_saved_rolls(srm, rows)
+        start = time.perf_counter()
+        with open(path, "w") as f:
+            srm.export_rolls(f)
+        export = time.perf_counter() - start
+        srm.close()
+
+        srm = SavedRollManager(os.path.join(directory, "target.db"), durable=True)
+        start = time.perf_counter()
+        with open(path) as f:
+            srm.import_rolls(f)
+        load = time.perf_counter() - start
+        srm.close()
+        size = os.path.getsize(path)
+
+    print(
+        f"Saved roll transfer ({rows:,} rows, {size / 2**20:,.1f} MiB): "
+        f"export {rows / export:,.0f} rows/s, import {rows / load:,.0f} rows/s"
+    )
+
+
+def bench_history(rows, users=1000):
+    command = RollCommand.from_args(["1d20+5", "2d6+3"])
+    results = command.roll()
+    with tempfile.TemporaryDirectory() as directory:
+        srm = SavedRollManager(os.path.join(directory, "bench.db"), durable=True)
+        history = srm.history
+
+        start = time.perf_counter()
+        for i in range(rows):
+            history.append(i % 50, i % users, "1d20+5 2d6+3", results)
+        history.flush()
+        append = (time.perf_counter() - start) / rows
+
+        first = bench(lambda: history.by_user(random.randrange(users)), number=200)
+        after = history.by_user(0)[-1].id
+        older = bench(lambda: history.by_user(0, after), number=200)
+        chat = bench(lambda: history.by_chat(random.randrange(50)), number=200)
+        # Move the write-ahead log into the database file, or it's not counted.
+        with srm.pool.connection() as connection:
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size = os.path.getsize(os.path.join(directory, "bench.db"))
+        srm.close()
+
+    print(
+        f"RollHistory ({rows:,} rolls, {size / rows:,.0f} bytes/roll): "
+        f"append {append * 1e6:,.1f} us, page by user {first * 1e6:,.1f} us, "
+        f"next page {older * 1e6:,.1f} us, page by chat {chat * 1e6:,.1f} us"
+    )
+
+
+INLINE_QUERIES = CORPUS + ["1d20+5 adv", "2d6+3 x4", "1d20 dis", "4d6 x6"]
+
+
+def keystrokes(query):
+    """Return the inline queries sent while typing query, one per keystroke."""
+    return [query[:i] for i in range(1, len(query) + 1)]
+
+
+def bench_inline(users):
+    rng = random.Random(1)
+    streams = [
+        (user, keystrokes(rng.choice(INLINE_QUERIES)))
+        for user in range(users)
+        for _ in range(5)
+    ]
+    rng.shuffle(streams)
+
+    roller = InlineRoller()
+    answered = 0
+    start = time.perf_counter()
+    for user, stream in streams:
+        for query in stream:
+            if roller.answer(user, query)["results"]:
+                answered += 1
+    elapsed = time.perf_counter() - start
+
+    count = roller.latency.count
+    quantiles = ", ".join(
+        f"p{q * 100:g} {roller.latency.quantile(q) * 1e6:,.0f} us"
+        for q in (0.5, 0.99, 0.999)
+    )
+    print(
+        f"InlineRoller ({count:,} keystrokes from {users:,} users): "
+        f"{count / elapsed:,.0f} queries/s, {quantiles}"
+    )
+    print(
+        f"Answered {answered / count:.0%}, short-circuited {roller.partial:,}, "
+        f"over budget {roller.over_budget:,}"
+    )
+
+
+STARTUP = "import commands; commands.open_saved_roll_manager().close()"
+"""str: Code run to time startup, up to having a SavedRollManager"""
+
+
+def startup_time(env, cwd, runs):
+    """Return the shortest time taken to start up, in seconds."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", STARTUP], env=env, cwd=cwd, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_startup(runs=10):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bundle.json")
+        bundle.build(path)
+
+        # Start from another directory, so paths have to be resolved relative
+        # to the code rather than the working directory.
+        env = dict(os.environ, PYTHONPATH=str(bundle.HERE))
+        env["FOXROLLBOT_BUNDLE"] = path
+        bundled = startup_time(env, directory, runs)
+        env["FOXROLLBOT_BUNDLE"] = os.path.join(directory, "missing.json")
+        rendered = startup_time(env, directory, runs)
+
+    for name, seconds in (("rendering templates", rendered), ("bundle", bundled)):
+        print(f"Startup ({name}): {seconds * 1000:,.1f} ms")
+    print(f"Speedup: {rendered / bundled:.2f}x")
+
+
+def suite_cases():
+    """
+    Yield the name and a timing function of each case in the suite. Timing
+    functions return seconds per operation.
+    """
+
+    # More repeats than usual, since the suite is compared between runs.
+    def timing(func):
+        return bench(func, repeat=9)
+
+    yield "Dice.from_str", lambda: timing(lambda: Dice.from_str("4d6"))
+    yield "Roll.from_str", lambda: timing(lambda: parse_corpus(Roll.from_str)) / len(
+        CORPUS
+    )
+
+    args = ["1d20+5", "adv", "x2", "2d6+3"]
+    RollCommand.from_args(args)
+    yield "RollCommand.from_args (cached)", lambda: timing(
+        lambda: RollCommand.from_args(args)
+    )
+    yield "RollCommand.from_args (uncached)", lambda: timing(
+        lambda: RollCommand._parse_args(args)
+    )
+
+    advantage = Roll.from_str("1d20+4d6+5", Roll.ADVANTAGE)
+    yield "Roll.roll (advantage)", lambda: timing(advantage.roll)
+    result = advantage.roll()
+    yield "RollResult.__str__", lambda: timing(result.__str__)
+
+
+def storage_cases(sizes):
+    """
+    Yield the name and seconds per operation of SavedRollManager's get, save
+    and delete on a durable database of each size.
+    """
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            srm = SavedRollManager(os.path.join(directory, "bench.db"), durable=True)
+            try:
+                latencies = storage_latency(srm, rows, repeat=5)
+            finally:
+                srm.close()
+        for method, seconds in zip(("get", "save", "delete"), latencies):
+            yield f"SavedRollManager.{method} ({rows:,} rows)", seconds
+
+
+def run_suite(sizes):
+    """
+    Time every case in the suite.
+
+    Returns:
+        dict: Suite results, with the seconds per operation of each case
+    """
+    cases = {}
+    for name, timing in suite_cases():
+        cases[name] = timing()
+    cases.update(storage_cases(sizes))
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cases": {name: {"seconds": seconds} for name, seconds in cases.items()},
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare suite results with a baseline.
+
+    Args:
+        results (dict): Suite results
+        baseline (dict): Earlier suite results
+        threshold (float): Slowdown beyond which a case is a regression, as a
+            fraction of its baseline time
+
+    Returns:
+        list: Names of cases that regressed
+    """
+    regressions = []
+    for name, case in results["cases"].items():
+        if name not in baseline["cases"]:
+            print(f"{name}: {case['seconds'] * 1e6:,.2f} us (new)")
+            continue
+        before = baseline["cases"][name]["seconds"]
+        change = case["seconds"] / before - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name}: {case['seconds'] * 1e6:,.2f} us "
+            f"(was {before * 1e6:,.2f} us, {change:+.1%}){flag}"
+        )
+    return regressions
+
+
+def bench_suite(sizes, output=None, baseline=None, threshold=0.25):
+    results = run_suite(sizes)
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {threshold:.0%}")
+            sys.exit(1)
+    elif output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+BENCHMARKS = (
+    "parse",
+    "results",
+    "storage",
+    "history",
+    "transfer",
+    "inline",
+    "suite",
+    "startup",
+)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run foxrollbot benchmarks.")
+    parser.add_argument(
+        "benchmarks", nargs="*", help=f"Benchmarks to run: {', '.join(BENCHMARKS)}"
+    )
+    parser.add_argument(
+        "--rows", type=int, default=100_000, help="Saved rolls to store"
+    )
+    parser.add_argument(
+        "--users", type=int, default=2000, help="Users typing inline queries"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1_000, 100_000],
+        help="Table sizes to time storage at in the suite",
+    )
+    parser.add_argument("--output", help="File to save suite results to, as JSON")
+    parser.add_argument("--baseline", help="Suite results to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Slowdown that counts as a regression, as a fraction",
+    )
+    args = parser.parse_args()
+    benchmarks = args.benchmarks or BENCHMARKS
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    if "parse" in benchmarks:
+        bench_parse()
+    if "results" in benchmarks:
+        bench_results()
+    if "storage" in benchmarks:
+        bench_storage(args.rows)
+    if "history" in benchmarks:
+        bench_history(args.rows)
+    if "transfer" in benchmarks:
+        bench_transfer(args.rows)
+    if "inline" in benchmarks:
+        bench_inline(args.users)
+    if "startup" in benchmarks:
+        bench_startup()
+    if "suite" in benchmarks:
+        bench_suite(args.sizes, args.output, args.baseline, args.threshold)
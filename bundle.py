@@ -0,0 +1,168 @@
+"""
+Prebuilt bundle of the bot's SQL statements and texts.
+
+Rendering the SQL templates means importing jinja2, which takes longer than
+everything else the bot does at startup. `python bundle.py` renders them once,
+along with the texts, into bundle.json next to this file, and starting up
+just reads that. A bundle whose sources have changed since it was built is
+ignored, and everything is loaded from the sources instead, so a stale bundle
+can't do any harm.
+"""
+
+import json
+import os
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+"""Path: Directory the bot's files are in"""
+
+SQL_DIR = HERE / "sql"
+"""Path: Directory of SQL templates"""
+
+TEXT_DIR = HERE / "text"
+"""Path: Directory of texts"""
+
+BUNDLE_PATH = Path(os.environ.get("FOXROLLBOT_BUNDLE", HERE / "bundle.json"))
+"""Path: Bundle file, which FOXROLLBOT_BUNDLE can change"""
+
+TABLE_NAMES = ("saved_rolls", "roll_history", "luck")
+"""tuple: Table names SQL is rendered for when building the bundle"""
+
+_bundle = None
+
+
+def sources():
+    """
+    Describe the files the bundle is built from.
+
+    Returns:
+        dict: Modification time and size of each file, keyed by its path
+            relative to HERE
+    """
+    files = {}
+    for directory in (SQL_DIR, TEXT_DIR):
+        for path in sorted(directory.rglob("*")):
+            if path.is_file():
+                stat = path.stat()
+                files[path.relative_to(HERE).as_posix()] = [
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                ]
+    return files
+
+
+def render_sql(table_name):
+    """
+    Render the SQL templates.
+
+    Args:
+        table_name (str): Name of table to render statements for
+
+    Returns:
+        dict: Statements keyed by path relative to SQL_DIR, without suffix,
+            such as "create_table"
+    """
+    from jinja2 import Template
+
+    context = {"table_name": table_name}
+    statements = {}
+    for path in sorted(SQL_DIR.rglob("*.sql")):
+        name = path.relative_to(SQL_DIR).with_suffix("").as_posix()
+        with open(path) as f:
+            statements[name] = Template(f.read().strip()).render(context)
+    return statements
+
+
+def read_texts():
+    """
+    Read the texts.
+
+    Returns:
+        dict: Texts keyed by file name
+    """
+    texts = {}
+    for path in sorted(TEXT_DIR.iterdir()):
+        if path.is_file():
+            with open(path) as f:
+                texts[path.name] = f.read().strip()
+    return texts
+
+
+def build(path=BUNDLE_PATH):
+    """
+    Write a bundle of everything rendered.
+
+    Args:
+        path (Path): File to write
+    """
+    bundle = {
+        "sources": sources(),
+        "sql": {table_name: render_sql(table_name) for table_name in TABLE_NAMES},
+        "text": read_texts(),
+    }
+    temporary = Path(f"{path}.tmp")
+    with open(temporary, "w") as f:
+        json.dump(bundle, f, indent=1, sort_keys=True)
+    os.replace(temporary, path)
+
+
+def load(path=BUNDLE_PATH):
+    """
+    Read a bundle, if it's up to date.
+
+    Args:
+        path (Path): File to read
+
+    Returns:
+        dict: Bundle, or an empty dict if it's missing or out of date
+    """
+    try:
+        with open(path) as f:
+            bundle = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if bundle.get("sources") != sources():
+        return {}
+    return bundle
+
+
+def _default():
+    """Get the bundle at BUNDLE_PATH, reading it the first time."""
+    global _bundle
+    if _bundle is None:
+        _bundle = load()
+    return _bundle
+
+
+def sql(table_name):
+    """
+    Get the SQL statements for a table, from the bundle if possible.
+
+    Args:
+        table_name (str): Name of table
+
+    Returns:
+        dict: Statements keyed by name
+    """
+    statements = _default().get("sql", {}).get(table_name)
+    if statements is None:
+        statements = render_sql(table_name)
+    return statements
+
+
+def texts():
+    """
+    Get the texts, from the bundle if possible.
+
+    Returns:
+        dict: Texts keyed by name
+    """
+    bundled = _default().get("text")
+    if bundled is None:
+        bundled = read_texts()
+    return bundled
+
+
+if __name__ == "__main__":
+    build()
+    print(f"Wrote {BUNDLE_PATH}")
@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded least-recently-used cache.
+
+    Entries can optionally expire a fixed time after they were stored, and
+    the cache can optionally be bounded by the total weight of its entries
+    as well as by their number.
+
+    Attributes:
+        maxsize (int): Maximum number of entries kept before the least
+            recently used one is evicted
+        maxweight (int): Maximum total weight of entries kept, or None if
+            only their number is bounded
+        ttl (float): Number of seconds entries stay valid, or None if they
+            never expire
+        hits (int): Number of lookups that found an entry
+        misses (int): Number of lookups that did not find an entry
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize=1024, ttl=None, maxweight=None, weigh=None):
+        """
+        Create an LRUCache instance.
+
+        Args:
+            maxsize (int): Maximum number of entries to keep
+            ttl (float): Number of seconds entries stay valid, or None if they
+                never expire
+            maxweight (int): Maximum total weight of entries to keep, or None
+                for no limit. An entry heavier than this is never kept.
+            weigh (callable): Function giving the weight of a value; needed
+                if maxweight is given
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        if maxweight is not None and weigh is None:
+            raise ValueError("weigh is needed to limit weight")
+
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._weigh = weigh
+        self._weight = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Look up an entry, marking it as the most recently used.
+
+        Args:
+            key: Key of entry to look up
+            default: Value to return if there is no such entry
+
+        Returns:
+            The cached value, or `default` if the key isn't cached
+        """
+        with self._lock:
+            value, expires = self._entries.get(key, (self._MISSING, None))
+            if expires is not None and expires <= time.monotonic():
+                self._remove(key)
+                value = self._MISSING
+
+            if value is self._MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Store an entry, evicting the least recently used one if necessary.
+
+        Args:
+            key: Key of entry to store
+            value: Value to store
+        """
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, expires)
+            if self.maxweight is not None:
+                self._weight += self._weigh(value)
+            while len(self._entries) > self.maxsize or (
+                self.maxweight is not None and self._weight > self.maxweight
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        """Remove an entry if it exists. Needs _lock."""
+        value, _ = self._entries.pop(key, (self._MISSING, None))
+        if value is not self._MISSING and self.maxweight is not None:
+            self._weight -= self._weigh(value)
+
+    def discard(self, key):
+        """
+        Remove an entry if it exists.
+
+        Args:
+            key: Key of entry to remove
+        """
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """Remove all entries and reset the hit and miss counters."""
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,593 @@
+"""
+The bot's commands, independent of how updates reach the bot.
+
+Each command takes the message it was sent in, its arguments and the
+SavedRollManager to use, and returns the keyword arguments of the reply to
+send with sendMessage. Messages only need `chat_id`, `message_id` and
+`from_user.id` attributes, like python-telegram-bot's Message.
+"""
+
+import os
+import time
+from functools import wraps
+
+import bundle
+import metrics
+from db import SavedRollManager
+from luck import FATE, lowest
+from profiling import profiler
+from roll import RollCommand, Dice
+from stats import check_work, summary
+from text import StaticReplies, Text
+from errors import *
+
+text = Text.from_texts(bundle.texts(), bundle.TEXT_DIR)
+static_replies = StaticReplies(
+    text, {"start": None, "about": "Markdown", "help": "Markdown"}
+)
+
+
+def open_saved_roll_manager(shared=False):
+    """
+    Create the SavedRollManager described by the environment.
+
+    Saved rolls are kept in memory unless FOXROLLBOT_DB gives a database
+    file. Writes to a file can be batched by setting FOXROLLBOT_WRITE_DELAY to
+    a number of seconds to wait for more of them.
+
+    Args:
+        shared (bool): Whether other processes use the database too. Their
+            changes have to be seen straight away, so nothing is cached and
+            writes aren't batched.
+
+    Returns:
+        SavedRollManager: New manager
+    """
+    if "FOXROLLBOT_DB" in os.environ:
+        if shared:
+            return SavedRollManager(
+                os.environ["FOXROLLBOT_DB"], durable=True, cache_size=0
+            )
+        write_delay = os.environ.get("FOXROLLBOT_WRITE_DELAY")
+        return SavedRollManager(
+            os.environ["FOXROLLBOT_DB"],
+            durable=True,
+            write_delay=float(write_delay) if write_delay else None,
+        )
+    elif shared:
+        raise ValueError("Sharing saved rolls between processes needs FOXROLLBOT_DB")
+    else:
+        return SavedRollManager()
+
+
+def admins():
+    """
+    Get the users allowed to use admin commands, from FOXROLLBOT_ADMINS.
+
+    Returns:
+        set: IDs of admins
+    """
+    ids = os.environ.get("FOXROLLBOT_ADMINS", "")
+    return {int(i) for i in ids.replace(",", " ").split()}
+
+
+def count_error(error):
+    """Count an error a command ran into, by type."""
+    metrics.registry.counter(
+        "foxrollbot_errors_total",
+        "Errors commands ran into, by type",
+        type=type(error).__name__,
+    ).inc()
+
+
+def instrument(command):
+    """
+    Decorator counting and timing every call of a command, and counting the
+    unexpected errors it raises. Calls are sampled by the profiler too, tagged
+    with their arguments.
+    """
+    name = command.__name__[: -len("_reply")]
+    calls = metrics.registry.counter(
+        "foxrollbot_commands_total", "Commands handled", command=name
+    )
+    latency = metrics.registry.histogram(
+        "foxrollbot_command_seconds", "Time taken to handle commands", command=name
+    )
+
+    @wraps(command)
+    def wrapper(message, args, srm):
+        calls.inc()
+        try:
+            with latency.time():
+                return profiler.run(name, " ".join(args), command, message, args, srm)
+        except Exception as e:
+            count_error(e)
+            raise
+
+    return wrapper
+
+
+def roll_phase(phase):
+    """Get the histogram timing one phase of the roll command."""
+    return metrics.registry.histogram(
+        "foxrollbot_roll_phase_seconds",
+        "Time taken by each phase of the roll command",
+        phase=phase,
+    )
+
+
+def reply_to(message, **kwargs):
+    """Start a Markdown reply to a message."""
+    msg_args = {
+        "chat_id": message.chat_id,
+        "reply_to_message_id": message.message_id,
+        "parse_mode": "Markdown",
+    }
+    msg_args.update(kwargs)
+    return msg_args
+
+
+def mention(user):
+    """Link to a user in Markdown, named by their first name."""
+    name = "".join(c for c in user.first_name or "" if c not in "_*`[]")
+    return f"[{name or user.id}](tg://user?id={user.id})"
+
+
+@instrument
+def start_reply(message, args, srm):
+    return static_replies.reply("start", message.chat_id)
+
+
+@instrument
+def about_reply(message, args, srm):
+    return static_replies.reply("about", message.chat_id)
+
+
+@instrument
+def help_reply(message, args, srm):
+    return static_replies.reply("help", message.chat_id)
+
+
+SUGGESTIONS = 5
+"""int: Most saved rolls suggested for a name that doesn't exist"""
+
+
+def rolled_reply(message, args, srm, syntax):
+    """
+    Roll a command's arguments, or the saved roll they name, and record the
+    results.
+
+    Args:
+        message: Message the command was sent in
+        args (list): Arguments of the command
+        srm (SavedRollManager): Manager of saved rolls and their history
+        syntax (str): Syntax of the command, for when its arguments are
+            invalid
+
+    Returns:
+        dict: Keyword arguments of the reply
+    """
+    msg_args = reply_to(message)
+
+    try:
+        with roll_phase("parse").time():
+            if len(args) < 1:
+                command = Dice(1, 20)
+            elif args[0][0].isalpha():
+                command = srm.get_command(args[0], message.from_user.id)
+            else:
+                command = RollCommand.from_args(args)
+
+        with roll_phase("roll").time():
+            results = command.roll()
+            if isinstance(command, Dice):
+                results = [results]
+
+        with roll_phase("format").time():
+            msg_args["text"] = "\n\n".join(str(r) for r in results)
+
+        with roll_phase("record").time():
+            srm.history.append(
+                message.chat_id,
+                message.from_user.id,
+                " ".join(args) or str(command),
+                results,
+            )
+            srm.luck.record_results(message.chat_id, message.from_user.id, results)
+    except InvalidSyntaxException as e:
+        count_error(e)
+        msg_args["text"] = f"Syntax: {syntax}"
+    except DoesNotExistException as e:
+        count_error(e)
+        msg_args["text"] = str(e)
+        # The name may be the start of one, as there's nothing to complete
+        # names as they're typed.
+        names = [name for name, _ in srm.list_rolls(message.from_user.id, args[0])]
+        if names:
+            suggestions = ", ".join(f"`{name}`" for name in names[:SUGGESTIONS])
+            msg_args["text"] += f" Did you mean {suggestions}?"
+    except FoxRollBotException as e:
+        count_error(e)
+        msg_args["text"] = str(e)
+
+    return msg_args
+
+
+@instrument
+def roll_reply(message, args, srm):
+    return rolled_reply(message, args, srm, text.roll_syntax)
+
+
+@instrument
+def stats_reply(message, args, srm):
+    msg_args = reply_to(message)
+
+    try:
+        if len(args) < 1:
+            raise InvalidSyntaxException()
+        elif args[0][0].isalpha():
+            command = srm.get_command(args[0], message.from_user.id)
+        else:
+            command = RollCommand.from_args(args)
+
+        # Repeated rolls share a single Roll instance, so only describe it once.
+        rolls = list({id(r): r for r in command.rolls}.values())
+        check_work(rolls)
+        msg_args["text"] = "\n\n".join(summary(r) for r in rolls)
+    except InvalidSyntaxException as e:
+        count_error(e)
+        msg_args["text"] = f"Syntax: {text.stats_syntax}"
+    except FoxRollBotException as e:
+        count_error(e)
+        msg_args["text"] = str(e)
+
+    return msg_args
+
+
+@instrument
+def save_reply(message, args, srm):
+    msg_args = reply_to(message)
+
+    try:
+        srm.save(args[0], args[1:], message.from_user.id)
+        msg_args["text"] = f"Roll successfully saved as `{args[0]}`!"
+    except InvalidSyntaxException as e:
+        count_error(e)
+        msg_args["text"] = f"Syntax: {text.save_syntax}"
+    except FoxRollBotException as e:
+        count_error(e)
+        msg_args["text"] = str(e)
+
+    return msg_args
+
+
+@instrument
+def delete_reply(message, args, srm):
+    msg_args = reply_to(message)
+
+    try:
+        srm.delete(args[0], message.from_user.id)
+        msg_args["text"] = f"Successfully deleted `{args[0]}`."
+    except FoxRollBotException as e:
+        count_error(e)
+        msg_args["text"] = str(e)
+
+    return msg_args
+
+
+LIST_LENGTH = 50
+"""int: Most saved rolls /list shows"""
+
+
+@instrument
+def list_reply(message, args, srm):
+    msg_args = reply_to(message)
+
+    if len(args) > 1:
+        msg_args["text"] = f"Syntax: {text.list_syntax}"
+        return msg_args
+
+    prefix = args[0] if args else ""
+    rolls = srm.list_rolls(message.from_user.id, prefix)
+    if not rolls:
+        if prefix:
+            msg_args["text"] = f"You have no saved rolls starting with `{prefix}`."
+        else:
+            msg_args["text"] = "You haven't saved any rolls yet."
+        return msg_args
+
+    lines = [f"`{name}`: {arguments}" for name, arguments in rolls[:LIST_LENGTH]]
+    if len(rolls) > LIST_LENGTH:
+        lines.append(
+            f"...and {len(rolls) - LIST_LENGTH:,} more. `/list <start of name>` "
+            "shows those starting with something."
+        )
+    msg_args["text"] = "\n".join(lines)
+    return msg_args
+
+
+HISTORY_DICE = 20
+"""int: Most dice of a roll /history lists"""
+
+
+def format_entry(entry):
+    """Describe a roll from the history in a line."""
+    made = time.strftime("%Y-%m-%d %H:%M", time.gmtime(entry.time))
+    totals = ", ".join(str(total) for total in entry.totals)
+    line = f"{made} `{entry.expression}`: {totals}"
+    if len(entry.dice) > 1:
+        dice = ", ".join(str(die) for die in entry.dice[:HISTORY_DICE])
+        more = ", ..." if len(entry.dice) > HISTORY_DICE else ""
+        line += f" ({dice}{more})"
+    return line
+
+
+@instrument
+def history_reply(message, args, srm):
+    msg_args = reply_to(message)
+
+    try:
+        args = list(args)
+        after = int(args.pop()) if args and args[-1].isdecimal() else None
+        if args == ["chat"]:
+            entries = srm.history.by_chat(message.chat_id, after)
+            title = "Rolls in this chat"
+            command = "/history chat"
+        elif not args:
+            # Private chats show rolls from everywhere, but groups only show
+            # those made in them, so nothing rolled privately leaks into one.
+            user = message.from_user.id
+            chat = None if message.chat_id == user else message.chat_id
+            entries = srm.history.by_user(user, after, chat=chat)
+            title = "Your rolls" if chat is None else "Your rolls in this chat"
+            command = "/history"
+        else:
+            raise InvalidSyntaxException()
+    except InvalidSyntaxException as e:
+        count_error(e)
+        msg_args["text"] = f"Syntax: {text.history_syntax}"
+        return msg_args
+
+    if not entries:
+        msg_args["text"] = "No rolls found." if after is None else "No older rolls."
+        return msg_args
+
+    lines = [f"*{title}* (UTC)"] + [format_entry(entry) for entry in entries]
+    # A full page may not be the last one.
+    if len(entries) == srm.history.PAGE_SIZE:
+        lines.append(f"Older: `{command} {entries[-1].id}`")
+    msg_args["text"] = "\n".join(lines)
+    return msg_args
+
+
+LUCK_MIN_ROLLS = 5
+"""int: Fewest rolls of a die someone needs to be on its leaderboard"""
+
+LUCK_LEADERS = 10
+"""int: Number of people on a leaderboard"""
+
+
+def parse_die(arg):
+    """Get the die a /luck argument like "d20" or "dF" names."""
+    if arg.lower() in ("df", "fate"):
+        return FATE
+    if arg[:1] == "d" and arg[1:].isdecimal() and int(arg[1:]) >= 2:
+        return int(arg[1:])
+    raise InvalidSyntaxException()
+
+
+def die_name(die):
+    return "dF" if die == FATE else f"d{die}"
+
+
+def format_tally(tally):
+    """Describe a tally in a line."""
+    lowest, highest = ("-", "+") if tally.die == FATE else (1, tally.die)
+    return (
+        f"{die_name(tally.die)}: {tally.count:,} rolled, average {tally.mean:.2f} "
+        f"({tally.expected:g} expected, luck {tally.luck:+.1f}), "
+        f"{tally.lows:,} × {lowest}, {tally.highs:,} × {highest}"
+    )
+
+
+@instrument
+def luck_reply(message, args, srm):
+    msg_args = reply_to(message)
+
+    try:
+        if args[:1] == ["chat"]:
+            if len(args) > 2:
+                raise InvalidSyntaxException()
+            die = parse_die(args[1]) if len(args) > 1 else 20
+            tallies = srm.luck.by_chat(message.chat_id, die)
+            leaders = sorted(
+                (
+                    (tally.luck, user, tally)
+                    for user, tally in tallies.items()
+                    if tally.count >= LUCK_MIN_ROLLS
+                ),
+                reverse=True,
+            )[:LUCK_LEADERS]
+            lines = [f"*Luckiest {die_name(die)} rollers in this chat*"]
+            lines += [
+                f"{rank}. [{user}](tg://user?id={user}): luck {luck:+.1f} "
+                f"over {tally.count:,} rolls"
+                for rank, (luck, user, tally) in enumerate(leaders, 1)
+            ]
+            if not leaders:
+                lines = [
+                    f"Nobody has rolled {die_name(die)} here {LUCK_MIN_ROLLS} "
+                    "times yet."
+                ]
+        elif len(args) == 1:
+            die = parse_die(args[0])
+            tally = srm.luck.get(message.chat_id, message.from_user.id, die)
+            if tally is None:
+                lines = [f"You haven't rolled {die_name(die)} here yet."]
+            else:
+                faces = " | ".join(
+                    f"{face}: {count:,}"
+                    for face, count in enumerate(tally.faces, lowest(die))
+                )
+                lines = [f"*Your {die_name(die)} rolls*", format_tally(tally), faces]
+        elif not args:
+            tallies = srm.luck.by_user(message.chat_id, message.from_user.id)
+            lines = ["*Your dice in this chat*"]
+            lines += [format_tally(tallies[die]) for die in sorted(tallies)]
+            if not tallies:
+                lines = ["You haven't rolled anything here yet."]
+        else:
+            raise InvalidSyntaxException()
+    except InvalidSyntaxException as e:
+        count_error(e)
+        msg_args["text"] = f"Syntax: {text.luck_syntax}"
+        return msg_args
+
+    msg_args["text"] = "\n".join(lines)
+    return msg_args
+
+
+FATE_ROLL = "4dF"
+"""str: Roll /fate makes, along with any modifier it's given"""
+
+
+@instrument
+def fate_reply(message, args, srm):
+    # Anything other than dice applies to the default Fate roll.
+    if not args or not args[0][0].isdigit():
+        if args and args[0][0] in "+-":
+            args = [FATE_ROLL + args[0]] + args[1:]
+        else:
+            args = [FATE_ROLL] + list(args)
+    return rolled_reply(message, args, srm, text.fate_syntax)
+
+
+def format_latency(histogram):
+    quantiles = "/".join(
+        f"{histogram.quantile(q) * 1000:.1f}" for q in (0.5, 0.95, 0.99)
+    )
+    return f"{histogram.count:,} ({quantiles} ms)"
+
+
+@instrument
+def botstats_reply(message, args, srm):
+    msg_args = reply_to(message)
+
+    if message.from_user.id not in admins():
+        msg_args["text"] = "Only the bot's admins can see its stats."
+        return msg_args
+
+    lines = []
+    for family in metrics.registry.collect():
+        section = []
+        for labels, metric in sorted(family.children.items()):
+            label = ", ".join(str(value) for _, value in labels) or "all"
+            label = label.replace("_", "\\_")
+            if family.kind == "histogram" and metric.count:
+                section.append(f"{label}: {format_latency(metric)}")
+            elif family.kind == "counter" and metric.value:
+                value = metric.value
+                value = f"{value:,.3f}" if isinstance(value, float) else f"{value:,}"
+                section.append(f"{label}: {value}")
+        if section:
+            lines += [f"*{family.help}*"] + section + [""]
+
+    msg_args["text"] = "\n".join(lines).strip() or "Nothing to report yet."
+    return msg_args
+
+
+PROFILE_PATH = "profile.folded"
+"""str: Default file for /profile dump to write to"""
+
+
+@instrument
+def profile_reply(message, args, srm):
+    msg_args = reply_to(message)
+
+    if message.from_user.id not in admins():
+        msg_args["text"] = "Only the bot's admins can use the profiler."
+        return msg_args
+
+    try:
+        action = args[0] if args else "status"
+        if action == "on":
+            rate = float(args[1]) if len(args) > 1 else 0.01
+            if not 0 < rate <= 1:
+                raise ValueError()
+            profiler.rate = rate
+        elif action == "off":
+            profiler.rate = 0.0
+        elif action == "clear":
+            profiler.clear()
+        elif action == "dump":
+            path = os.environ.get("FOXROLLBOT_PROFILE", PROFILE_PATH)
+            profiler.dump(path)
+            msg_args["text"] = f"Wrote sampled stacks to `{path}`."
+            return msg_args
+        elif action != "status":
+            raise ValueError()
+    except ValueError:
+        msg_args["text"] = "Syntax: `/profile [on [rate]|off|clear|dump]`"
+        return msg_args
+
+    lines = [f"Sampling {profiler.rate:.1%} of commands."]
+    for command, expression, sample in profiler.top(5):
+        expression = expression.replace("`", "'")
+        line = (
+            f"`/{command} {expression}`: {sample.count:,} sampled, "
+            f"{sample.seconds / sample.count * 1000:.2f} ms each"
+        )
+        if sample.peak:
+            line += f", up to {sample.peak:,} bytes"
+        lines.append(line)
+    msg_args["text"] = "\n".join(lines)
+    return msg_args
+
+
+COMMANDS = {
+    "start": start_reply,
+    "about": about_reply,
+    "help": help_reply,
+    "roll": roll_reply,
+    "r": roll_reply,
+    "stats": stats_reply,
+    "save": save_reply,
+    "delete": delete_reply,
+    "list": list_reply,
+    "history": history_reply,
+    "luck": luck_reply,
+    "fudge": fate_reply,
+    "fate": fate_reply,
+    "f": fate_reply,
+    "rf": fate_reply,
+    "botstats": botstats_reply,
+    "profile": profile_reply,
+}
+"""dict: Commands by name, as typed after the slash"""
+
+
+def may_block(command, args):
+    """
+    Check whether running a command could block for long, on the database or
+    on computation, and so shouldn't run on an event loop.
+
+    Args:
+        command (callable): Command function from COMMANDS
+        args (list): Arguments the command will be given
+
+    Returns:
+        bool: True if the command may query the SavedRollManager or compute
+            statistics
+    """
+    if command in (
+        save_reply,
+        delete_reply,
+        list_reply,
+        history_reply,
+        luck_reply,
+        stats_reply,
+    ):
+        return True
+    if command is roll_reply:
+        return len(args) > 0 and args[0][0].isalpha()
+    return False
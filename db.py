@@ -1,44 +1,231 @@
+import json
 import os
 import sqlite3
-from pathlib import Path
-
-from jinja2 import Template
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from itertools import chain
 
+import bundle
+import metrics
+from cache import LRUCache
+from history import RollHistory
+from luck import LuckTracker
 from roll import RollCommand
 from errors import *
 
 
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of database connections.
+
+    Connections are created as they're needed, up to a maximum, and handed
+    back out most-recently-used first, so a busy worker thread tends to keep
+    getting the same connection and its cache of prepared statements. When
+    every connection is in use, callers wait for one to be released.
+
+    Attributes:
+        size (int): Maximum number of connections
+        waits (int): Number of times a caller had to wait for a connection
+        wait_time (float): Total number of seconds spent waiting
+    """
+
+    def __init__(self, connect, size):
+        """
+        Create a ConnectionPool instance.
+
+        Args:
+            connect (callable): Function that opens a new connection
+            size (int): Maximum number of connections
+        """
+        self.size = size
+        self.waits = 0
+        self.wait_time = 0.0
+
+        self._connect = connect
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Take a connection from the pool, waiting for one if necessary.
+
+        Returns:
+            sqlite3.Connection: Connection for the exclusive use of the caller
+        """
+        with self._condition:
+            if not self._idle and self._open >= self.size:
+                self.waits += 1
+                start = time.perf_counter()
+                self._condition.wait_for(lambda: self._idle or self._closed)
+                self.wait_time += time.perf_counter() - start
+
+            if self._closed:
+                raise sqlite3.ProgrammingError("Connection pool is closed.")
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, connection):
+        """
+        Return a connection to the pool.
+
+        Args:
+            connection (sqlite3.Connection): Connection taken with acquire()
+        """
+        with self._condition:
+            if self._closed:
+                self._open -= 1
+                connection.close()
+            else:
+                self._idle.append(connection)
+                self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that borrows a connection from the pool. Any open
+        transaction is rolled back if the block raises.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            self.release(connection)
+
+    def close(self):
+        """
+        Close idle connections, and any others as soon as they're released.
+        """
+        with self._condition:
+            self._closed = True
+            for connection in self._idle:
+                connection.close()
+            self._open -= len(self._idle)
+            self._idle.clear()
+            self._condition.notify_all()
+
+
 class SavedRollManager:
     """
     Class for managing saved rolls.
 
     Attributes:
         db (str): URI of database used for connections
+        pool (ConnectionPool): Pool of connections used by methods
+        cache (LRUCache): Parsed saved rolls, keyed by (user, name), or None
+            if they aren't cached
+        names (LRUCache): Sorted lists of each user's saved rolls, as (name,
+            arguments) tuples, keyed by user, or None if they aren't cached
+        history (RollHistory): History of rolls, in the same database
+        luck (LuckTracker): Tallies of the dice rolled, in the same database
     """
 
     TABLE = "saved_rolls"
     """str: Name of table in which to store saved rolls"""
 
-    def __init__(self, db=None):
+    POOL_SIZE = 8
+    """int: Maximum number of pooled connections"""
+
+    CACHED_STATEMENTS = 32
+    """int: Number of prepared statements cached by each connection"""
+
+    CACHE_SIZE = 4096
+    """int: Maximum number of parsed saved rolls to keep in memory"""
+
+    CACHE_TTL = 600
+    """float: Number of seconds a parsed saved roll is kept in memory"""
+
+    NAMES_CACHE_SIZE = 1024
+    """int: Maximum number of users whose saved roll names are kept in memory"""
+
+    TRANSFER_BATCH = 1000
+    """int: Number of rows read or written at a time by export and import"""
+
+    _MISSING = object()
+
+    def __init__(
+        self,
+        db=None,
+        durable=False,
+        pool_size=POOL_SIZE,
+        cache_size=CACHE_SIZE,
+        cache_ttl=CACHE_TTL,
+        write_delay=None,
+    ):
         """
         Create a SavedRollManager instance.
 
         If a connection is not passed, it will use a new in-memory database.
 
         Args:
-            db (str): URI of database to connect to
+            db (str): URI or path of database to connect to
+            durable (bool): Whether db is a file to be tuned for durable
+                storage, with write-ahead logging and the pragmas in
+                sql/pragmas.sql applied to every connection
+            pool_size (int): Maximum number of pooled connections. A
+                shared-cache in-memory database always gets one, since
+                shared-cache connections lock whole tables and don't wait for
+                each other's locks.
+            cache_size (int): Maximum number of parsed saved rolls to keep,
+                or 0 not to cache them or their names, such as when other
+                processes change the same database
+            cache_ttl (float): Number of seconds to keep a parsed saved roll,
+                or None to keep it until it's evicted or changed
+            write_delay (float): If given, saves and deletes are queued and
+                written together in one transaction at most this many seconds
+                later, rather than each being committed immediately
         """
         if db is None:
             self.db = "file:foxrollbot_db?mode=memory&cache=shared"
         else:
             self.db = db
+        self.durable = durable
+
+        self._load_statements()
 
         # This attribute is used to maintain a single connection to the
         # database, so that in-memory databases aren't just lost after every
         # connection is finished.
-        self._main_connection = sqlite3.connect(self.db, uri=True)
+        self._main_connection = self.connect()
+        if self.shared_cache:
+            pool_size = 1
+        self.pool = ConnectionPool(self.connect, pool_size)
+        self._register_metrics()
+        self.history = RollHistory(self.pool)
+        self.luck = LuckTracker(self.pool)
+
+        # Incremented whenever a saved roll changes, so that a lookup racing
+        # with a change doesn't put a stale command back into the cache.
+        self.cache = LRUCache(cache_size, cache_ttl) if cache_size else None
+        self.names = LRUCache(self.NAMES_CACHE_SIZE, cache_ttl) if cache_size else None
+        self._generation = 0
+        self._generation_lock = threading.Lock()
+
+        # Writes waiting to be flushed, and those being flushed right now,
+        # keyed by (user, name). Values are the arguments to save, or None to
+        # delete. Reads check both before the database.
+        self.write_delay = write_delay
+        self._pending = {}
+        self._flushing = {}
+        self._timer = None
+        self._write_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
 
-        self._load_statements()
         self._init_db()
 
     def _init_db(self):
@@ -48,21 +235,69 @@ class SavedRollManager:
         """
         cursor = self._main_connection.cursor()
         cursor.execute(self.sql["create_table"])
+        cursor.execute(self.sql["create_index"])
         self._main_connection.commit()
 
+    def _register_metrics(self):
+        """Export the pool's contention counts, replacing any other pool's."""
+        pool = self.pool
+        metrics.registry.register(
+            "foxrollbot_db_pool_waits_total",
+            "Times a database connection had to be waited for",
+            metrics.CallbackCounter(lambda: pool.waits),
+        )
+        metrics.registry.register(
+            "foxrollbot_db_pool_wait_seconds_total",
+            "Time spent waiting for database connections",
+            metrics.CallbackCounter(lambda: pool.wait_time),
+        )
+
+    @property
+    def shared_cache(self):
+        """bool: Whether db is an in-memory database in shared-cache mode"""
+        if not self.db.startswith("file:"):
+            return False
+        options = self.db.partition("?")[2].split("&")
+        return "mode=memory" in options and "cache=shared" in options
+
     def _load_statements(self):
-        """Load SQL statements from the ./sql directory."""
-        home = Path(".")
-        context = {"table_name": self.TABLE}
-        self.sql = {}
-        for path in home.glob("./sql/*"):
-            with open(path) as f:
-                template = Template(f.read().strip())
-                self.sql[path.stem] = template.render(context)
+        """
+        Load SQL statements for TABLE, from the bundle if there's an up to
+        date one and otherwise by rendering the templates in ./sql.
+        """
+        self.sql = bundle.sql(self.TABLE)
 
     def connect(self):
-        return sqlite3.connect(self.db, uri=True)
+        """
+        Open a new connection to the database, outside of the pool.
+
+        Returns:
+            sqlite3.Connection: New connection
+        """
+        connection = sqlite3.connect(
+            self.db,
+            uri=True,
+            check_same_thread=False,
+            cached_statements=self.CACHED_STATEMENTS,
+        )
+        if self.durable:
+            connection.executescript(self.sql["pragmas"])
+        return connection
+
+    def close(self):
+        """
+        Close every connection held by this instance, after writing any
+        queued saves, deletes, rolls and tallies.
+        """
+        self.flush()
+        self.history.close()
+        self.luck.close()
+        self.pool.close()
+        self._main_connection.close()
 
+    @metrics.timed(
+        "foxrollbot_db_seconds", "Time taken by saved roll storage", method="save"
+    )
     def save(self, name, args, user):
         """
         Save a roll to the database.
@@ -75,13 +310,24 @@ class SavedRollManager:
         # Make sure the given arguments are valid first.
         RollCommand.from_args(args)
 
-        connection = self.connect()
-        cursor = connection.cursor()
-        cursor.execute(
-            self.sql["save"], {"name": name, "args": " ".join(args), "user": user}
-        )
-        connection.commit()
+        if self.write_delay is not None:
+            with self._write_lock:
+                self._pending[(user, name)] = " ".join(args)
+                self._schedule_flush()
+            self._invalidate(name, user, " ".join(args))
+            return
+
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                self.sql["save"], {"name": name, "args": " ".join(args), "user": user}
+            )
+            connection.commit()
+        self._invalidate(name, user, " ".join(args))
 
+    @metrics.timed(
+        "foxrollbot_db_seconds", "Time taken by saved roll storage", method="get"
+    )
     def get(self, name, user):
         """
         Get a saved roll from the database.
@@ -93,17 +339,23 @@ class SavedRollManager:
         Returns:
             list: List of arguments of saved roll
         """
-        connection = self.connect()
-        cursor = connection.cursor()
-        cursor.execute(self.sql["get"], {"name": name, "user": user})
-        result = cursor.fetchone()
-        if result is not None:
-            return result[0].split()
+        arguments = self._MISSING
+        if self.write_delay is not None:
+            with self._write_lock:
+                arguments = self._queued(name, user)
+        if arguments is self._MISSING:
+            arguments = self._select(name, user)
+
+        if arguments is not None:
+            return arguments.split()
         else:
             raise DoesNotExistException(
                 "Could not find an applicable saved roll with that name."
             )
 
+    @metrics.timed(
+        "foxrollbot_db_seconds", "Time taken by saved roll storage", method="delete"
+    )
     def delete(self, name, user):
         """
         Delete a saved roll from the database.
@@ -112,11 +364,347 @@ class SavedRollManager:
             name (str): Name of saved roll
             user (int): User ID to delete roll from
         """
-        connection = self.connect()
-        cursor = connection.cursor()
-        cursor.execute(self.sql["delete"], {"name": name, "user": user})
-        if cursor.rowcount < 1:
-            raise DoesNotExistException(
-                "Could not find an applicable saved roll with that name."
+        if self.write_delay is not None:
+            with self._write_lock:
+                arguments = self._queued(name, user)
+                if arguments is self._MISSING:
+                    arguments = self._select(name, user)
+                if arguments is None:
+                    raise DoesNotExistException(
+                        "Could not find an applicable saved roll with that name."
+                    )
+                self._pending[(user, name)] = None
+                self._schedule_flush()
+            self._invalidate(name, user)
+            return
+
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(self.sql["delete"], {"name": name, "user": user})
+            if cursor.rowcount < 1:
+                raise DoesNotExistException(
+                    "Could not find an applicable saved roll with that name."
+                )
+            connection.commit()
+        self._invalidate(name, user)
+
+    @metrics.timed(
+        "foxrollbot_db_seconds", "Time taken by saved roll storage", method="list"
+    )
+    def list_rolls(self, user, prefix=""):
+        """
+        Get a user's saved rolls, or those whose names start with a prefix.
+
+        Each user's saved rolls are cached as a sorted list, which saves and
+        deletes keep up to date, so finding those with a prefix is a binary
+        search.
+
+        Args:
+            user (int): User ID to get rolls of
+            prefix (str): Start of the names of rolls to get
+
+        Returns:
+            list: (name, arguments) tuples, sorted by name
+        """
+        # Every name starting with prefix sorts between these.
+        start, end = (prefix,), (prefix + "\U0010ffff",)
+        if self.names is None:
+            return self._select_list(user, start[0], end[0])
+
+        entries = self.names.get(user)
+        if entries is None:
+            generation = self._generation
+            entries = self._load_list(user)
+            with self._generation_lock:
+                if generation == self._generation:
+                    self.names.put(user, entries)
+        with self._generation_lock:
+            return entries[bisect_left(entries, start) : bisect_left(entries, end)]
+
+    @metrics.timed(
+        "foxrollbot_db_seconds",
+        "Time taken by saved roll storage",
+        method="get_command",
+    )
+    def get_command(self, name, user):
+        """
+        Get a saved roll as a parsed command.
+
+        Commands are cached, so repeated lookups of the same roll don't touch
+        the database or parse its arguments again until it's saved or deleted.
+
+        Args:
+            name (str): Name of saved roll
+            user (int): User ID to get roll for
+
+        Returns:
+            RollCommand: Parsed saved roll
+        """
+        if self.cache is None:
+            return RollCommand.from_args(self.get(name, user))
+
+        key = (user, name)
+        command = self.cache.get(key)
+        if command is None:
+            generation = self._generation
+            command = RollCommand.from_args(self.get(name, user))
+            with self._generation_lock:
+                if generation == self._generation:
+                    self.cache.put(key, command)
+        return command
+
+    @metrics.timed(
+        "foxrollbot_db_seconds", "Time taken by saved roll storage", method="flush"
+    )
+    def flush(self):
+        """Write any queued saves and deletes in a single transaction."""
+        with self._flush_lock:
+            with self._write_lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                self._flushing, self._pending = self._pending, {}
+
+            if not self._flushing:
+                return
+
+            saves = []
+            deletes = []
+            for (user, name), arguments in self._flushing.items():
+                if arguments is None:
+                    deletes.append({"name": name, "user": user})
+                else:
+                    saves.append({"name": name, "args": arguments, "user": user})
+
+            try:
+                with self.pool.connection() as connection:
+                    connection.executemany(self.sql["delete"], deletes)
+                    connection.executemany(self.sql["save"], saves)
+                    connection.commit()
+            except Exception:
+                # Requeue anything that hasn't been overwritten since.
+                with self._write_lock:
+                    for key, arguments in self._flushing.items():
+                        self._pending.setdefault(key, arguments)
+                    self._schedule_flush()
+                raise
+            finally:
+                with self._write_lock:
+                    self._flushing = {}
+
+    def export_rolls(self, file):
+        """
+        Write every saved roll to a file as JSON Lines, oldest first.
+
+        Rows are streamed from the database, so the whole table is never in
+        memory at once.
+
+        Args:
+            file: Text file to write to
+
+        Returns:
+            int: Number of rolls written
+        """
+        self.flush()
+        count = 0
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.arraysize = self.TRANSFER_BATCH
+            cursor.execute(self.sql["select_all"])
+            for _, name, arguments, user in cursor:
+                record = {"user": user, "name": name, "arguments": arguments}
+                file.write(json.dumps(record) + "\n")
+                count += 1
+            cursor.close()
+        return count
+
+    def import_rolls(self, file, skip_invalid=False):
+        """
+        Save every roll in a file written by export_rolls.
+
+        Rolls are read and checked a batch at a time, and all of them are
+        saved in a single transaction, so either the whole file is imported
+        or none of it is. Imported rolls replace saved rolls of the same user
+        and name.
+
+        Args:
+            file: Text file to read from
+            skip_invalid (bool): Whether to skip rolls that aren't valid,
+                rather than importing nothing
+
+        Returns:
+            tuple: Number of rolls imported and number skipped
+
+        Raises:
+            InvalidSyntaxException: If a line isn't a valid saved roll, and
+                invalid rolls aren't skipped
+        """
+        self.flush()
+        imported = skipped = 0
+        with self.pool.connection() as connection:
+            batch = []
+            for number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    batch.append(self._import_row(line))
+                except (
+                    FoxRollBotException,
+                    ValueError,
+                    LookupError,
+                    TypeError,
+                    AttributeError,
+                ) as e:
+                    if not skip_invalid:
+                        raise InvalidSyntaxException(
+                            f"Line {number} isn't a valid saved roll: {e}"
+                        )
+                    skipped += 1
+                    continue
+
+                if len(batch) == self.TRANSFER_BATCH:
+                    connection.executemany(self.sql["save"], batch)
+                    imported += len(batch)
+                    batch = []
+            connection.executemany(self.sql["save"], batch)
+            imported += len(batch)
+            connection.commit()
+
+        with self._generation_lock:
+            self._generation += 1
+            if self.cache is not None:
+                self.cache.clear()
+            if self.names is not None:
+                self.names.clear()
+        return imported, skipped
+
+    @staticmethod
+    def _import_row(line):
+        """Check a line of an export, and get the parameters to save it."""
+        record = json.loads(line)
+        name, arguments, user = record["name"], record["arguments"], record["user"]
+        if not isinstance(name, str) or not name or not isinstance(user, int):
+            raise ValueError("bad name or user")
+        RollCommand.from_args(arguments.split())
+        return {"name": name, "args": arguments, "user": user}
+
+    def _schedule_flush(self):
+        """Start the flush timer if it isn't running. Needs _write_lock."""
+        if self._timer is None:
+            self._timer = threading.Timer(self.write_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _queued(self, name, user):
+        """
+        Get the arguments of a queued write: None for a delete, or _MISSING
+        if there isn't one. Needs _write_lock.
+        """
+        key = (user, name)
+        if key in self._pending:
+            return self._pending[key]
+        return self._flushing.get(key, self._MISSING)
+
+    def _select(self, name, user):
+        """Get the stored arguments of a saved roll, or None."""
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(self.sql["get"], {"name": name, "user": user})
+            result = cursor.fetchone()
+            cursor.close()
+        return None if result is None else result[0]
+
+    def _select_list(self, user, start, end):
+        """Get a user's stored rolls with names from start up to end."""
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(self.sql["list"], {"user": user, "start": start, "end": end})
+            rows = cursor.fetchall()
+            cursor.close()
+        return rows
+
+    def _load_list(self, user):
+        """Get every saved roll of a user, including queued writes."""
+        queued = {}
+        if self.write_delay is not None:
+            # Queued writes are read before the database, so that any flushed
+            # in the meantime are in the database when it's read.
+            with self._write_lock:
+                for (u, name), arguments in chain(
+                    self._flushing.items(), self._pending.items()
+                ):
+                    if u == user:
+                        queued[name] = arguments
+
+        rolls = dict(self._select_list(user, "", "\U0010ffff"))
+        rolls.update(queued)
+        return sorted((n, a) for n, a in rolls.items() if a is not None)
+
+    def _invalidate(self, name, user, arguments=None):
+        """
+        Drop a saved roll from the cache after it has changed, and update the
+        user's cached list.
+
+        Args:
+            name (str): Name of saved roll
+            user (int): User ID it belongs to
+            arguments (str): Arguments it was saved with, or None if it was
+                deleted
+        """
+        with self._generation_lock:
+            self._generation += 1
+            if self.cache is not None:
+                self.cache.discard((user, name))
+
+            entries = None if self.names is None else self.names.get(user)
+            if entries is not None:
+                i = bisect_left(entries, (name,))
+                exists = i < len(entries) and entries[i][0] == name
+                if arguments is None:
+                    if exists:
+                        del entries[i]
+                elif exists:
+                    entries[i] = (name, arguments)
+                else:
+                    entries.insert(i, (name, arguments))
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Export or import the saved rolls in FOXROLLBOT_DB."
+    )
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("path", help="JSON Lines file, or - for stdout or stdin")
+    parser.add_argument(
+        "--skip-invalid",
+        action="store_true",
+        help="Import the valid rolls of a file that has invalid ones",
+    )
+    args = parser.parse_args()
+    if "FOXROLLBOT_DB" not in os.environ:
+        parser.error("FOXROLLBOT_DB must be set to the database file")
+
+    srm = SavedRollManager(os.environ["FOXROLLBOT_DB"], durable=True)
+    try:
+        if args.action == "export":
+            if args.path == "-":
+                count = srm.export_rolls(sys.stdout)
+            else:
+                with open(args.path, "w") as f:
+                    count = srm.export_rolls(f)
+            print(f"Exported {count:,} saved rolls", file=sys.stderr)
+        else:
+            if args.path == "-":
+                imported, skipped = srm.import_rolls(sys.stdin, args.skip_invalid)
+            else:
+                with open(args.path) as f:
+                    imported, skipped = srm.import_rolls(f, args.skip_invalid)
+            print(
+                f"Imported {imported:,} saved rolls, skipped {skipped:,}",
+                file=sys.stderr,
             )
-        connection.commit()
+    finally:
+        srm.close()
@@ -3,7 +3,9 @@ class FoxRollBotException(Exception):
 
 
 class InvalidSyntaxException(FoxRollBotException):
-    pass
+    def __init__(self, *args, position=None):
+        super().__init__(*args)
+        self.position = position
 
 
 class NotANumberException(FoxRollBotException):
@@ -0,0 +1,348 @@
+"""
+History of the rolls users have made.
+
+Every roll's totals and dice are kept, so users can look back at what they
+rolled. Appends are buffered in memory and written in batches, one
+transaction at a time, so rolling never waits for the database. Totals and
+dice are stored as packed arrays of integers rather than text, and rolls are
+looked up by chat, by user or by user in a chat through indexes on (chat,
+time), (user, time) and (chat, user, time), a page at a time, starting after
+the last roll of the previous page.
+"""
+
+import sys
+import threading
+import time
+from array import array
+
+import bundle
+import metrics
+
+
+def pack(typecode, values):
+    """
+    Pack integers into a little-endian blob.
+
+    Args:
+        typecode (str): array typecode of the integers
+        values (iterable): Integers to pack
+
+    Returns:
+        bytes: Packed integers
+    """
+    packed = array(typecode, values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack(typecode, blob):
+    """
+    Unpack integers packed by pack.
+
+    Args:
+        typecode (str): array typecode of the integers
+        blob (bytes): Packed integers
+
+    Returns:
+        list: Integers
+    """
+    packed = array(typecode)
+    packed.frombytes(blob)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tolist()
+
+
+def flatten(results):
+    """
+    Get the totals and individual dice of a command's results.
+
+    Args:
+        results (list): RollResult or DiceResult instances
+
+    Returns:
+        tuple: List of totals, one per result, and list of every die rolled
+            that counted towards them, in order
+    """
+    totals = []
+    dice = []
+    for result in results:
+        totals.append(result.total)
+        # A bare DiceResult has its dice itself; a RollResult has them in
+        # each of its DiceResults.
+        for dice_result in getattr(result, "rolls", (result,)):
+            dice += dice_result.results
+    return totals, dice
+
+
+class Entry:
+    """
+    A roll in a user's history.
+
+    Attributes:
+        id (int): ID of entry, which pages of older entries start after
+        time (int): When the roll was made, in seconds since the epoch
+        chat (int): ID of chat it was made in, if it was looked up by user
+        user (int): ID of user who made it, if it was looked up by chat
+        expression (str): Arguments of the roll command
+        totals (list): Totals of each roll
+        dice (list): Every die rolled
+    """
+
+    __slots__ = ("id", "time", "chat", "user", "expression", "totals", "dice")
+
+    def __init__(self, id, time, chat, user, expression, totals, dice):
+        self.id = id
+        self.time = time
+        self.chat = chat
+        self.user = user
+        self.expression = expression
+        self.totals = totals
+        self.dice = dice
+
+
+class RollHistory:
+    """
+    Store of every roll made, by chat and by user.
+
+    Attributes:
+        pool (ConnectionPool): Pool of connections to the database
+        retention (float): Seconds rolls are kept for
+    """
+
+    TABLE = "roll_history"
+    """str: Name of table in which to store rolls"""
+
+    FLUSH_DELAY = 1.0
+    """float: Seconds appended rolls wait for more before they're written"""
+
+    BATCH_SIZE = 500
+    """int: Number of waiting rolls that are written without further delay"""
+
+    RETENTION = 90 * 24 * 60 * 60
+    """float: Seconds rolls are kept for"""
+
+    PRUNE_INTERVAL = 60 * 60
+    """float: Seconds between deletions of expired rolls"""
+
+    PAGE_SIZE = 10
+    """int: Number of rolls in a page"""
+
+    TOTALS_TYPE = "i"
+    """str: array typecode totals are packed as"""
+
+    DICE_TYPE = "h"
+    """str: array typecode dice are packed as, big enough for Dice.MAX_SIDES"""
+
+    _NEWEST = 2**62
+
+    def __init__(
+        self,
+        pool,
+        flush_delay=FLUSH_DELAY,
+        batch_size=BATCH_SIZE,
+        retention=RETENTION,
+    ):
+        """
+        Create a RollHistory instance, and its table if it doesn't exist.
+
+        Args:
+            pool (ConnectionPool): Pool of connections to the database
+            flush_delay (float): Seconds appended rolls wait for more before
+                they're written
+            batch_size (int): Number of waiting rolls that are written without
+                further delay
+            retention (float): Seconds rolls are kept for, or None to keep
+                them forever
+        """
+        self.pool = pool
+        self.retention = retention
+        self.sql = bundle.sql(self.TABLE)
+
+        self._flush_delay = flush_delay
+        self._batch_size = batch_size
+        self._pending = []
+        self._timer = None
+        self._last_prune = 0.0
+        self._write_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        with self.pool.connection() as connection:
+            connection.execute(self.sql["history/create_table"])
+            connection.executescript(self.sql["history/create_indexes"])
+
+    def append(self, chat, user, expression, results):
+        """
+        Add a roll to the history. It's written later, in a batch.
+
+        Args:
+            chat (int): ID of chat it was made in
+            user (int): ID of user who made it
+            expression (str): Arguments of the roll command
+            results (list): RollResult or DiceResult instances
+        """
+        totals, dice = flatten(results)
+        row = {
+            "time": int(time.time()),
+            "chat": chat,
+            "user": user,
+            "expression": expression,
+            "totals": pack(self.TOTALS_TYPE, totals),
+            "dice": pack(self.DICE_TYPE, dice),
+        }
+        with self._write_lock:
+            self._pending.append(row)
+            if len(self._pending) >= self._batch_size:
+                self._schedule_flush(0)
+            else:
+                self._schedule_flush(self._flush_delay)
+
+    @metrics.timed(
+        "foxrollbot_db_seconds",
+        "Time taken by saved roll storage",
+        method="history_flush",
+    )
+    def flush(self):
+        """Write waiting rolls in a single transaction."""
+        with self._flush_lock:
+            with self._write_lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                rows, self._pending = self._pending, []
+
+            if rows:
+                try:
+                    with self.pool.connection() as connection:
+                        connection.executemany(self.sql["history/append"], rows)
+                        connection.commit()
+                except Exception:
+                    with self._write_lock:
+                        self._pending[:0] = rows
+                        self._schedule_flush(self._flush_delay)
+                    raise
+
+            if (
+                self.retention is not None
+                and time.monotonic() - self._last_prune >= self.PRUNE_INTERVAL
+            ):
+                self._last_prune = time.monotonic()
+                self.prune(time.time() - self.retention)
+
+    def _schedule_flush(self, delay):
+        """Start the flush timer if it isn't running. Needs _write_lock."""
+        if self._timer is not None and delay:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def close(self):
+        """Write any waiting rolls."""
+        self.flush()
+
+    def prune(self, before):
+        """
+        Delete rolls made before a time.
+
+        Rolls are deleted in the order they were added, up to the first one
+        that's still new enough, so only expired rows are read.
+
+        Args:
+            before (float): Time in seconds since the epoch
+
+        Returns:
+            int: Number of rolls deleted
+        """
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(self.sql["history/prune_boundary"], {"time": before})
+            boundary = cursor.fetchone()
+            if boundary is None:
+                cursor.execute(self.sql["history/max_id"])
+                boundary = cursor.fetchone()
+            cursor.execute(self.sql["history/prune"], {"id": boundary[0]})
+            deleted = cursor.rowcount
+            connection.commit()
+            cursor.close()
+        return deleted
+
+    def by_user(self, user, after=None, limit=PAGE_SIZE, chat=None):
+        """
+        Get a page of a user's rolls, newest first.
+
+        Args:
+            user (int): ID of user
+            after (int): ID of the last entry of the previous page, or None
+                for the newest rolls
+            limit (int): Number of rolls to get
+            chat (int): ID of chat to get only the rolls made in, or None for
+                rolls made anywhere
+
+        Returns:
+            list: Entry instances, with chat set and user None
+        """
+        if chat is None:
+            statement, parameters = "history/user_page", {"user": user}
+        else:
+            statement = "history/user_chat_page"
+            parameters = {"user": user, "chat": chat}
+        rows = self._page(statement, parameters, after, limit)
+        return [
+            Entry(id, time, chat, None, expression, totals, dice)
+            for id, time, chat, expression, totals, dice in rows
+        ]
+
+    def by_chat(self, chat, after=None, limit=PAGE_SIZE):
+        """
+        Get a page of the rolls made in a chat, newest first.
+
+        Args:
+            chat (int): ID of chat
+            after (int): ID of the last entry of the previous page, or None
+                for the newest rolls
+            limit (int): Number of rolls to get
+
+        Returns:
+            list: Entry instances, with user set and chat None
+        """
+        rows = self._page("history/chat_page", {"chat": chat}, after, limit)
+        return [
+            Entry(id, time, None, user, expression, totals, dice)
+            for id, time, user, expression, totals, dice in rows
+        ]
+
+    def _page(self, statement, parameters, after, limit):
+        # Rolls still waiting to be written would be missing otherwise.
+        self.flush()
+
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            start = (self._NEWEST, self._NEWEST)
+            if after is not None:
+                cursor.execute(self.sql["history/cursor"], {"id": after})
+                start = cursor.fetchone()
+                if start is None:
+                    # The previous page has been pruned since, so this one
+                    # has been too.
+                    cursor.close()
+                    return []
+            parameters = dict(parameters, time=start[0], id=start[1], limit=limit)
+            cursor.execute(self.sql[statement], parameters)
+            rows = cursor.fetchall()
+            cursor.close()
+
+        return [
+            (
+                id,
+                time,
+                owner,
+                expression,
+                unpack(self.TOTALS_TYPE, totals),
+                unpack(self.DICE_TYPE, dice),
+            )
+            for id, time, owner, expression, totals, dice in rows
+        ]
@@ -0,0 +1,213 @@
+"""
+Rolling in inline mode.
+
+Inline queries are sent on every keystroke, so most of them are unfinished
+expressions. InlineRoller answers those straight away with the last complete
+roll the user typed, without trying to parse them, and keeps each user's
+recently parsed queries so going back and forth over an expression doesn't
+parse it again. Answers are rolled fresh every time; only the parsing is
+cached. Parsing, rolling and formatting all count against a time budget, and
+rolls too long for a message aren't offered. A query that starts with a letter is taken as the start of the names
+of the user's saved rolls, and each of those is offered.
+"""
+
+import re
+import time
+import uuid
+
+from cache import LRUCache
+from metrics import LatencyHistogram
+from roll import Roll, RollCommand
+from errors import *
+
+# Prefixes of roll expressions, such as "2", "1d20+" or "2d{1,". Anything
+# matching this that isn't a complete roll with dice in it is still being
+# typed.
+PARTIAL_TERM = r"\d+(d(\d*|[Ff]|\{[-\d,]*\}?))?"
+PARTIAL_SYNTAX = re.compile(rf"{PARTIAL_TERM}([+-]({PARTIAL_TERM})?)*")
+
+
+def is_partial(args):
+    """
+    Check whether a query looks like a roll that's still being typed.
+
+    Args:
+        args (list): Words of the query
+
+    Returns:
+        bool: True if the last word is an unfinished roll expression or
+            repeat count
+    """
+    last = args[-1]
+    if last == "x":
+        return True
+    if not PARTIAL_SYNTAX.fullmatch(last):
+        return False
+    return "d" not in last or not Roll.SYNTAX.fullmatch(last)
+
+
+class InlineRoller:
+    """
+    Answers inline queries with rolls.
+
+    Attributes:
+        latency (LatencyHistogram): Time taken to answer each query
+        partial (int): Number of queries short-circuited as unfinished
+        over_budget (int): Number of queries that ran out of time
+        too_long (int): Number of rolls not offered as they wouldn't fit in
+            a message
+    """
+
+    USERS = 10_000
+    """int: Number of users whose queries are kept"""
+
+    QUERIES = 16
+    """int: Number of parsed queries kept per user"""
+
+    BUDGET = 0.05
+    """float: Seconds an answer should take at most"""
+
+    DEFAULT_QUERY = "1d20"
+    """str: Roll offered for an empty query"""
+
+    SAVED_ROLLS = 10
+    """int: Most saved rolls offered for a query"""
+
+    MAX_LENGTH = 4096
+    """int: Longest message text Telegram accepts"""
+
+    def __init__(self, users=USERS, queries=QUERIES, budget=BUDGET):
+        """
+        Create an InlineRoller instance.
+
+        Args:
+            users (int): Number of users whose queries are kept
+            queries (int): Number of parsed queries kept per user
+            budget (float): Seconds an answer should take at most. If
+                parsing, rolling and formatting a query use it up, the user's
+                last roll is offered instead of the new one.
+        """
+        self.latency = LatencyHistogram()
+        self.partial = 0
+        self.over_budget = 0
+        self.too_long = 0
+
+        self._budget = budget
+        self._queries = queries
+        # Per user, an LRUCache of parsed commands keyed by query, then the
+        # last query that was answered and its command.
+        self._users = LRUCache(users)
+
+    def answer(self, user, query, srm=None):
+        """
+        Answer an inline query.
+
+        Args:
+            user (int): ID of user who sent the query
+            query (str): Text of the query
+            srm (SavedRollManager): Manager of the user's saved rolls, if
+                they're offered
+
+        Returns:
+            dict: Keyword arguments for answerInlineQuery, besides the query
+                ID. Results are dicts in the Bot API's JSON form.
+        """
+        start = time.perf_counter()
+        try:
+            return self._answer(user, query, srm, start)
+        finally:
+            self.latency.observe(time.perf_counter() - start)
+
+    def _answer(self, user, query, srm, start):
+        state = self._users.get(user)
+        if state is None:
+            state = [LRUCache(self._queries), None, None]
+            self._users.put(user, state)
+        parsed = state[0]
+
+        query = " ".join(query.split()) or self.DEFAULT_QUERY
+        if srm is not None and query[0].isalpha() and " " not in query:
+            return self._saved(user, query, srm)
+        command = parsed.get(query)
+        if command is None:
+            args = query.split()
+            if is_partial(args):
+                self.partial += 1
+                return self._reply(state[1], state[2])
+            try:
+                command = RollCommand.from_args(args)
+            except FoxRollBotException:
+                return self._reply(None, None)
+            parsed.put(query, command)
+
+        if time.perf_counter() - start > self._budget:
+            self.over_budget += 1
+            return self._reply(state[1], state[2])
+        if self._min_length(command) > self.MAX_LENGTH:
+            self.too_long += 1
+            return self._reply(None, None)
+
+        reply = self._reply(query, command)
+        if time.perf_counter() - start > self._budget:
+            # Don't offer it again as the last roll.
+            self.over_budget += 1
+            return self._reply(state[1], state[2])
+        if not reply["results"]:
+            self.too_long += 1
+            return reply
+
+        state[1:] = query, command
+        return reply
+
+    @staticmethod
+    def _min_length(command):
+        """
+        Get a lower bound on the length of a command's result, without
+        rolling it. Each die of a group is shown with a separator.
+        """
+        return sum(
+            2 * dice.quantity
+            for roll in command.rolls
+            for dice in roll.rolls
+            if dice.quantity > 1
+        )
+
+    def _saved(self, user, prefix, srm):
+        results = []
+        for name, arguments in srm.list_rolls(user, prefix)[: self.SAVED_ROLLS]:
+            try:
+                command = srm.get_command(name, user)
+            except FoxRollBotException:
+                # Deleted since it was listed.
+                continue
+            result = self._result(name, command, arguments)
+            if result is not None:
+                results.append(result)
+        return {"results": results, "cache_time": 0, "is_personal": True}
+
+    @classmethod
+    def _result(cls, query, command, description="Tap to roll and send the result."):
+        """Roll a command into a result, or None if it's too long to send."""
+        text = f"`{query}`\n{command}"
+        if len(text) > cls.MAX_LENGTH:
+            return None
+        return {
+            "type": "article",
+            "id": uuid.uuid4().hex,
+            "title": f"Roll {query}",
+            "description": description,
+            "input_message_content": {
+                "message_text": text,
+                "parse_mode": "Markdown",
+            },
+        }
+
+    def _reply(self, query, command):
+        results = []
+        if command is not None:
+            result = self._result(query, command)
+            if result is not None:
+                results.append(result)
+        # Results are rolled fresh for every query, so Telegram mustn't cache
+        # them or share them between users.
+        return {"results": results, "cache_time": 0, "is_personal": True}
@@ -0,0 +1,356 @@
+"""
+Running statistics of the dice each user rolls in each chat.
+
+Every die rolled is counted as it's rolled, by chat, user and number of sides,
+so how lucky someone has been never needs their whole history to be read. The
+counts since the last checkpoint are kept in memory and added to the
+database's every so often, in one transaction, which also works when several
+processes share the database.
+"""
+
+import math
+import threading
+
+import bundle
+import metrics
+from history import pack, unpack
+from roll import Dice
+
+FATE = 0
+"""int: Die size Fate dice are counted under, as they have faces -1 to 1"""
+
+
+def lowest(die):
+    """Get the lowest face of a die with a number of sides, or of Fate dice."""
+    return -1 if die == FATE else 1
+
+
+class Tally:
+    """
+    Counts of the rolls of one die.
+
+    Attributes:
+        die (int): Number of sides, or FATE
+        count (int): Number of times it was rolled
+        total (int): Sum of the faces rolled
+        squares (int): Sum of the squares of the faces rolled
+        faces (list): Number of times each face was rolled, lowest first
+    """
+
+    __slots__ = ("die", "count", "total", "squares", "faces")
+
+    FACES_TYPE = "I"
+    """str: array typecode face counts are packed as"""
+
+    def __init__(self, die, count=0, total=0, squares=0, faces=None):
+        self.die = die
+        self.count = count
+        self.total = total
+        self.squares = squares
+        self.faces = faces or [0] * (3 if die == FATE else die)
+
+    @classmethod
+    def from_row(cls, die, count, total, squares, faces):
+        """Create a Tally from a row of the luck table."""
+        return cls(die, count, total, squares, unpack(cls.FACES_TYPE, faces))
+
+    def add(self, values):
+        """
+        Count some rolls.
+
+        Args:
+            values (iterable): Faces rolled
+        """
+        offset = lowest(self.die)
+        faces = self.faces
+        for value in values:
+            faces[value - offset] += 1
+            self.count += 1
+            self.total += value
+            self.squares += value * value
+
+    def merge(self, other):
+        """Add the counts of another Tally of the same die to this one."""
+        self.count += other.count
+        self.total += other.total
+        self.squares += other.squares
+        self.faces = [a + b for a, b in zip(self.faces, other.faces)]
+
+    def copy(self):
+        """Get a Tally with the same counts, which can change separately."""
+        return Tally(self.die, self.count, self.total, self.squares, list(self.faces))
+
+    def row(self):
+        """Get the columns of this Tally in the luck table, besides its key."""
+        return {
+            "die": self.die,
+            "count": self.count,
+            "total": self.total,
+            "squares": self.squares,
+            "faces": pack(self.FACES_TYPE, self.faces),
+        }
+
+    @property
+    def lows(self):
+        """int: Number of times the lowest face was rolled"""
+        return self.faces[0]
+
+    @property
+    def highs(self):
+        """int: Number of times the highest face was rolled"""
+        return self.faces[-1]
+
+    @property
+    def mean(self):
+        """float: Average face rolled"""
+        return self.total / self.count
+
+    @property
+    def expected(self):
+        """float: Average face of a fair die"""
+        return (len(self.faces) - 1) / 2 + lowest(self.die)
+
+    @property
+    def std(self):
+        """float: Standard deviation of the faces rolled"""
+        variance = self.squares / self.count - self.mean**2
+        return math.sqrt(max(variance, 0.0))
+
+    @property
+    def luck(self):
+        """
+        float: How far the average face rolled is above what a fair die would
+            give, in standard errors
+        """
+        faces = len(self.faces)
+        variance = (faces * faces - 1) / 12
+        return (self.total - self.count * self.expected) / math.sqrt(
+            self.count * variance
+        )
+
+
+class LuckTracker:
+    """
+    Tallies of every die rolled, by chat, user and number of sides.
+
+    Attributes:
+        pool (ConnectionPool): Pool of connections to the database
+    """
+
+    TABLE = "luck"
+    """str: Name of table in which to store tallies"""
+
+    CHECKPOINT_INTERVAL = 60.0
+    """float: Seconds counts are kept in memory before they're checkpointed"""
+
+    def __init__(self, pool, checkpoint_interval=CHECKPOINT_INTERVAL):
+        """
+        Create a LuckTracker instance, and its table if it doesn't exist.
+
+        Args:
+            pool (ConnectionPool): Pool of connections to the database
+            checkpoint_interval (float): Seconds counts are kept in memory
+                before they're added to the database's
+        """
+        self.pool = pool
+        self.sql = bundle.sql(self.TABLE)
+
+        self._checkpoint_interval = checkpoint_interval
+        # Counts since the last checkpoint, keyed by (chat, user, die).
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        # Held while checkpointing, and while reading, so that counts being
+        # checkpointed aren't missed or read twice.
+        self._checkpoint_lock = threading.Lock()
+
+        with self.pool.connection() as connection:
+            connection.execute(self.sql["luck/create_table"])
+
+    def record(self, chat, user, die, values):
+        """
+        Count rolls of a die.
+
+        Args:
+            chat (int): ID of chat they were rolled in
+            user (int): ID of user who rolled them
+            die (int): Number of sides, or FATE
+            values (iterable): Faces rolled
+        """
+        key = (chat, user, die)
+        with self._lock:
+            tally = self._pending.get(key)
+            if tally is None:
+                tally = self._pending[key] = Tally(die)
+            tally.add(values)
+            if self._timer is None:
+                self._timer = threading.Timer(
+                    self._checkpoint_interval, self.checkpoint
+                )
+                self._timer.daemon = True
+                self._timer.start()
+
+    def record_results(self, chat, user, results):
+        """
+        Count the dice of a roll command's results.
+
+        Dice rolled with advantage or disadvantage aren't counted, since
+        only the better or worse of their attempts is kept. Neither are
+        custom dice, other than Fate dice.
+
+        Args:
+            chat (int): ID of chat they were rolled in
+            user (int): ID of user who rolled them
+            results (list): RollResult or DiceResult instances
+        """
+        for result in results:
+            if getattr(result, "losing", None) is not None:
+                continue
+            for dice_result in getattr(result, "rolls", (result,)):
+                dice = dice_result.dice
+                if dice.faces is None:
+                    self.record(chat, user, dice.die, dice_result.results)
+                elif dice.faces == Dice.FATE:
+                    self.record(chat, user, FATE, dice_result.results)
+
+    @metrics.timed(
+        "foxrollbot_db_seconds",
+        "Time taken by saved roll storage",
+        method="luck_checkpoint",
+    )
+    def checkpoint(self):
+        """Add the counts kept in memory to the database's."""
+        with self._checkpoint_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                tallies, self._pending = self._pending, {}
+
+            if not tallies:
+                return
+
+            try:
+                with self.pool.connection() as connection:
+                    # Taking the write lock up front stops other processes
+                    # adding their counts between the reads and the writes.
+                    connection.execute("BEGIN IMMEDIATE")
+                    rows = []
+                    for (chat, user, die), tally in tallies.items():
+                        stored = self._select(connection, chat, user, die)
+                        if stored is not None:
+                            stored.merge(tally)
+                            tally = stored
+                        rows.append(dict(tally.row(), chat=chat, user=user))
+                    connection.executemany(self.sql["luck/save"], rows)
+                    connection.commit()
+            except Exception:
+                with self._lock:
+                    for key, tally in self._pending.items():
+                        if key in tallies:
+                            tallies[key].merge(tally)
+                        else:
+                            tallies[key] = tally
+                    self._pending = tallies
+                raise
+
+    def close(self):
+        """Checkpoint any counts kept in memory."""
+        self.checkpoint()
+
+    def _select(self, connection, chat, user, die):
+        cursor = connection.execute(
+            self.sql["luck/get"], {"chat": chat, "user": user, "die": die}
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        return None if row is None else Tally.from_row(die, *row)
+
+    def _add_pending(self, tallies, name):
+        """
+        Add the counts that haven't been checkpointed to stored tallies.
+        Needs _checkpoint_lock.
+
+        Args:
+            tallies (dict): Stored tallies
+            name (callable): Function giving the key in tallies of a
+                (chat, user, die) key, or None for counts that don't belong
+        """
+        with self._lock:
+            for key, pending in self._pending.items():
+                key = name(key)
+                if key is None:
+                    continue
+                tally = tallies.get(key)
+                if tally is None:
+                    tallies[key] = pending.copy()
+                else:
+                    tally.merge(pending)
+        return tallies
+
+    def get(self, chat, user, die):
+        """
+        Get the tally of a user's rolls of a die in a chat.
+
+        Args:
+            chat (int): ID of chat
+            user (int): ID of user
+            die (int): Number of sides, or FATE
+
+        Returns:
+            Tally: Counts of the rolls, or None if there haven't been any
+        """
+        with self._checkpoint_lock:
+            with self.pool.connection() as connection:
+                tally = self._select(connection, chat, user, die)
+            with self._lock:
+                pending = self._pending.get((chat, user, die))
+                if pending is None:
+                    return tally
+                if tally is None:
+                    return pending.copy()
+                tally.merge(pending)
+                return tally
+
+    def by_user(self, chat, user):
+        """
+        Get the tallies of every die a user has rolled in a chat.
+
+        Args:
+            chat (int): ID of chat
+            user (int): ID of user
+
+        Returns:
+            dict: Tally of each die, keyed by number of sides
+        """
+        with self._checkpoint_lock:
+            with self.pool.connection() as connection:
+                rows = connection.execute(
+                    self.sql["luck/user"], {"chat": chat, "user": user}
+                ).fetchall()
+            tallies = {row[0]: Tally.from_row(*row) for row in rows}
+            return self._add_pending(
+                tallies, lambda key: key[2] if key[:2] == (chat, user) else None
+            )
+
+    def by_chat(self, chat, die):
+        """
+        Get the tallies of everyone who has rolled a die in a chat.
+
+        Args:
+            chat (int): ID of chat
+            die (int): Number of sides, or FATE
+
+        Returns:
+            dict: Tally of each user, keyed by user ID
+        """
+        with self._checkpoint_lock:
+            with self.pool.connection() as connection:
+                rows = connection.execute(
+                    self.sql["luck/chat"], {"chat": chat, "die": die}
+                ).fetchall()
+            tallies = {user: Tally.from_row(die, *row) for user, *row in rows}
+            return self._add_pending(
+                tallies,
+                lambda key: key[1] if key[0] == chat and key[2] == die else None,
+            )
@@ -1,15 +1,28 @@
+import argparse
 import logging
 import os
-from random import randint
-
-from telegram.ext import CommandHandler, MessageHandler
+import re
+import signal
+import threading
+import time
+
+from telegram import Bot, InlineQueryResultArticle, InputTextMessageContent, Update
+from telegram.error import NetworkError
+from telegram.ext import (
+    CommandHandler,
+    Dispatcher,
+    InlineQueryHandler,
+    MessageHandler,
+)
 from telegram.ext.updater import Updater
 
-from db import SavedRollManager
-from roll import RollCommand, Dice
-from text import Text
-from errors import *
-
+import metrics
+from commands import *
+from inline import InlineRoller
+from outbox import Outbox
+from profiling import profiler
+from shard import ShardSupervisor, run_shard
+from webhook import WebhookServer
 
 logging.basicConfig(
     level=logging.INFO,  # filename='log.txt',
@@ -17,130 +30,365 @@ logging.basicConfig(
 )
 
 
-text = Text("./text")
+srm = open_saved_roll_manager()
 
-# Just going to use the default in-memory database for now.
-srm = SavedRollManager()
+# Replies are sent through this, once the bot's been created.
+outbox = None
+
+inline_roller = InlineRoller()
+metrics.registry.register(
+    "foxrollbot_inline_seconds",
+    "Time taken to answer inline queries",
+    inline_roller.latency,
+)
+
+
+def asker(update):
+    """Name who sent an update's message, for replies joined in the outbox."""
+    return mention(update.message.from_user)
 
 
 def start_cmd(update, ctx):
-    ctx.bot.send_message(chat_id=update.message.chat_id, text=text.start)
+    outbox.put(start_reply(update.message, ctx.args, srm), asker(update))
 
 
 def about_cmd(update, ctx):
-    ctx.bot.send_message(
-        chat_id=update.message.chat_id, parse_mode="Markdown", text=text.about
-    )
+    outbox.put(about_reply(update.message, ctx.args, srm), asker(update))
 
 
 def help_cmd(update, ctx):
-    ctx.bot.send_message(
-        chat_id=update.message.chat_id, parse_mode="Markdown", text=text.help
-    )
+    outbox.put(help_reply(update.message, ctx.args, srm), asker(update))
 
 
 def roll_cmd(update, ctx):
-    msg_args = {
-        "chat_id": update.message.chat_id,
-        "reply_to_message_id": update.message.message_id,
-        "parse_mode": "Markdown",
-    }
+    outbox.put(roll_reply(update.message, ctx.args, srm), asker(update))
 
-    try:
-        if len(ctx.args) < 1:
-            msg_args["text"] = str(Dice(1, 20).roll())
-        elif ctx.args[0][0].isalpha():
-            saved_args = srm.get(ctx.args[0], update.message.from_user.id)
-            msg_args["text"] = str(RollCommand.from_args(saved_args))
-        else:
-            msg_args["text"] = str(RollCommand.from_args(ctx.args))
-    except InvalidSyntaxException:
-        msg_args["text"] = f"Syntax: {text.roll_syntax}"
-    except FoxRollBotException as e:
-        msg_args["text"] = str(e)
 
-    ctx.bot.send_message(**msg_args)
+def stats_cmd(update, ctx):
+    outbox.put(stats_reply(update.message, ctx.args, srm), asker(update))
 
 
 def save_cmd(update, ctx):
-    msg_args = {
-        "chat_id": update.message.chat_id,
-        "reply_to_message_id": update.message.message_id,
-        "parse_mode": "Markdown",
-    }
+    outbox.put(save_reply(update.message, ctx.args, srm), asker(update))
 
-    try:
-        srm.save(ctx.args[0], ctx.args[1:], update.message.from_user.id)
-        msg_args["text"] = f"Roll successfully saved as `{ctx.args[0]}`!"
-    except InvalidSyntaxException:
-        msg_args["text"] = f"Syntax: {text.save_syntax}"
-    except FoxRollBotException as e:
-        msg_args["text"] = str(e)
 
-    ctx.bot.send_message(**msg_args)
+def delete_cmd(update, ctx):
+    outbox.put(delete_reply(update.message, ctx.args, srm), asker(update))
 
 
-def delete_cmd(update, ctx):
-    msg_args = {
-        "chat_id": update.message.chat_id,
-        "reply_to_message_id": update.message.message_id,
-        "parse_mode": "Markdown",
-    }
+def list_cmd(update, ctx):
+    outbox.put(list_reply(update.message, ctx.args, srm), asker(update))
 
-    try:
-        srm.delete(ctx.args[0], update.message.from_user.id)
-        msg_args["text"] = f"Successfully deleted `{ctx.args[0]}`."
-    except FoxRollBotException as e:
-        msg_args["text"] = str(e)
 
-    ctx.bot.send_message(**msg_args)
+def history_cmd(update, ctx):
+    outbox.put(history_reply(update.message, ctx.args, srm), asker(update))
 
 
-def fate_val_to_string(value):
-    if value > 0:
-        return "+"
-    elif value < 0:
-        return "-"
-    return "/"
+def luck_cmd(update, ctx):
+    outbox.put(luck_reply(update.message, ctx.args, srm), asker(update))
 
 
 def fate_cmd(update, ctx):
-    msg_args = {
-        "chat_id": update.message.chat_id,
-        "reply_to_message_id": update.message.message_id,
-    }
+    outbox.put(fate_reply(update.message, ctx.args, srm), asker(update))
 
-    rolls = [randint(-1, 1) for _ in range(4)]
 
-    msg_args[
-        "text"
-    ] = f"Fate: {sum(rolls)} [{''.join(fate_val_to_string(r) for r in rolls)}]"
+def botstats_cmd(update, ctx):
+    outbox.put(botstats_reply(update.message, ctx.args, srm), asker(update))
 
-    ctx.bot.send_message(**msg_args)
 
+def profile_cmd(update, ctx):
+    outbox.put(profile_reply(update.message, ctx.args, srm), asker(update))
 
-def error_callback(update, ctx):
-    logging.error(ctx.error)
 
+def inline_cmd(update, ctx):
+    query = update.inline_query
+    answer = inline_roller.answer(query.from_user.id, query.query, srm)
+    answer["results"] = [
+        InlineQueryResultArticle(
+            id=result["id"],
+            title=result["title"],
+            description=result["description"],
+            input_message_content=InputTextMessageContent(
+                result["input_message_content"]["message_text"],
+                parse_mode=result["input_message_content"]["parse_mode"],
+            ),
+        )
+        for result in answer["results"]
+    ]
+    query.answer(**answer)
 
-if __name__ == "__main__":
-    with open("token.txt") as token_file:
-        token = token_file.read().strip()
 
-    updater = Updater(token)
-    dispatcher = updater.dispatcher
+def error_callback(update, ctx):
+    logging.error(ctx.error)
+
 
+def add_handlers(dispatcher):
     dispatcher.add_handler(CommandHandler("start", start_cmd))
     dispatcher.add_handler(CommandHandler("about", about_cmd))
     dispatcher.add_handler(CommandHandler("help", help_cmd))
     dispatcher.add_handler(CommandHandler(["roll", "r"], roll_cmd, pass_args=True))
+    dispatcher.add_handler(CommandHandler("stats", stats_cmd, pass_args=True))
     dispatcher.add_handler(CommandHandler("save", save_cmd, pass_args=True))
     dispatcher.add_handler(CommandHandler("delete", delete_cmd, pass_args=True))
+    dispatcher.add_handler(CommandHandler("list", list_cmd, pass_args=True))
+    dispatcher.add_handler(CommandHandler("history", history_cmd, pass_args=True))
+    dispatcher.add_handler(CommandHandler("luck", luck_cmd, pass_args=True))
     dispatcher.add_handler(
         CommandHandler(["fudge", "fate", "f", "rf"], fate_cmd, pass_args=True)
     )
+    dispatcher.add_handler(CommandHandler("botstats", botstats_cmd))
+    dispatcher.add_handler(CommandHandler("profile", profile_cmd, pass_args=True))
+    dispatcher.add_handler(InlineQueryHandler(inline_cmd))
 
     dispatcher.add_error_handler(error_callback)
 
+
+def process_with(dispatcher):
+    """Make a function that handles update JSON with a dispatcher."""
+
+    def process(data):
+        dispatcher.process_update(Update.de_json(data, dispatcher.bot))
+
+    return process
+
+
+def register_latencies(name, help, latency, label):
+    for stage, histogram in latency.items():
+        metrics.registry.register(name, help, histogram, **{label: stage})
+
+
+def start_outbox(bot, metrics_interval):
+    global outbox
+    outbox = Outbox(bot.send_message, retry_on=(NetworkError,))
+    outbox.start()
+
+    register_latencies(
+        "foxrollbot_outbox_seconds",
+        "Time replies spend waiting to be sent and being sent",
+        outbox.latency,
+        "stage",
+    )
+    metrics.registry.register(
+        "foxrollbot_outbox_depth",
+        "Replies waiting to be sent",
+        metrics.Gauge(lambda: outbox.depth),
+    )
+    threading.Thread(
+        target=log_outbox_metrics, args=(metrics_interval,), daemon=True
+    ).start()
+
+
+def log_outbox_metrics(interval):
+    while True:
+        time.sleep(interval)
+        logging.info("Outbox: %s", outbox.summary())
+
+
+def run_webhook(bot, handle, args):
+    server = WebhookServer(
+        handle,
+        address=(args.host, args.port),
+        path=args.path,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        shed=args.shed,
+        secret_token=args.secret_token,
+    )
+    register_latencies(
+        "foxrollbot_webhook_seconds",
+        "Time taken by each stage of handling webhook updates",
+        server.latency,
+        "stage",
+    )
+    metrics.registry.register(
+        "foxrollbot_webhook_depth",
+        "Webhook updates waiting to be handled",
+        metrics.Gauge(lambda: server.depth),
+    )
+
+    def log_metrics():
+        while not stopped.wait(args.metrics_interval):
+            logging.info("Webhook: %s", server.summary())
+
+    stopped = threading.Event()
+    threading.Thread(target=log_metrics, daemon=True).start()
+
+    bot.set_webhook(args.webhook, secret_token=args.secret_token)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        server.stop()
+        logging.info("Webhook: %s", server.summary())
+
+
+def run_polling(bot, handle):
+    bot.delete_webhook()
+    offset = None
+    try:
+        while True:
+            try:
+                updates = bot.get_updates(offset=offset, timeout=30)
+            except NetworkError as e:
+                logging.error(e)
+                time.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                handle(update.to_dict())
+    except KeyboardInterrupt:
+        pass
+
+
+def shard_worker(index, updates, token, args):
+    global srm
+
+    # The supervisor decides when to stop, once this worker's queue is empty.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Other workers change saved rolls too, so this one can't cache them.
+    srm.close()
+    srm = open_saved_roll_manager(shared=True)
+
+    # Each worker serves its own metrics, on the ports after the supervisor's.
+    if args.metrics_port is not None:
+        metrics.serve(("127.0.0.1", args.metrics_port + 1 + index))
+    profiler.rate = args.profile_rate
+    profiler.memory = args.profile_memory
+
+    bot = Bot(token)
+    dispatcher = Dispatcher(bot, None, workers=0)
+    add_handlers(dispatcher)
+    start_outbox(bot, args.metrics_interval)
+
+    try:
+        run_shard(updates, process_with(dispatcher))
+    finally:
+        outbox.close()
+        srm.close()
+        if args.profile_output:
+            profiler.dump(f"{args.profile_output}.{index}")
+
+
+def run_sharded(token, args):
+    supervisor = ShardSupervisor(shard_worker, args.shards, args=(token, args))
+    supervisor.start()
+
+    bot = Bot(token)
+    try:
+        if args.webhook:
+            run_webhook(bot, supervisor.route, args)
+        else:
+            run_polling(bot, supervisor.route)
+    finally:
+        supervisor.stop()
+        logging.info("Updates routed to each shard: %s", supervisor.routed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the bot.")
+    parser.add_argument(
+        "--webhook",
+        metavar="URL",
+        help="Receive updates through a webhook at this public URL, instead "
+        "of polling. A local server receives them, behind a TLS proxy.",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Webhook server host")
+    parser.add_argument("--port", type=int, default=8080, help="Webhook server port")
+    parser.add_argument("--path", default="/", help="Path updates are POSTed to")
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Threads handling webhook updates"
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=1000, help="Most webhook updates to queue"
+    )
+    parser.add_argument(
+        "--shed",
+        choices=WebhookServer.SHED_POLICIES,
+        default="reject",
+        help="What to do with webhook updates when the queue is full",
+    )
+    parser.add_argument(
+        "--secret-token",
+        default=os.environ.get("FOXROLLBOT_WEBHOOK_SECRET"),
+        help="Secret Telegram sends with each webhook update, which the server "
+        "checks; defaults to FOXROLLBOT_WEBHOOK_SECRET",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60,
+        help="Seconds between logging webhook and outbox metrics",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        help="Handle updates in this many worker processes, each serving its "
+        "own share of chats. Needs FOXROLLBOT_DB, which they all use.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve metrics for Prometheus at /metrics on this local port",
+    )
+    parser.add_argument(
+        "--profile-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of commands to profile; /profile changes it while running",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="Trace the memory use of profiled commands too, holding other "
+        "commands back while they run",
+    )
+    parser.add_argument(
+        "--profile-output",
+        metavar="PATH",
+        help="Write profiled stacks here in folded format on exit",
+    )
+    args = parser.parse_args()
+    if args.shards and "FOXROLLBOT_DB" not in os.environ:
+        parser.error("--shards needs FOXROLLBOT_DB to be set")
+    if args.secret_token is not None and not re.fullmatch(
+        r"[A-Za-z0-9_-]{1,256}", args.secret_token
+    ):
+        parser.error(
+            "--secret-token must be 1-256 letters, digits, underscores or hyphens"
+        )
+
+    with open("token.txt") as token_file:
+        token = token_file.read().strip()
+
+    if args.metrics_port is not None:
+        metrics.serve(("127.0.0.1", args.metrics_port))
+    profiler.rate = args.profile_rate
+    profiler.memory = args.profile_memory
+
     print("Starting bot...")
-    updater.start_polling()
+    if args.shards:
+        run_sharded(token, args)
+    else:
+        updater = Updater(token)
+        add_handlers(updater.dispatcher)
+        start_outbox(updater.bot, args.metrics_interval)
+
+        if args.webhook:
+            run_webhook(updater.bot, process_with(updater.dispatcher), args)
+        else:
+            updater.start_polling()
+            updater.idle()
+
+        # Send the replies still waiting.
+        outbox.close()
+
+    # Write out any saves and deletes still waiting to be batched.
+    srm.close()
+
+    if args.profile_output:
+        profiler.dump(args.profile_output)
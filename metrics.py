@@ -0,0 +1,385 @@
+"""
+Metrics for the bot's serving paths.
+
+Metrics are kept in a Registry, by name and labels, and can be exposed in
+Prometheus's text format with serve(). Code that's always instrumented uses
+the module's default registry.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+"""tuple: Default upper bounds of histogram buckets, in seconds"""
+
+
+class LatencyHistogram:
+    """
+    Thread-safe histogram of durations, counted into fixed buckets.
+
+    Attributes:
+        buckets (tuple): Upper bound of each bucket, in seconds. A final
+            bucket catches everything larger.
+        count (int): Number of observations
+        sum (float): Sum of all observations, in seconds
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        Create a LatencyHistogram instance.
+
+        Args:
+            buckets (tuple): Increasing upper bounds of buckets, in seconds
+        """
+        self.buckets = tuple(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """
+        Record a duration.
+
+        Args:
+            seconds (float): Duration to record
+        """
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    @contextmanager
+    def time(self):
+        """Context manager that records how long its block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def counts(self):
+        """
+        Get the number of observations in each bucket.
+
+        Returns:
+            list: Count for each bucket, then for the overflow bucket
+        """
+        with self._lock:
+            return list(self._counts)
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by interpolating within the bucket it falls in.
+
+        Args:
+            q (float): Quantile, from 0 to 1
+
+        Returns:
+            float: Estimated duration in seconds, or 0.0 with no observations.
+                Quantiles in the overflow bucket are reported as the largest
+                bucket bound.
+        """
+        counts = self.counts()
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+
+        target = q * total
+        seen = 0
+        for i, count in enumerate(counts[:-1]):
+            if count and seen + count >= target:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                fraction = (target - seen) / count
+                return lower + (self.buckets[i] - lower) * fraction
+            seen += count
+        return self.buckets[-1]
+
+
+class Counter:
+    """
+    Thread-safe counter.
+
+    Attributes:
+        value (float): Current count
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        Add to the count.
+
+        Args:
+            amount (float): Amount to add
+        """
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    """Value read from a function whenever it's collected."""
+
+    def __init__(self, function):
+        """
+        Create a Gauge instance.
+
+        Args:
+            function (callable): Function returning the current value
+        """
+        self._function = function
+
+    @property
+    def value(self):
+        """float: Current value"""
+        return self._function()
+
+
+class CallbackCounter(Gauge):
+    """Count kept elsewhere, read from a function whenever it's collected."""
+
+
+class Family:
+    """
+    Metrics of one name, told apart by their labels.
+
+    Attributes:
+        name (str): Name of metrics
+        kind (str): Prometheus type: "counter", "gauge" or "histogram"
+        help (str): Description of metrics
+        children (dict): Metrics keyed by their labels, as a sorted tuple of
+            (name, value) pairs
+    """
+
+    def __init__(self, name, kind, help):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.children = {}
+
+
+class Registry:
+    """Thread-safe collection of metrics."""
+
+    KINDS = {
+        Counter: "counter",
+        CallbackCounter: "counter",
+        Gauge: "gauge",
+        LatencyHistogram: "histogram",
+    }
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, **labels):
+        """
+        Get a counter, creating it if it doesn't exist.
+
+        Args:
+            name (str): Name of counter
+            help (str): Description of counter
+            **labels: Labels of counter
+
+        Returns:
+            Counter: Counter with those labels
+        """
+        return self._get(name, help, labels, Counter)
+
+    def histogram(self, name, help, **labels):
+        """
+        Get a latency histogram, creating it if it doesn't exist.
+
+        Args:
+            name (str): Name of histogram
+            help (str): Description of histogram
+            **labels: Labels of histogram
+
+        Returns:
+            LatencyHistogram: Histogram with those labels
+        """
+        return self._get(name, help, labels, LatencyHistogram)
+
+    def register(self, name, help, metric, **labels):
+        """
+        Add an existing metric, replacing any with the same name and labels.
+
+        Args:
+            name (str): Name of metric
+            help (str): Description of metric
+            metric: Counter, CallbackCounter, Gauge or LatencyHistogram to
+                add
+            **labels: Labels of metric
+        """
+        with self._lock:
+            family = self._family(name, help, type(metric))
+            family.children[tuple(sorted(labels.items()))] = metric
+
+    def collect(self):
+        """
+        Get a snapshot of every family of metrics.
+
+        Returns:
+            list: Copies of families, sorted by name, that won't change as
+                metrics are added
+        """
+        families = []
+        with self._lock:
+            for name in sorted(self._families):
+                family = self._families[name]
+                copy = Family(name, family.kind, family.help)
+                copy.children = dict(family.children)
+                families.append(copy)
+        return families
+
+    def exposition(self):
+        """
+        Describe every metric in Prometheus's text format.
+
+        Returns:
+            str: Exposition of metrics
+        """
+        lines = []
+        for family in self.collect():
+            lines.append(f"# HELP {family.name} {_escape(family.help, False)}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for labels, metric in family.children.items():
+                if family.kind != "histogram":
+                    lines.append(
+                        f"{family.name}{_labels(labels)} {_number(metric.value)}"
+                    )
+                    continue
+
+                cumulative = 0
+                counts = metric.counts()
+                bounds = [_number(b) for b in metric.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    bucket_labels = _labels(labels + (("le", bound),))
+                    lines.append(f"{family.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{family.name}_sum{_labels(labels)} {metric.sum!r}")
+                lines.append(f"{family.name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def _get(self, name, help, labels, kind):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._family(name, help, kind)
+            metric = family.children.get(key)
+            if metric is None:
+                metric = family.children[key] = kind()
+            return metric
+
+    def _family(self, name, help, kind):
+        # Must be called with the lock held.
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = Family(name, self.KINDS[kind], help)
+        elif family.kind != self.KINDS[kind]:
+            raise ValueError(f"{name} is already a {family.kind}")
+        return family
+
+
+def _escape(value, quotes=True):
+    value = value.replace("\\", "\\\\").replace("\n", "\\n")
+    if quotes:
+        value = value.replace('"', '\\"')
+    return value
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+"""Registry: Default registry, used by the bot's instrumented code"""
+
+
+def timed(name, help, **labels):
+    """
+    Decorator timing every call of a function into a histogram of the
+    default registry.
+
+    Args:
+        name (str): Name of histogram
+        help (str): Description of histogram
+        **labels: Labels of histogram
+    """
+
+    def decorator(function):
+        histogram = registry.histogram(name, help, **labels)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time():
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def serve(address, registry=registry):
+    """
+    Serve metrics in Prometheus's text format at /metrics, in a background
+    thread.
+
+    Args:
+        address (tuple): Host and port to listen on
+        registry (Registry): Registry of metrics to serve
+
+    Returns:
+        ThreadingHTTPServer: Running server, to be shut down with shutdown()
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.exposition().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(address, RequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,348 @@
+"""
+Rate-limited sending of the bot's replies.
+
+Telegram limits how fast a bot can send to each chat: about a message a second
+in private chats and twenty a minute in groups. Outbox queues replies per chat
+and sends them as each chat's token bucket allows, so a burst in one busy chat
+waits its turn instead of being flood limited, and doesn't hold up other
+chats. Replies that pile up for a chat are sent together as one message when
+they fit, each headed by who asked for it if they answer different messages,
+and failed sends are retried with backoff.
+"""
+
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+
+from metrics import LatencyHistogram
+
+
+class _Chat:
+    """Queue and token bucket of one chat."""
+
+    __slots__ = ("pending", "rate", "tokens", "updated", "not_before", "active")
+
+    def __init__(self, rate, tokens, now):
+        # Each pending item is [reply, time queued, attempts so far, asker].
+        self.pending = deque()
+        self.rate = rate
+        self.tokens = tokens
+        self.updated = now
+        self.not_before = now
+        # Whether the chat is scheduled or being sent to, so it's only ever
+        # handled by one sender at a time and its replies stay in order.
+        self.active = False
+
+
+class Outbox:
+    """
+    Scheduler that sends replies within per-chat rate limits.
+
+    Attributes:
+        sent (int): Number of messages sent
+        coalesced (int): Number of replies sent as part of another message
+        retries (int): Number of failed sends that were retried
+        failed (int): Number of replies given up on
+        latency (dict): LatencyHistogram of how long replies wait to be sent
+            ("queue") and how long sending them takes ("send")
+    """
+
+    RATE = 1.0
+    """float: Messages per second each private chat's bucket refills at"""
+
+    GROUP_RATE = 20 / 60
+    """float: Messages per second each group chat's bucket refills at"""
+
+    BURST = 3
+    """int: Number of messages a chat's bucket holds"""
+
+    MAX_LENGTH = 4096
+    """int: Longest message text Telegram accepts"""
+
+    MAX_RETRIES = 5
+    """int: Number of times to retry a failed send before giving up"""
+
+    BACKOFF = 1.0
+    """float: Seconds to wait before the first retry, doubling for each one"""
+
+    SENDERS = 4
+    """int: Number of threads sending replies"""
+
+    def __init__(
+        self,
+        send,
+        rate=RATE,
+        group_rate=GROUP_RATE,
+        burst=BURST,
+        max_retries=MAX_RETRIES,
+        backoff=BACKOFF,
+        senders=SENDERS,
+        retry_on=(OSError,),
+    ):
+        """
+        Create an Outbox instance. Nothing is sent until start() is called.
+
+        Args:
+            send (callable): Function that sends a message, called with a
+                reply's keyword arguments, like Bot.send_message
+            rate (float): Refill rate of private chats' buckets, per second
+            group_rate (float): Refill rate of group chats' buckets, per second
+            burst (int): Capacity of each chat's bucket
+            max_retries (int): Number of times to retry a failed send
+            backoff (float): Seconds before the first retry
+            senders (int): Number of sending threads
+            retry_on (tuple): Exceptions from send worth retrying. Exceptions
+                with a retry_after attribute, which Telegram gives when flood
+                limiting, are always retried after that many seconds.
+        """
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failed = 0
+        self.latency = {"queue": LatencyHistogram(), "send": LatencyHistogram()}
+
+        self._send = send
+        self._rate = rate
+        self._group_rate = group_rate
+        self._burst = burst
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._senders = senders
+        self._retry_on = retry_on
+
+        self._chats = {}
+        # Heap of (time, sequence number, chat id) of chats with replies ready
+        # to go out once that time comes.
+        self._schedule = []
+        self._sequence = 0
+        self._depth = 0
+        self._in_flight = 0
+        self._closing = False
+        self._condition = threading.Condition()
+        self._threads = []
+
+    @property
+    def depth(self):
+        """int: Number of replies waiting to be sent"""
+        return self._depth
+
+    def start(self):
+        """Start the sending threads."""
+        for _ in range(self._senders):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        """Send the replies still waiting, then stop the sending threads."""
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def put(self, reply, asker=None):
+        """
+        Queue a reply to be sent.
+
+        Args:
+            reply (dict): Keyword arguments for send, including chat_id
+            asker (str): Markdown naming who the reply answers, which lets a
+                Markdown reply be joined with replies to other messages
+        """
+        chat_id = reply["chat_id"]
+        with self._condition:
+            now = time.monotonic()
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                # Group chats have negative ids.
+                rate = self._group_rate if chat_id < 0 else self._rate
+                chat = self._chats[chat_id] = _Chat(rate, self._burst, now)
+
+            chat.pending.append([reply, now, 0, asker])
+            self._depth += 1
+            if not chat.active:
+                self._enqueue(chat_id, chat, now)
+
+    def summary(self):
+        """
+        Describe the outbox's counters and latencies on one line.
+
+        Returns:
+            str: Summary, with latencies in milliseconds
+        """
+        stages = " ".join(
+            f"{stage}="
+            + "/".join(f"{h.quantile(q) * 1000:.1f}" for q in (0.5, 0.95, 0.99))
+            for stage, h in self.latency.items()
+        )
+        return (
+            f"depth={self.depth} sent={self.sent} coalesced={self.coalesced} "
+            f"retries={self.retries} failed={self.failed} "
+            f"p50/p95/p99 ms: {stages}"
+        )
+
+    def _enqueue(self, chat_id, chat, now):
+        # Must be called with the condition held.
+        self._refill(chat, now)
+        ready = max(chat.not_before, now + (1 - chat.tokens) / chat.rate)
+        self._sequence += 1
+        heapq.heappush(self._schedule, (ready, self._sequence, chat_id))
+        chat.active = True
+        self._condition.notify()
+
+    def _refill(self, chat, now):
+        chat.tokens = min(self._burst, chat.tokens + (now - chat.updated) * chat.rate)
+        chat.updated = now
+
+    def _coalesce(self, chat):
+        """
+        Take the next message to send to a chat off its queue, joining as
+        many of its waiting replies into it as fit.
+
+        Only replies to messages are joined, and only if their options match.
+        Replies to the same message are simply joined. If they answer
+        different messages, the result is a reply to the first message, and
+        each part is headed by who asked for it, so none of them looks like
+        it answers someone else.
+
+        Returns:
+            list: Pending item of the message
+        """
+        first = chat.pending.popleft()
+        reply, queued, attempts, asker = first
+        # Retries go out as they were, as they may be joined already.
+        if reply.get("reply_to_message_id") is None or attempts:
+            return first
+
+        options = self._options(reply)
+        labelled = asker is not None and reply.get("parse_mode") == "Markdown"
+        parts = [first]
+        length = len(reply["text"])
+
+        while chat.pending:
+            candidate = chat.pending[0]
+            reply_to = candidate[0].get("reply_to_message_id")
+            if reply_to is None or self._options(candidate[0]) != options:
+                break
+            same = reply_to == reply["reply_to_message_id"]
+            if not same and not (labelled and candidate[3] is not None):
+                break
+            length += 2 + len(candidate[0]["text"])
+            if length + self._label_length(parts + [candidate]) > self.MAX_LENGTH:
+                break
+            parts.append(candidate)
+            chat.pending.popleft()
+
+        if len(parts) == 1:
+            return first
+
+        if self._label_length(parts):
+            texts = [f"{part[3]}\n{part[0]['text']}" for part in parts]
+        else:
+            texts = [part[0]["text"] for part in parts]
+        self._depth -= len(parts) - 1
+        self.coalesced += len(parts) - 1
+        return [dict(reply, text="\n\n".join(texts)), queued, attempts, None]
+
+    @staticmethod
+    def _label_length(parts):
+        """Get the length of the headings parts need, if any."""
+        first = parts[0][0]["reply_to_message_id"]
+        if all(part[0]["reply_to_message_id"] == first for part in parts):
+            return 0
+        return sum(len(part[3]) + 1 for part in parts)
+
+    @staticmethod
+    def _options(reply):
+        return {
+            k: v for k, v in reply.items() if k not in ("text", "reply_to_message_id")
+        }
+
+    def _next(self):
+        """
+        Wait for a chat that's ready to be sent to.
+
+        Returns:
+            tuple: Chat id, chat and pending item to send, or None once the
+                outbox is closed and everything has been sent
+        """
+        while True:
+            if not self._schedule:
+                if self._closing and self._in_flight == 0:
+                    return None
+                self._condition.wait()
+                continue
+
+            now = time.monotonic()
+            ready, _, chat_id = self._schedule[0]
+            if ready > now:
+                self._condition.wait(ready - now)
+                continue
+
+            heapq.heappop(self._schedule)
+            chat = self._chats[chat_id]
+            self._refill(chat, now)
+            chat.tokens -= 1
+            return chat_id, chat, self._coalesce(chat)
+
+    def _work(self):
+        while True:
+            with self._condition:
+                task = self._next()
+                if task is None:
+                    self._condition.notify_all()
+                    return
+                self._in_flight += 1
+
+            chat_id, chat, item = task
+            reply, queued, attempts, _ = item
+            started = time.monotonic()
+            self.latency["queue"].observe(started - queued)
+            error = None
+            try:
+                self._send(**reply)
+            except Exception as e:
+                error = e
+            finished = time.monotonic()
+            self.latency["send"].observe(finished - started)
+
+            with self._condition:
+                self._in_flight -= 1
+                if error is None:
+                    self._depth -= 1
+                    self.sent += 1
+                else:
+                    self._failed(chat, item, error, finished)
+
+                if chat.pending:
+                    self._enqueue(chat_id, chat, finished)
+                else:
+                    chat.active = False
+                    # Forget chats with nothing to send, unless they might
+                    # still be rate limited.
+                    self._refill(chat, finished)
+                    if chat.tokens >= self._burst and chat.not_before <= finished:
+                        del self._chats[chat_id]
+                self._condition.notify_all()
+
+    def _failed(self, chat, item, error, now):
+        # Must be called with the condition held.
+        retry_after = getattr(error, "retry_after", None)
+        if item[2] < self._max_retries and (
+            retry_after is not None or isinstance(error, self._retry_on)
+        ):
+            if retry_after is None:
+                retry_after = self._backoff * 2 ** item[2]
+            logging.warning("Retrying send in %.1fs: %s", retry_after, error)
+            item[2] += 1
+            chat.pending.appendleft(item)
+            chat.not_before = now + retry_after
+            self.retries += 1
+        else:
+            logging.error("Giving up on send: %s", error)
+            self._depth -= 1
+            self.failed += 1
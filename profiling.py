@@ -0,0 +1,262 @@
+"""
+Sampling profiler for live command traffic.
+
+When it's switched on, a fraction of command invocations are run under
+cProfile, and optionally tracemalloc, and the results are added up by command
+and roll expression. They can be dumped as folded stacks, which flame graph
+tools like flamegraph.pl and speedscope read, with each stack rooted at the
+command and expression that caused it, so expensive inputs stand out.
+
+tracemalloc counts every thread's allocations, so while a sampled call's
+memory is traced, other calls going through the profiler wait for it, and it
+waits for those already running, to keep its peak to its own allocations.
+"""
+
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+
+def folded_stacks(stats, root):
+    """
+    Turn cProfile stats into folded stacks.
+
+    cProfile only records which functions called which, not whole stacks, so
+    the time of functions called from more than one place is shared between
+    their callers in proportion to the time spent in each call.
+
+    Args:
+        stats (pstats.Stats): Profile to fold
+        root (str): Frame to put at the bottom of every stack
+
+    Returns:
+        dict: Microseconds spent in each stack, keyed by its frames joined
+            with semicolons
+    """
+    children = {}
+    roots = []
+    for function, (_, _, self_time, total, callers) in stats.stats.items():
+        if not callers:
+            roots.append((function, self_time, total))
+        for caller, (_, _, _, edge_total) in callers.items():
+            children.setdefault(caller, []).append((function, edge_total))
+
+    folded = {}
+
+    def walk(function, share, stack, seen):
+        _, _, self_time, total, _ = stats.stats[function]
+        stack = f"{stack};{label(function)}"
+        ratio = share / total if total else 0
+        microseconds = round(self_time * ratio * 1e6)
+        if microseconds:
+            folded[stack] = folded.get(stack, 0) + microseconds
+        for child, edge_total in children.get(function, ()):
+            # Recursive calls are already counted in the outer call.
+            if child not in seen:
+                walk(child, edge_total * ratio, stack, seen | {child})
+
+    for function, _, total in roots:
+        walk(function, total, root, {function})
+    return folded
+
+
+def label(function):
+    """Name a function from cProfile stats for a stack frame."""
+    filename, line, name = function
+    if filename == "~":
+        # Built-in functions, like "<built-in method builtins.sum>".
+        return name.strip("<>")
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+class Sample:
+    """
+    Totals of the sampled invocations of one command and expression.
+
+    Attributes:
+        count (int): Number of sampled invocations
+        seconds (float): Total wall time of sampled invocations
+        peak (int): Largest amount of memory an invocation allocated, in
+            bytes, if memory was traced
+    """
+
+    __slots__ = ("count", "seconds", "peak")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.peak = 0
+
+
+class Profiler:
+    """
+    Profiler sampling a fraction of the calls it runs.
+
+    Attributes:
+        rate (float): Fraction of calls sampled, from 0 to 1
+        memory (bool): Whether sampled calls' memory use is traced as well;
+            other calls are held back while it's traced
+        samples (dict): Sample totals, keyed by (command, expression)
+    """
+
+    MAX_EXPRESSION = 100
+    """int: Longest expression kept as a tag, in characters"""
+
+    def __init__(self, rate=0.0, memory=False):
+        """
+        Create a Profiler instance.
+
+        Args:
+            rate (float): Fraction of calls to sample; 0 switches it off
+            memory (bool): Whether to trace sampled calls' memory use
+        """
+        self.rate = rate
+        self.memory = memory
+        self.samples = {}
+
+        self._folded = {}
+        self._random = random.Random()
+        # Only one call is profiled at a time, which keeps tracemalloc's
+        # global state to one call and bounds the overhead.
+        self._sampling = threading.Lock()
+        self._lock = threading.Lock()
+        # Calls running outside the profiler, and the thread whose call's
+        # memory is being traced, if any.
+        self._running = 0
+        self._tracer = None
+        self._gate = threading.Condition()
+
+    def run(self, command, expression, function, *args):
+        """
+        Call a function, profiling it if it's sampled.
+
+        Args:
+            command (str): Name of command being run
+            expression (str): Roll expression or arguments being handled
+            function (callable): Function to call
+            *args: Arguments for function
+
+        Returns:
+            What the function returns
+        """
+        if self.rate <= 0:
+            return function(*args)
+        if self._random.random() >= self.rate or not self._sampling.acquire(
+            blocking=False
+        ):
+            return self._run_beside(function, args)
+
+        try:
+            return self._profile(command, expression, function, args)
+        finally:
+            self._sampling.release()
+
+    def _run_beside(self, function, args):
+        # Calls made by the traced call itself belong in its peak, and would
+        # wait for it forever.
+        if not self.memory or self._tracer == threading.get_ident():
+            return function(*args)
+
+        with self._gate:
+            self._gate.wait_for(lambda: self._tracer is None)
+            self._running += 1
+        try:
+            return function(*args)
+        finally:
+            with self._gate:
+                self._running -= 1
+                self._gate.notify_all()
+
+    def _profile(self, command, expression, function, args):
+        # Imported here, since pstats takes longer to import than the rest of
+        # the bot's commands put together and most runs never profile.
+        import cProfile
+
+        expression = expression[: self.MAX_EXPRESSION]
+        memory = self.memory and not tracemalloc.is_tracing()
+        if memory:
+            with self._gate:
+                self._tracer = threading.get_ident()
+                self._gate.wait_for(lambda: not self._running)
+            tracemalloc.start()
+
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            seconds = time.perf_counter() - start
+            peak = 0
+            if memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                with self._gate:
+                    self._tracer = None
+                    self._gate.notify_all()
+            self._record(command, expression, profile, seconds, peak)
+
+    def _record(self, command, expression, profile, seconds, peak):
+        import pstats
+
+        # Semicolons separate frames in folded stacks.
+        root = f"/{command} {expression}".strip().replace(";", ",")
+        folded = folded_stacks(pstats.Stats(profile), root)
+
+        with self._lock:
+            sample = self.samples.get((command, expression))
+            if sample is None:
+                sample = self.samples[(command, expression)] = Sample()
+            sample.count += 1
+            sample.seconds += seconds
+            sample.peak = max(sample.peak, peak)
+
+            for stack, microseconds in folded.items():
+                self._folded[stack] = self._folded.get(stack, 0) + microseconds
+
+    def top(self, count=10):
+        """
+        Get the commands and expressions that took the most time.
+
+        Args:
+            count (int): Number to get
+
+        Returns:
+            list: (command, expression, Sample) tuples, most time first
+        """
+        with self._lock:
+            items = [(c, e, s) for (c, e), s in self.samples.items()]
+        items.sort(key=lambda item: item[2].seconds, reverse=True)
+        return items[:count]
+
+    def folded(self):
+        """
+        Get every sampled stack in folded format.
+
+        Returns:
+            str: One line per stack, its frames and then microseconds spent
+        """
+        with self._lock:
+            stacks = sorted(self._folded.items())
+        return "".join(f"{stack} {microseconds}\n" for stack, microseconds in stacks)
+
+    def dump(self, path):
+        """
+        Write sampled stacks to a file in folded format.
+
+        Args:
+            path (str): Path of file to write
+        """
+        with open(path, "w") as f:
+            f.write(self.folded())
+
+    def clear(self):
+        """Forget everything sampled so far."""
+        with self._lock:
+            self.samples = {}
+            self._folded = {}
+
+
+profiler = Profiler()
+"""Profiler: Profiler for the bot's commands, off until its rate is set"""
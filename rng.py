@@ -0,0 +1,85 @@
+import random
+
+
+class RandomBackend:
+    """
+    Dice backend using Python's random module.
+
+    Without a seed, this uses the module-level functions of random, so
+    `random.seed()` affects it. With a seed, it gets its own generator.
+    """
+
+    def __init__(self, seed=None):
+        """
+        Create a RandomBackend instance.
+
+        Args:
+            seed (int): Seed for a private generator, or None to share the
+                random module's global generator
+        """
+        self._random = random if seed is None else random.Random(seed)
+
+    def roll(self, sides):
+        """
+        Roll one die for each entry of sides.
+
+        Args:
+            sides (list): Number of sides of each die to roll
+
+        Returns:
+            list: Results, in the same order as sides
+        """
+        randint = self._random.randint
+        return [randint(1, die) for die in sides]
+
+
+class NumpyBackend:
+    """
+    Dice backend drawing every die of a batch with a single NumPy call.
+
+    Requires numpy to be installed.
+    """
+
+    def __init__(self, seed=None):
+        """
+        Create a NumpyBackend instance.
+
+        Args:
+            seed (int): Seed for the generator, or None for fresh entropy
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("NumpyBackend requires numpy to be installed.")
+
+        self._numpy = numpy
+        self._generator = numpy.random.default_rng(seed)
+
+    def roll(self, sides):
+        """
+        Roll one die for each entry of sides.
+
+        Args:
+            sides (list): Number of sides of each die to roll
+
+        Returns:
+            list: Results, in the same order as sides
+        """
+        high = self._numpy.asarray(sides, dtype=self._numpy.int64) + 1
+        return self._generator.integers(1, high).tolist()
+
+
+backend = RandomBackend()
+"""Backend used when none is passed to a roll explicitly."""
+
+
+def set_backend(new_backend):
+    """
+    Replace the default backend.
+
+    Args:
+        new_backend: Object with a roll(sides) method, such as RandomBackend or
+            NumpyBackend
+    """
+    global backend
+    backend = new_backend
@@ -1,7 +1,10 @@
+import copy
 import re
-import random
 from functools import total_ordering
+from itertools import islice
 
+import rng
+from cache import LRUCache
 from errors import *
 
 
@@ -10,8 +13,26 @@ class Dice:
 
     MAX_DICE = 100
     MAX_SIDES = 1000
+    MAX_FACES = 100
+
+    # Faces of Fate (or Fudge) dice, written dF.
+    FATE = (-1, 0, 1)
+
+    def __init__(self, quantity, die, negative=False, faces=None):
+        # Dice with faces other than 1 to die are given as a list of faces,
+        # each as likely as the others, and die is their number.
+        if faces is not None:
+            faces = tuple(faces)
+            die = len(faces)
+            if die < 2 or die > self.MAX_FACES:
+                raise OutOfRangeException(
+                    f"Custom dice must have between 2 and {self.MAX_FACES} faces."
+                )
+            if any(abs(face) > self.MAX_SIDES for face in faces):
+                raise OutOfRangeException(
+                    f"Faces must be between -{self.MAX_SIDES} and {self.MAX_SIDES}."
+                )
 
-    def __init__(self, quantity, die, negative=False):
         if quantity < 1 or quantity > self.MAX_DICE:
             raise OutOfRangeException(
                 f"Number of dice must be between 1 and {self.MAX_DICE}."
@@ -24,72 +45,207 @@ class Dice:
         self.quantity = quantity
         self.die = die
         self.negative = negative
+        self.faces = faces
+
+        # Dice are drawn like ordinary ones, from 1 to die, and the draws are
+        # looked up in this table, which has a dummy entry at 0.
+        self._table = None if faces is None else (0,) + faces
 
     @classmethod
     def from_str(cls, roll_str):
-        if roll_str.startswith("+") or roll_str.startswith("-"):
-            sign = roll_str[0]
-            roll_str = roll_str[1:]
-        else:
-            sign = "+"
-
-        match = cls.SYNTAX.fullmatch(roll_str)
-
-        if match:
-            quantity = int(match.group(1))
-            die = int(match.group(2))
-            return cls(quantity, die, sign == "-")
-        else:
-            raise InvalidSyntaxException()
-
-    def roll(self):
-        results = []
-        for i in range(self.quantity):
-            results.append(random.randint(1, self.die))
-        return DiceResult(self, results, self.negative)
+        parser = RollParser(roll_str)
+        negative = parser.parse_sign() == "-"
+        quantity, die, faces = parser.parse_term()
+        parser.expect_end()
+
+        if die is None:
+            raise parser.error("Expected dice", parser.pos)
+        return cls(quantity, die, negative, faces)
+
+    @property
+    def lowest(self):
+        """int: Lowest face of one die"""
+        return 1 if self.faces is None else min(self.faces)
+
+    @property
+    def highest(self):
+        """int: Highest face of one die"""
+        return self.die if self.faces is None else max(self.faces)
+
+    def roll(self, backend=None):
+        backend = backend or rng.backend
+        return self.result(iter(backend.roll(self.sides())))
+
+    def sides(self):
+        return [self.die] * self.quantity
+
+    def result(self, values):
+        # Takes this roll's results from an iterator over a larger batch.
+        drawn = islice(values, self.quantity)
+        if self._table is not None:
+            drawn = map(self._table.__getitem__, drawn)
+        return DiceResult(self, tuple(drawn), self.negative)
 
     def __str__(self):
         sign = "-" if self.negative else ""
-        return f"{sign}{self.quantity}d{self.die}"
+        if self.faces is None:
+            die = self.die
+        elif self.faces == self.FATE:
+            die = "F"
+        else:
+            die = "{" + ",".join(str(face) for face in self.faces) + "}"
+        return f"{sign}{self.quantity}d{die}"
 
     def __eq__(self, other):
         try:
             quantity = self.quantity == other.quantity
-            die = self.die == other.die
+            die = self.die == other.die and self.faces == other.faces
             return True if quantity and die else False
         except AttributeError:
             return False
 
 
+class RollParser:
+    # Single-pass parser for roll expressions. The grammar is:
+    #
+    #   roll  := term (sign term)*
+    #   term  := number ["d" die]
+    #   die   := number | "F" | "{" face ("," face)* "}"
+    #   face  := ["-"] number
+    #   sign  := "+" | "-"
+    #
+    # Terms with a "d" become Dice and the rest become modifiers. At least one
+    # term has to be dice. "F" is a Fate die, and a list of faces is a custom
+    # die with those faces. Errors carry the offset at which parsing failed.
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def error(self, message, position):
+        return InvalidSyntaxException(
+            f"{message} at position {position}.", position=position
+        )
+
+    def parse_roll(self):
+        terms = []
+        negative = False
+
+        while True:
+            quantity, die, faces = self.parse_term()
+            terms.append((negative, quantity, die, faces))
+
+            sign = self.parse_sign()
+            if sign is None:
+                self.expect_end()
+                break
+            negative = sign == "-"
+
+        # Dice are only built once the whole string is known to be valid, so
+        # syntax errors take precedence over range errors.
+        rolls = []
+        modifiers = []
+        for negative, quantity, die, faces in terms:
+            if die is not None:
+                rolls.append(Dice(quantity, die, negative, faces))
+            else:
+                modifiers.append(-quantity if negative else quantity)
+
+        if len(rolls) == 0:
+            raise self.error("Expected at least one dice term", 0)
+
+        return rolls, modifiers
+
+    def parse_sign(self):
+        if self.pos < len(self.text) and self.text[self.pos] in "+-":
+            self.pos += 1
+            return self.text[self.pos - 1]
+        return None
+
+    def parse_term(self):
+        # Returns the quantity, the number of sides or None for a modifier,
+        # and the faces of a custom die or None.
+        quantity = self.parse_number()
+        if self.pos < len(self.text) and self.text[self.pos] == "d":
+            self.pos += 1
+            if self.text[self.pos : self.pos + 1] in ("F", "f"):
+                self.pos += 1
+                return quantity, len(Dice.FATE), Dice.FATE
+            if self.text[self.pos : self.pos + 1] == "{":
+                faces = self.parse_faces()
+                return quantity, len(faces), faces
+            return quantity, self.parse_number(), None
+        return quantity, None, None
+
+    def parse_faces(self):
+        self.pos += 1
+        faces = []
+        while True:
+            negative = self.text[self.pos : self.pos + 1] == "-"
+            if negative:
+                self.pos += 1
+            face = self.parse_number()
+            faces.append(-face if negative else face)
+
+            if self.text[self.pos : self.pos + 1] == "}":
+                self.pos += 1
+                return tuple(faces)
+            if self.text[self.pos : self.pos + 1] != ",":
+                raise self.error("Expected , or }", self.pos)
+            self.pos += 1
+
+    def parse_number(self):
+        start = self.pos
+        text = self.text
+        while self.pos < len(text) and text[self.pos].isdecimal():
+            self.pos += 1
+        if self.pos == start:
+            raise self.error("Expected a number", start)
+        return int(text[start : self.pos])
+
+    def expect_end(self):
+        if self.pos != len(self.text):
+            raise self.error("Unexpected character", self.pos)
+
+
 @total_ordering
 class DiceResult:
+    # Results are created for every roll, so they use slots and work out their
+    # total once rather than on every comparison.
+    __slots__ = ("dice", "negative", "results", "total")
+
     def __init__(self, dice, results, negative):
         self.dice = dice
         self.negative = negative
         self.results = results
+        self.total = sum(results)
+
+    FATE_SYMBOLS = {-1: "-", 0: "/", 1: "+"}
 
     def __str__(self):
         sep = " | " if len(self.results) > 1 else ""
-        if len(self.results) > 1:
-            ind_results = ", ".join(str(r) for r in self.results)
-        else:
+        if len(self.results) <= 1:
             ind_results = ""
-        return f"{self.dice}: {sum(self.results)}{sep}{ind_results}"
+        elif self.dice.faces == Dice.FATE:
+            ind_results = "".join(self.FATE_SYMBOLS[r] for r in self.results)
+        else:
+            ind_results = ", ".join(str(r) for r in self.results)
+        return f"{self.dice}: {self.total}{sep}{ind_results}"
 
     def __add__(self, other):
         if type(other) == int:
-            return sum(self.results) + other
+            return self.total + other
         else:
-            return sum(self.results) + sum(other.results)
+            return self.total + other.total
 
     def __radd__(self, other):
         return self.__add__(other)
 
     def __eq__(self, other):
-        return sum(self.results) == sum(other.results)
+        return self.total == other.total
 
     def __lt__(self, other):
-        return sum(self.results) < sum(other.results)
+        return self.total < other.total
 
 
 class Roll:
@@ -97,7 +253,8 @@ class Roll:
     ADVANTAGE = 1
     DISADVANTAGE = 2
 
-    SYNTAX = re.compile(r"(\d+d\d+|\d+)([+-](\d+d\d+|\d+))*")
+    TERM = r"\d+d(?:\d+|[Ff]|\{-?\d+(?:,-?\d+)*\})|\d+"
+    SYNTAX = re.compile(rf"({TERM})([+-]({TERM}))*")
 
     MAX_COMPONENTS = 25
     MAX_MODIFIER = 1000
@@ -122,45 +279,65 @@ class Roll:
 
     @classmethod
     def from_str(cls, roll_str, advantage=NORMAL):
-        if cls.SYNTAX.fullmatch(roll_str):
-            components = re.sub(r"([+-])", r" \g<1>", "+" + roll_str).split()
-            rolls = []
-            modifiers = []
-
-            for comp in components:
-                match = Dice.SYNTAX.match(comp)
-                if match:
-                    rolls.append(Dice.from_str(comp))
-                else:
-                    modifiers.append(int(comp))
-
-            if len(rolls) == 0:
-                raise InvalidSyntaxException()
+        rolls, modifiers = RollParser(roll_str).parse_roll()
+        return cls(rolls, modifiers, advantage)
 
-            return cls(rolls, modifiers, advantage)
-        else:
-            raise InvalidSyntaxException()
+    def roll(self, backend=None):
+        backend = backend or rng.backend
+        return self.result(iter(backend.roll(self.sides())))
 
-    def roll(self):
-        results = []
+    def sides(self):
+        sides = []
         for roll in self.rolls:
-            results.append(roll.roll())
+            sides += roll.sides()
 
         if self.advantage is not self.NORMAL:
-            other_results = []
-            for roll in self.rolls:
-                other_results.append(roll.roll())
+            sides *= 2
+        return sides
+
+    def result(self, values):
+        # Takes this roll's results from an iterator over a larger batch, in the
+        # order given by sides().
+        results = [roll.result(values) for roll in self.rolls]
 
-            greater = max(results, other_results)
-            lesser = min(results, other_results)
+        if self.advantage is not self.NORMAL:
+            other_results = [roll.result(values) for roll in self.rolls]
 
+            # Attempts are compared dice by dice, and the first attempt wins
+            # ties.
+            totals = [r.total for r in results]
+            other_totals = [r.total for r in other_results]
             if self.advantage is self.ADVANTAGE:
-                return RollResult(greater, self.modifiers, sum(lesser))
-            if self.advantage is self.DISADVANTAGE:
-                return RollResult(lesser, self.modifiers, sum(greater))
+                other_wins = other_totals > totals
+            else:
+                other_wins = other_totals < totals
+
+            if other_wins:
+                results, other_results = other_results, results
+            losing = sum(r.total for r in other_results)
+            return RollResult(results, self.modifiers, losing)
         else:
             return RollResult(results, self.modifiers, None)
 
+    def __str__(self):
+        terms = [str(r) if r.negative else f"+{r}" for r in self.rolls]
+        modifiers = [f"{m:+d}" for m in self.modifiers]
+
+        # Expressions can't start with a sign, so if the first dice are
+        # negative, lead with a positive modifier instead.
+        if self.rolls[0].negative:
+            for i, modifier in enumerate(modifiers):
+                if modifier.startswith("+"):
+                    terms.insert(0, modifiers.pop(i))
+                    break
+
+        output = "".join(terms + modifiers).lstrip("+")
+        if self.advantage is self.ADVANTAGE:
+            output += " adv"
+        elif self.advantage is self.DISADVANTAGE:
+            output += " dis"
+        return output
+
     def __eq__(self, other):
         pairs = list(zip(self.rolls, other.rolls)) + list(
             zip(self.modifiers, other.modifiers)
@@ -179,16 +356,17 @@ class Roll:
 
 
 class RollResult:
+    __slots__ = ("rolls", "roll_total", "modifiers", "mod_total", "total", "losing")
+
     def __init__(self, rolls, modifiers, losing):
         self.rolls = rolls
 
         self.roll_total = 0
         for roll in self.rolls:
-            subtotal = sum(roll.results)
             if not roll.negative:
-                self.roll_total += subtotal
+                self.roll_total += roll.total
             else:
-                self.roll_total -= subtotal
+                self.roll_total -= roll.total
 
         self.modifiers = modifiers
         self.mod_total = sum(self.modifiers)
@@ -226,6 +404,11 @@ class RollResult:
 class RollCommand:
     MAX_ROLLS = 25
 
+    # Parsed commands keyed by their argument tuple. Commands are never
+    # modified after parsing, so the same instance can be handed out to every
+    # caller. Failed parses are cached too, as the exception that was raised.
+    cache = LRUCache(maxsize=1024)
+
     def __init__(self, rolls):
         if len(rolls) > self.MAX_ROLLS:
             raise TooManyComponentsException(
@@ -233,10 +416,32 @@ class RollCommand:
                 "command."
             )
 
-        self.rolls = rolls
+        self.rolls = tuple(rolls)
+
+        # Every die of the command is drawn from the backend in one batch.
+        self._sides = []
+        for roll in self.rolls:
+            self._sides += roll.sides()
 
     @classmethod
     def from_args(cls, args):
+        key = tuple(args)
+        cached = cls.cache.get(key)
+
+        if cached is None:
+            try:
+                cached = cls._parse_args(key)
+            except FoxRollBotException as e:
+                cached = e
+            cls.cache.put(key, cached)
+
+        if isinstance(cached, FoxRollBotException):
+            # Raise a copy so that concurrent callers don't share a traceback.
+            raise copy.copy(cached)
+        return cached
+
+    @classmethod
+    def _parse_args(cls, args):
         rolls = []
 
         cur_roll = {"roll": None, "adv": Roll.NORMAL, "qty": 1}
@@ -264,5 +469,10 @@ class RollCommand:
 
         return cls(rolls)
 
+    def roll(self, backend=None):
+        backend = backend or rng.backend
+        values = iter(backend.roll(self._sides))
+        return [roll.result(values) for roll in self.rolls]
+
     def __str__(self):
-        return "\n\n".join(str(r.roll()) for r in self.rolls)
+        return "\n\n".join(str(r) for r in self.roll())
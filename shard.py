@@ -0,0 +1,183 @@
+"""
+Spreading the bot's work over several processes.
+
+One process can only parse and format rolls as fast as one core allows.
+ShardSupervisor starts a number of worker processes and sends each update to
+one of them, picked by the chat it came from, so every chat is always served
+by the same worker and its replies stay in order. Workers that die are
+restarted, and updates already routed to them wait in their queue.
+"""
+
+import logging
+import multiprocessing
+import threading
+
+
+def chat_id_of(update):
+    """
+    Find the id of the chat an update belongs to.
+
+    Args:
+        update (dict): Update from the Bot API
+
+    Returns:
+        int: Id of the update's chat, or of the user who caused it if it isn't
+            in a chat (like inline queries), or None if it has neither
+    """
+    for key, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        message = value.get("message", value)
+        if "chat" in message:
+            return message["chat"]["id"]
+        if "from" in value:
+            return value["from"]["id"]
+    return None
+
+
+def run_shard(updates, handle):
+    """
+    Handle updates from a supervisor's queue until it's told to stop.
+
+    This is meant to be the main loop of a worker process.
+
+    Args:
+        updates (multiprocessing.Queue): Queue the worker was given
+        handle (callable): Function called with each update
+    """
+    while True:
+        update = updates.get()
+        if update is None:
+            return
+        try:
+            handle(update)
+        except Exception:
+            logging.exception("Error handling update")
+
+
+class ShardSupervisor:
+    """
+    Supervisor routing updates to worker processes by chat.
+
+    Attributes:
+        shards (int): Number of worker processes
+        routed (list): Number of updates routed to each worker
+        restarts (int): Number of times a dead worker has been restarted
+    """
+
+    QUEUE_SIZE = 1000
+    """int: Maximum number of updates waiting for each worker"""
+
+    CHECK_INTERVAL = 1.0
+    """float: Seconds between checks for dead workers"""
+
+    def __init__(self, target, shards, args=(), queue_size=QUEUE_SIZE):
+        """
+        Create a ShardSupervisor instance. No processes are started yet.
+
+        Workers are started with the spawn method, so they don't inherit the
+        supervisor's threads or database connections, and the target has to
+        be importable.
+
+        Args:
+            target (callable): Function run in each worker process, with the
+                worker's index, its queue of updates and then args. It should
+                call run_shard.
+            shards (int): Number of worker processes
+            args (tuple): Extra arguments for target
+            queue_size (int): Maximum number of updates waiting for a worker;
+                routing to a full queue blocks
+        """
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+
+        self.shards = shards
+        self.routed = [0] * shards
+        self.restarts = 0
+
+        self._target = target
+        self._args = args
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue(queue_size) for _ in range(shards)]
+        self._processes = [None] * shards
+        self._routed_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._monitor = None
+
+    def start(self):
+        """Start the worker processes, and a thread that restarts them."""
+        for index in range(self.shards):
+            self._spawn(index)
+        self._monitor = threading.Thread(target=self._watch, daemon=True)
+        self._monitor.start()
+
+    def stop(self):
+        """Let the workers finish the updates routed to them, then stop them."""
+        self._stopping.set()
+        if self._monitor is not None:
+            self._monitor.join()
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            if process is not None:
+                process.join()
+
+    def shard_of(self, update):
+        """
+        Pick the worker an update should go to.
+
+        Args:
+            update (dict): Update from the Bot API
+
+        Returns:
+            int: Index of worker
+        """
+        chat_id = chat_id_of(update)
+        return (chat_id or 0) % self.shards
+
+    def route(self, update):
+        """
+        Send an update to its worker.
+
+        Args:
+            update (dict): Update from the Bot API
+
+        Returns:
+            int: Index of worker it was sent to
+        """
+        index = self.shard_of(update)
+        self._queues[index].put(update)
+        with self._routed_lock:
+            self.routed[index] += 1
+        return index
+
+    def depths(self):
+        """
+        Get the number of updates waiting for each worker.
+
+        Returns:
+            list: Approximate queue length of each worker
+        """
+        return [queue.qsize() for queue in self._queues]
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=self._target,
+            args=(index, self._queues[index]) + tuple(self._args),
+            name=f"shard-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
+
+    def _watch(self):
+        while not self._stopping.wait(self.CHECK_INTERVAL):
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logging.error(
+                        "Shard %d exited with code %s, restarting it",
+                        index,
+                        process.exitcode,
+                    )
+                    self.restarts += 1
+                    self._spawn(index)
@@ -0,0 +1,251 @@
+"""
+Monte Carlo simulation of rolls.
+
+Simulations draw totals in fixed-size chunks and count them straight into a
+histogram, so no result objects are created per roll. They can be split
+across a pool of processes, each with its own seed derived from the one given.
+
+Usage: python simulate.py [-n SAMPLES] [-w WORKERS] [-s SEED] <roll args>
+"""
+
+import argparse
+import random
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from roll import Roll, RollCommand
+from stats import Distribution, summary
+from errors import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+CHUNK_SIZE = 65_536
+"""int: Number of rolls drawn at a time"""
+
+
+class Histogram:
+    """
+    Counts of roll totals, stored in a flat array of unsigned integers.
+
+    Attributes:
+        offset (int): Total counted by the first element of counts
+        counts (array): Number of times each total occurred
+    """
+
+    def __init__(self, minimum, maximum):
+        """
+        Create an empty Histogram instance.
+
+        Args:
+            minimum (int): Smallest total that can be counted
+            maximum (int): Largest total that can be counted
+        """
+        self.offset = minimum
+        self.counts = array("Q", bytes(8 * (maximum - minimum + 1)))
+
+    @property
+    def samples(self):
+        return sum(self.counts)
+
+    def add(self, total):
+        self.counts[total - self.offset] += 1
+
+    def add_many(self, totals):
+        """
+        Count a numpy array of totals.
+
+        Args:
+            totals (numpy.ndarray): Totals to count
+        """
+        counts = numpy.frombuffer(self.counts, dtype=numpy.uint64)
+        counts += numpy.bincount(totals - self.offset, minlength=len(counts)).astype(
+            numpy.uint64
+        )
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram with the same bounds to this one.
+
+        Args:
+            other (Histogram): Histogram to merge in
+        """
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+
+    def to_distribution(self):
+        """
+        Get the observed distribution of totals, trimmed to the range of
+        totals that actually occurred.
+
+        Returns:
+            Distribution: Observed distribution
+        """
+        samples = self.samples
+        nonzero = [i for i, count in enumerate(self.counts) if count]
+        first, last = nonzero[0], nonzero[-1]
+        return Distribution(
+            self.offset + first,
+            [count / samples for count in self.counts[first : last + 1]],
+        )
+
+
+def bounds(roll):
+    """
+    Get the smallest and largest possible totals of a roll.
+
+    Args:
+        roll (Roll): Roll to get the bounds of
+
+    Returns:
+        tuple: Minimum and maximum total
+    """
+    minimum = maximum = sum(roll.modifiers)
+    for dice in roll.rolls:
+        if dice.negative:
+            minimum -= dice.quantity * dice.highest
+            maximum -= dice.quantity * dice.lowest
+        else:
+            minimum += dice.quantity * dice.lowest
+            maximum += dice.quantity * dice.highest
+    return minimum, maximum
+
+
+def _sample_python(roll, histogram, samples, generator):
+    choices = generator.choices
+    groups = [(d.faces or range(1, d.die + 1), d.quantity) for d in roll.rolls]
+    signs = [-1 if d.negative else 1 for d in roll.rolls]
+    modifier = sum(roll.modifiers)
+
+    def attempt():
+        return [sum(choices(faces, k=quantity)) for faces, quantity in groups]
+
+    for _ in range(samples):
+        sums = attempt()
+        if roll.advantage is not Roll.NORMAL:
+            # Compared group by group like lists of DiceResults in Roll.roll.
+            other = attempt()
+            if roll.advantage is Roll.ADVANTAGE:
+                sums = max(sums, other)
+            else:
+                sums = min(sums, other)
+        histogram.add(sum(s * sign for s, sign in zip(sums, signs)) + modifier)
+
+
+def _sample_numpy(roll, histogram, samples, generator):
+    signs = numpy.array([-1 if d.negative else 1 for d in roll.rolls])
+    modifier = sum(roll.modifiers)
+
+    # Custom dice are drawn as indexes into their faces.
+    tables = [None if d.faces is None else numpy.array(d.faces) for d in roll.rolls]
+
+    def attempt():
+        sums = []
+        for d, table in zip(roll.rolls, tables):
+            if table is None:
+                drawn = generator.integers(1, d.die + 1, size=(samples, d.quantity))
+            else:
+                drawn = table[generator.integers(0, d.die, size=(samples, d.quantity))]
+            sums.append(drawn.sum(axis=1))
+        return numpy.stack(sums, axis=1)
+
+    sums = attempt()
+    if roll.advantage is not Roll.NORMAL:
+        # Find the first group in which the two attempts differ, and keep
+        # whichever attempt is greater (or lesser) there.
+        other = attempt()
+        diff = sums - other
+        first = (diff != 0).argmax(axis=1)
+        decider = diff[numpy.arange(samples), first]
+        if roll.advantage is Roll.ADVANTAGE:
+            keep_other = decider < 0
+        else:
+            keep_other = decider > 0
+        sums = numpy.where(keep_other[:, None], other, sums)
+
+    histogram.add_many(sums @ signs + modifier)
+
+
+def _simulate_part(roll, samples, chunk_size, seed):
+    histogram = Histogram(*bounds(roll))
+
+    if numpy is not None:
+        generator = numpy.random.default_rng(seed)
+        sample = _sample_numpy
+    else:
+        generator = random.Random(seed)
+        sample = _sample_python
+
+    for done in range(0, samples, chunk_size):
+        sample(roll, histogram, min(chunk_size, samples - done), generator)
+    return histogram
+
+
+def simulate(roll, samples, workers=1, seed=None, chunk_size=CHUNK_SIZE):
+    """
+    Roll a roll many times and count the totals.
+
+    Samples are split evenly between workers. Each worker gets its own seed,
+    derived from the given one, so results are reproducible for a given seed
+    and number of workers.
+
+    Args:
+        roll (Roll): Roll to simulate
+        samples (int): Number of times to roll it
+        workers (int): Number of processes to use
+        seed (int): Seed to derive worker seeds from, or None for fresh entropy
+        chunk_size (int): Number of rolls drawn at a time by each worker
+
+    Returns:
+        Histogram: Counts of each total
+
+    Raises:
+        ValueError: If samples or workers is less than 1
+    """
+    if samples < 1:
+        raise ValueError("samples must be at least 1")
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+
+    seeder = random.Random(seed)
+    seeds = [seeder.getrandbits(64) for _ in range(workers)]
+    parts = [samples // workers + (i < samples % workers) for i in range(workers)]
+
+    if workers == 1:
+        return _simulate_part(roll, samples, chunk_size, seeds[0])
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(_simulate_part, roll, part, chunk_size, worker_seed)
+            for part, worker_seed in zip(parts, seeds)
+        ]
+        histogram = Histogram(*bounds(roll))
+        for future in futures:
+            histogram.merge(future.result())
+    return histogram
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate rolls many times.")
+    parser.add_argument("-n", "--samples", type=int, default=1_000_000)
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("-s", "--seed", type=int, default=None)
+    parser.add_argument("roll", nargs="+", help="Roll, as given to /roll")
+    args = parser.parse_args()
+    if args.samples < 1:
+        parser.error("--samples must be at least 1")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    try:
+        command = RollCommand.from_args(args.roll)
+    except FoxRollBotException as e:
+        parser.error(str(e) or "Invalid roll syntax.")
+
+    rolls = list({id(r): r for r in command.rolls}.values())
+    for roll in rolls:
+        histogram = simulate(roll, args.samples, args.workers, args.seed)
+        print(summary(roll, histogram.to_distribution()), end="\n\n")
@@ -0,0 +1,2 @@
+CREATE INDEX IF NOT EXISTS {{ table_name }}_user_name
+    ON {{ table_name }} (user, name, arguments);
@@ -1,2 +1,2 @@
-SELECT arguments FROM {{ table_name }}
-    WHERE name=:name AND user=:user;
+SELECT arguments FROM {{ table_name }} INDEXED BY {{ table_name }}_user_name
+    WHERE user=:user AND name=:name;
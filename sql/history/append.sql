@@ -0,0 +1,9 @@
+INSERT INTO {{ table_name }} VALUES (
+    NULL,
+    :time,
+    :chat,
+    :user,
+    :expression,
+    :totals,
+    :dice
+);
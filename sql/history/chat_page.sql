@@ -0,0 +1,4 @@
+SELECT id, time, user, expression, totals, dice FROM {{ table_name }}
+    WHERE chat=:chat AND (time, id) < (:time, :id)
+    ORDER BY time DESC, id DESC
+    LIMIT :limit;
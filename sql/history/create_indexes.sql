@@ -0,0 +1,6 @@
+CREATE INDEX IF NOT EXISTS {{ table_name }}_chat_time
+    ON {{ table_name }} (chat, time);
+CREATE INDEX IF NOT EXISTS {{ table_name }}_user_time
+    ON {{ table_name }} (user, time);
+CREATE INDEX IF NOT EXISTS {{ table_name }}_chat_user_time
+    ON {{ table_name }} (chat, user, time);
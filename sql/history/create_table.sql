@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS {{ table_name }} (
+    id INTEGER PRIMARY KEY,
+    time INTEGER NOT NULL,
+    chat INTEGER NOT NULL,
+    user INTEGER NOT NULL,
+    expression TEXT NOT NULL,
+    totals BLOB NOT NULL,
+    dice BLOB NOT NULL
+);
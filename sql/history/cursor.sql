@@ -0,0 +1,2 @@
+SELECT time, id FROM {{ table_name }}
+    WHERE id=:id;
@@ -0,0 +1 @@
+SELECT coalesce(max(id), 0) + 1 FROM {{ table_name }};
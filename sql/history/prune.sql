@@ -0,0 +1,2 @@
+DELETE FROM {{ table_name }}
+    WHERE id < :id;
@@ -0,0 +1,4 @@
+SELECT id FROM {{ table_name }} NOT INDEXED
+    WHERE time >= :time
+    ORDER BY id
+    LIMIT 1;
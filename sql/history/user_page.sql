@@ -0,0 +1,4 @@
+SELECT id, time, chat, expression, totals, dice FROM {{ table_name }}
+    WHERE user=:user AND (time, id) < (:time, :id)
+    ORDER BY time DESC, id DESC
+    LIMIT :limit;
@@ -0,0 +1,3 @@
+SELECT name, arguments FROM {{ table_name }}
+    WHERE user=:user AND name >= :start AND name < :end
+    ORDER BY name;
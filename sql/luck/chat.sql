@@ -0,0 +1,2 @@
+SELECT user, count, total, squares, faces FROM {{ table_name }}
+    WHERE chat=:chat AND die=:die;
@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS {{ table_name }} (
+    chat INTEGER NOT NULL,
+    user INTEGER NOT NULL,
+    die INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    squares INTEGER NOT NULL,
+    faces BLOB NOT NULL,
+    PRIMARY KEY (chat, user, die)
+) WITHOUT ROWID;
@@ -0,0 +1,2 @@
+SELECT count, total, squares, faces FROM {{ table_name }}
+    WHERE chat=:chat AND die=:die AND user=:user;
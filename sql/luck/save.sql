@@ -0,0 +1,9 @@
+INSERT OR REPLACE INTO {{ table_name }} VALUES (
+    :chat,
+    :user,
+    :die,
+    :count,
+    :total,
+    :squares,
+    :faces
+);
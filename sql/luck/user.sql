@@ -0,0 +1,2 @@
+SELECT die, count, total, squares, faces FROM {{ table_name }}
+    WHERE chat=:chat AND user=:user;
@@ -0,0 +1,5 @@
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+PRAGMA cache_size = -32000;
+PRAGMA mmap_size = 268435456;
+PRAGMA temp_store = MEMORY;
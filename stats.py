@@ -0,0 +1,468 @@
+from bisect import bisect_left
+from functools import lru_cache, wraps
+from itertools import accumulate
+
+from cache import LRUCache
+from roll import Roll
+from errors import *
+
+FFT_THRESHOLD = 250_000
+"""int: Size (len(a) * len(b)) above which convolutions use FFT with numpy"""
+
+WORK_LIMIT = 10_000_000
+"""int: Most work a command's statistics are computed with, in products of
+probabilities in Python"""
+
+NUMPY_SPEEDUP = 50
+"""int: How many times faster numpy multiplies probabilities than Python"""
+
+ADVANTAGE_PASSES = 6
+"""int: Number of times advantage reads each outcome of a group"""
+
+SUMMARY_PASSES = 3
+"""int: Number of times a summary reads each outcome"""
+
+WINDOW_COST = 8
+"""int: Work of each outcome dice_distribution computes without numpy, in
+products, as it's about that much slower than a convolution's inner loop"""
+
+MEMO_SIZE = 2_000_000
+"""int: Most probabilities kept by memoized distributions, together"""
+
+VECTOR_THRESHOLD = 10_000
+"""int: Number of outcomes above which moments are worked out with numpy"""
+
+PERCENTILES = (10, 25, 50, 75, 90)
+"""tuple: Percentiles included in summaries"""
+
+
+@lru_cache(maxsize=None)
+def _numpy():
+    """
+    Import numpy the first time it's needed, since importing it takes longer
+    than most statistics do.
+
+    Returns:
+        module: numpy, or None if it isn't installed
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class Distribution:
+    """
+    Exact probability distribution of an integer-valued outcome.
+
+    Attributes:
+        offset (int): Smallest possible outcome
+        probabilities (list): Probability of each outcome, starting at offset
+    """
+
+    def __init__(self, offset, probabilities):
+        """
+        Create a Distribution instance.
+
+        Args:
+            offset (int): Outcome that the first probability belongs to
+            probabilities (list): Probability of each consecutive outcome
+        """
+        self.offset = offset
+        self.probabilities = probabilities
+        self._moments = None
+        self._cumulative = None
+
+    @property
+    def minimum(self):
+        return self.offset
+
+    @property
+    def maximum(self):
+        return self.offset + len(self.probabilities) - 1
+
+    @property
+    def mean(self):
+        return self.offset + self._get_moments()[0]
+
+    @property
+    def variance(self):
+        return self._get_moments()[1]
+
+    @property
+    def std(self):
+        return self.variance**0.5
+
+    def _get_moments(self):
+        """Get the mean, less offset, and variance, working them out once."""
+        if self._moments is None:
+            p = self.probabilities
+            numpy = _numpy() if len(p) > VECTOR_THRESHOLD else None
+            if numpy is not None:
+                p = numpy.asarray(p)
+                index = numpy.arange(len(p))
+                mean = float(p @ index)
+                deviations = index - mean
+                self._moments = (mean, float(p @ (deviations * deviations)))
+            else:
+                mean = sum(i * q for i, q in enumerate(p))
+                variance = sum((i - mean) ** 2 * q for i, q in enumerate(p))
+                self._moments = (mean, variance)
+        return self._moments
+
+    def probability(self, value):
+        """
+        Get the probability of a single outcome.
+
+        Args:
+            value (int): Outcome to get the probability of
+
+        Returns:
+            float: Probability of exactly that outcome
+        """
+        if self.minimum <= value <= self.maximum:
+            return self.probabilities[value - self.offset]
+        return 0.0
+
+    def percentile(self, percent):
+        """
+        Get the smallest outcome at or below which the given percentage of
+        outcomes fall.
+
+        The cumulative probabilities are worked out the first time, and each
+        percentile is then found by bisecting them.
+
+        Args:
+            percent (float): Percentage, from 0 to 100
+
+        Returns:
+            int: Outcome at that percentile
+        """
+        if self._cumulative is None:
+            self._cumulative = list(accumulate(self.probabilities))
+        cumulative = self._cumulative
+        # Allow for floating-point error in the cumulative sum.
+        target = percent / 100 * cumulative[-1] - 1e-12
+        index = bisect_left(cumulative, target)
+        return self.offset + min(index, len(cumulative) - 1)
+
+    def shift(self, amount):
+        return Distribution(self.offset + amount, self.probabilities)
+
+    def negate(self):
+        return Distribution(-self.maximum, self.probabilities[::-1])
+
+    def __add__(self, other):
+        """Distribution of the sum of two independent outcomes."""
+        return Distribution(
+            self.offset + other.offset,
+            convolve(self.probabilities, other.probabilities),
+        )
+
+
+def convolve(a, b):
+    """
+    Convolve two lists of probabilities.
+
+    Small inputs are convolved directly. Large ones use an FFT if numpy is
+    installed.
+
+    Args:
+        a (list): First list of probabilities
+        b (list): Second list of probabilities
+
+    Returns:
+        list: Convolution of a and b
+    """
+    size = len(a) * len(b)
+    numpy = _numpy()
+
+    if numpy is not None and size > FFT_THRESHOLD:
+        length = len(a) + len(b) - 1
+        spectrum = numpy.fft.rfft(a, length) * numpy.fft.rfft(b, length)
+        return numpy.clip(numpy.fft.irfft(spectrum, length), 0, None).tolist()
+    if numpy is not None:
+        return numpy.convolve(a, b).tolist()
+
+    if len(a) < len(b):
+        a, b = b, a
+    result = [0.0] * (len(a) + len(b) - 1)
+    for j, q in enumerate(b):
+        for i, p in enumerate(a, j):
+            result[i] += p * q
+    return result
+
+
+def _mix(a, b):
+    """Pointwise sum of two partial distributions, keeping both supports."""
+    offset = min(a.offset, b.offset)
+    probabilities = [0.0] * (max(a.maximum, b.maximum) - offset + 1)
+    for dist in (a, b):
+        for i, p in enumerate(dist.probabilities, dist.offset - offset):
+            probabilities[i] += p
+    return Distribution(offset, probabilities)
+
+
+def _memoize(function):
+    """
+    Memoize a function returning Distributions, keeping as many results as
+    fit in MEMO_SIZE probabilities. Its cache is its `cache` attribute.
+    """
+    cache = LRUCache(
+        maxsize=512, maxweight=MEMO_SIZE, weigh=lambda d: len(d.probabilities)
+    )
+
+    @wraps(function)
+    def wrapper(*args):
+        dist = cache.get(args)
+        if dist is None:
+            dist = function(*args)
+            cache.put(args, dist)
+        return dist
+
+    wrapper.cache = cache
+    return wrapper
+
+
+@_memoize
+def dice_distribution(quantity, die):
+    """
+    Get the distribution of the sum of a number of identical dice.
+
+    Results are memoized per (quantity, die), so they're usually only
+    computed once.
+
+    Args:
+        quantity (int): Number of dice
+        die (int): Number of sides of each die
+
+    Returns:
+        Distribution: Distribution of the sum
+    """
+    length = quantity * (die - 1) + 1
+    numpy = _numpy() if quantity * length > FFT_THRESHOLD else None
+
+    if numpy is not None:
+        # The sum's length is exactly the circular convolution length, so
+        # raising the die's spectrum to the power of quantity doesn't wrap.
+        spectrum = numpy.fft.rfft([1 / die] * die, length) ** quantity
+        probabilities = numpy.fft.irfft(spectrum, length)
+        return Distribution(quantity, numpy.clip(probabilities, 0, None).tolist())
+
+    # Add one die at a time. Each outcome of the new sum is the average of a
+    # window of die outcomes of the old one, read off the prefix sums.
+    probabilities = [1.0]
+    for _ in range(quantity):
+        prefix = [0.0, *accumulate(probabilities)]
+        last = len(probabilities)
+        probabilities = [
+            (prefix[min(i + 1, last)] - prefix[max(i - die + 1, 0)]) / die
+            for i in range(last + die - 1)
+        ]
+    return Distribution(quantity, probabilities)
+
+
+@_memoize
+def faces_distribution(quantity, faces):
+    """
+    Get the distribution of the sum of a number of identical custom dice.
+
+    Results are memoized per (quantity, faces), like dice_distribution.
+
+    Args:
+        quantity (int): Number of dice
+        faces (tuple): Faces of each die, all equally likely
+
+    Returns:
+        Distribution: Distribution of the sum
+    """
+    lowest = min(faces)
+    probabilities = [0.0] * (max(faces) - lowest + 1)
+    for face in faces:
+        probabilities[face - lowest] += 1 / len(faces)
+    die = Distribution(lowest, probabilities)
+
+    # Sum by repeated doubling, so only about log2(quantity) convolutions are
+    # needed.
+    total = Distribution(0, [1.0])
+    while quantity:
+        if quantity & 1:
+            total += die
+        quantity >>= 1
+        if quantity:
+            die += die
+    return total
+
+
+def group_distribution(dice):
+    """Get the distribution of the unsigned sum of a Dice instance."""
+    if dice.faces is None:
+        return dice_distribution(dice.quantity, dice.die)
+    return faces_distribution(dice.quantity, dice.faces)
+
+
+def _convolution_work(m, n, fast):
+    """
+    Estimate the work of convolving m probabilities with n, in products.
+
+    Args:
+        m (int): Number of probabilities in one list
+        n (int): Number of probabilities in the other
+        fast (bool): Whether numpy is used
+    """
+    if not fast:
+        return m * n
+    # numpy multiplies far faster than Python, but the probabilities still
+    # go from lists to arrays and back.
+    length = m + n - 1
+    products = m * n if m * n <= FFT_THRESHOLD else length * length.bit_length()
+    return 2 * length + products // NUMPY_SPEEDUP
+
+
+def _group_work(dice, fast):
+    """
+    Estimate the work of group_distribution.
+
+    Returns:
+        tuple: Number of outcomes of the distribution, and work in products
+    """
+    quantity = dice.quantity
+    if dice.faces is None:
+        # The sum of k dice has k * (die - 1) + 1 outcomes.
+        step = dice.die - 1
+        length = quantity * step + 1
+        if fast and quantity * length > FFT_THRESHOLD:
+            return length, _convolution_work(length, 1, fast)
+        outcomes = step * quantity * (quantity + 1) // 2 + quantity
+        return length, WINDOW_COST * outcomes
+
+    die = dice.highest - dice.lowest + 1
+    length, work = 1, 0
+    while quantity:
+        if quantity & 1:
+            work += _convolution_work(length, die, fast)
+            length += die - 1
+        quantity >>= 1
+        if quantity:
+            work += _convolution_work(die, die, fast)
+            die += die - 1
+    return length, work
+
+
+def estimate_work(roll, fast=False):
+    """
+    Estimate the work of roll_distribution and summary, assuming nothing is
+    memoized.
+
+    Args:
+        roll (Roll): Roll to estimate the work of
+        fast (bool): Whether numpy is used
+
+    Returns:
+        int: Work, in products of probabilities
+    """
+    work = 0
+    rest = winner = 1
+    for dice in reversed(roll.rolls):
+        length, group_work = _group_work(dice, fast)
+        work += group_work
+        if roll.advantage is Roll.NORMAL:
+            work += _convolution_work(rest, length, fast)
+        else:
+            # The lists worked out from the group, both convolutions, then
+            # the pass that mixes them.
+            work += ADVANTAGE_PASSES * length
+            work += _convolution_work(length, rest, fast)
+            work += _convolution_work(length, winner, fast)
+            winner = length + max(rest, winner) - 1
+            work += winner
+        rest += length - 1
+    # Summaries read each outcome a few times.
+    return work + SUMMARY_PASSES * max(rest, winner)
+
+
+def check_work(rolls):
+    """
+    Make sure the distributions of some rolls can be computed quickly enough.
+
+    Large convolutions take seconds each without numpy, and even with it,
+    every outcome is handled in Python a few times. The estimated work of
+    every roll together is limited to WORK_LIMIT.
+
+    Args:
+        rolls (iterable): Rolls whose distributions are to be computed
+
+    Raises:
+        OutOfRangeException: If they'd take too long
+    """
+    fast = _numpy() is not None
+    if sum(estimate_work(roll, fast) for roll in rolls) > WORK_LIMIT:
+        raise OutOfRangeException("That roll is too large to compute statistics for.")
+
+
+def roll_distribution(roll):
+    """
+    Get the exact distribution of a roll's total.
+
+    Args:
+        roll (Roll): Roll to get the distribution of
+
+    Returns:
+        Distribution: Distribution of the total, including modifiers
+    """
+    groups = [group_distribution(dice) for dice in roll.rolls]
+    signed = [g.negate() if d.negative else g for d, g in zip(roll.rolls, groups)]
+    modifier = sum(roll.modifiers)
+
+    if roll.advantage is Roll.NORMAL:
+        total = Distribution(0, [1.0])
+        for group in signed:
+            total += group
+        return total.shift(modifier)
+
+    # With advantage, the two attempts are compared by their unsigned dice
+    # sums group by group, and the first group that differs decides the
+    # winner. Working from the last group back, `rest` is the distribution of
+    # the remaining groups of one attempt, and `winner` is that of the
+    # remaining groups of whichever attempt wins on them.
+    rest = Distribution(0, [1.0])
+    winner = Distribution(0, [1.0])
+    for dice, group, signed_group in reversed(list(zip(roll.rolls, groups, signed))):
+        p = group.probabilities
+        below = [0.0, *accumulate(p)][:-1]
+        above = [1.0 - b - q for b, q in zip(below, p)]
+        beaten = below if roll.advantage is Roll.ADVANTAGE else above
+
+        decides = Distribution(group.offset, [2 * q * b for q, b in zip(p, beaten)])
+        ties = Distribution(group.offset, [q * q for q in p])
+        if dice.negative:
+            decides = decides.negate()
+            ties = ties.negate()
+
+        winner = _mix(decides + rest, ties + winner)
+        rest = signed_group + rest
+
+    return winner.shift(modifier)
+
+
+def summary(roll, dist=None):
+    """
+    Describe a roll's distribution in a short, human-readable form.
+
+    Args:
+        roll (Roll): Roll to describe
+        dist (Distribution): Distribution to describe, if not the exact one
+
+    Returns:
+        str: Markdown-formatted summary
+    """
+    if dist is None:
+        dist = roll_distribution(roll)
+    percentiles = " | ".join(f"{p}%: {dist.percentile(p)}" for p in PERCENTILES)
+    return (
+        f"`{roll}`\n"
+        f"Mean: {dist.mean:.2f} | SD: {dist.std:.2f}\n"
+        f"Range: {dist.minimum} to {dist.maximum}\n"
+        f"Percentiles: {percentiles}"
+    )
@@ -1,12 +1,69 @@
+import asyncio
+import cProfile
+import http.client
+import io
+import json
+import math
+import multiprocessing
 import os
+import pstats
 import random
 import sqlite3
-from unittest import TestCase, main
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+import urllib.error
+import urllib.request
+from unittest import IsolatedAsyncioTestCase, TestCase, main, skipUnless
+from unittest.mock import patch
 
-from db import SavedRollManager
+from aiobot import AsyncBot
+import bundle
+from cache import LRUCache
+from commands import (
+    botstats_reply,
+    help_reply,
+    fate_reply,
+    history_reply,
+    list_reply,
+    luck_reply,
+    may_block,
+    profile_reply,
+    roll_reply,
+    stats_reply,
+    text,
+)
+from db import ConnectionPool, SavedRollManager
+from history import RollHistory, pack, unpack
+from luck import FATE, LuckTracker, Tally
+from inline import InlineRoller, is_partial
+from rng import RandomBackend, NumpyBackend
 from roll import Dice, Roll, RollCommand
+from shard import ShardSupervisor, chat_id_of, run_shard
+from simulate import bounds, simulate
+from stats import (
+    WORK_LIMIT,
+    Distribution,
+    check_work,
+    convolve,
+    dice_distribution,
+    estimate_work,
+    roll_distribution,
+)
+from text import StaticReplies, Text
+import metrics
+from metrics import Counter, Gauge, LatencyHistogram, Registry
+from outbox import Outbox
+from profiling import Profiler, folded_stacks, profiler
+from webhook import WebhookServer
 from errors import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def reset_seed():
     # Keep in mind that if the seed changes, all of the outputs will too.
@@ -20,6 +77,10 @@ class DiceTestCase(TestCase):
     def test_from_str(self):
         self.assertEqual(Dice.from_str("1d20"), Dice(1, 20))
 
+    def test_from_str_invalid(self):
+        for roll_str in ("1d", "d20", "20", "1d20+2"):
+            self.assertRaises(InvalidSyntaxException, lambda: Dice.from_str(roll_str))
+
     def test_single_die_output(self):
         dice = Dice(1, 20)
         self.assertEqual(str(dice.roll()), "1d20: 5")
@@ -28,6 +89,11 @@ class DiceTestCase(TestCase):
         dice = Dice(4, 8)
         self.assertEqual(str(dice.roll()), "4d8: 12 | 3, 2, 5, 2")
 
+    def test_result_total(self):
+        result = Dice(4, 8).roll()
+        self.assertEqual(result.total, sum(result.results))
+        self.assertFalse(hasattr(result, "__dict__"))
+
     def test_disallows_small_quantities(self):
         self.assertRaises(OutOfRangeException, lambda: Dice(0, 2))
 
@@ -64,6 +130,32 @@ class DiceTestCase(TestCase):
         self.assertGreaterEqual(result, 2)
         self.assertLessEqual(result, 12)
 
+    def test_fate_dice(self):
+        dice = Dice.from_str("4dF")
+        self.assertEqual(dice, Dice(4, 3, faces=Dice.FATE))
+        self.assertEqual(str(dice), "4dF")
+        self.assertEqual((dice.lowest, dice.highest), (-1, 1))
+        self.assertEqual(str(dice.roll()), "4dF: -1 | -+-/")
+
+    def test_custom_dice(self):
+        dice = Dice.from_str("2d{1,1,2,3}")
+        self.assertEqual(str(dice), "2d{1,1,2,3}")
+        self.assertEqual(Dice.from_str(str(dice)), dice)
+        self.assertNotEqual(dice, Dice(2, 4))
+        self.assertEqual((dice.lowest, dice.highest), (1, 3))
+        for result in dice.roll().results:
+            self.assertIn(result, (1, 2, 3))
+        self.assertEqual(Dice.from_str("1d{-1,5}").highest, 5)
+
+    def test_custom_dice_invalid(self):
+        for roll_str in ("1d{", "1d{1,", "1d{,1}", "1d{1,,2}", "1dG"):
+            self.assertRaises(InvalidSyntaxException, lambda: Dice.from_str(roll_str))
+        self.assertRaises(OutOfRangeException, lambda: Dice.from_str("1d{1}"))
+        faces = ",".join(["1"] * (Dice.MAX_FACES + 1))
+        self.assertRaises(OutOfRangeException, lambda: Dice.from_str(f"1d{{{faces}}}"))
+        big = Dice.MAX_SIDES + 1
+        self.assertRaises(OutOfRangeException, lambda: Dice.from_str(f"1d{{1,{big}}}"))
+
 
 class RollTestCase(TestCase):
     def setUp(self):
@@ -74,6 +166,24 @@ class RollTestCase(TestCase):
         r2 = Roll.from_str("1d20+4d6+5-2", False)
         self.assertEqual(r1, r2)
 
+    def test_from_str_negative_dice(self):
+        r1 = Roll([Dice(2, 6), Dice(1, 4, True)], [3])
+        r2 = Roll.from_str("3+2d6-1d4")
+        self.assertEqual(r1, r2)
+        self.assertTrue(r2.rolls[1].negative)
+
+    def test_from_str_requires_dice(self):
+        self.assertRaises(InvalidSyntaxException, lambda: Roll.from_str("5+3"))
+
+    def test_from_str_error_position(self):
+        for roll_str, position in (("1d20+", 5), ("1d20+x", 5), ("d20", 0)):
+            with self.assertRaises(InvalidSyntaxException) as cm:
+                Roll.from_str(roll_str)
+            self.assertEqual(cm.exception.position, position)
+
+    def test_from_str_syntax_errors_take_precedence(self):
+        self.assertRaises(InvalidSyntaxException, lambda: Roll.from_str("0d20+x"))
+
     def test_simple_roll_output(self):
         roll = Roll([Dice(1, 20)], [])
         result = roll.roll()
@@ -158,6 +268,21 @@ class RollCommandTestCase(TestCase):
     def setUp(self):
         reset_seed()
 
+    def test_fate_command(self):
+        message = SimpleNamespace(
+            chat_id=100, message_id=1, from_user=SimpleNamespace(id=12345)
+        )
+        srm = SavedRollManager("file:fate_test?mode=memory&cache=shared")
+        self.assertEqual(fate_reply(message, [], srm)["text"], "4dF: -1 | -+-/")
+        reply = fate_reply(message, ["+2", "adv", "x2"], srm)["text"]
+        self.assertEqual(reply.count("Other roll: "), 2)
+        self.assertEqual(reply.count("Modifier: 2"), 2)
+        reply = fate_reply(message, ["2dF-1"], srm)["text"]
+        self.assertIn("2dF: ", reply)
+        reply = fate_reply(message, ["x"], srm)["text"]
+        self.assertEqual(reply, f"Syntax: {text.fate_syntax}")
+        srm.close()
+
     def test_roll_command_output(self):
         args = ["1d20", "adv", "x2"]
         rc = RollCommand.from_args(args)
@@ -174,6 +299,411 @@ class RollCommandTestCase(TestCase):
         rolls = [roll] * (Roll.MAX_COMPONENTS + 1)
         self.assertRaises(TooManyComponentsException, lambda: RollCommand(rolls))
 
+    def test_from_args_is_cached(self):
+        RollCommand.cache.clear()
+        rc1 = RollCommand.from_args(["1d20+5", "adv"])
+        rc2 = RollCommand.from_args(("1d20+5", "adv"))
+        self.assertIs(rc1, rc2)
+        self.assertEqual(RollCommand.cache.misses, 1)
+        self.assertEqual(RollCommand.cache.hits, 1)
+
+    def test_from_args_caches_failures(self):
+        RollCommand.cache.clear()
+        for _ in range(2):
+            self.assertRaises(
+                InvalidSyntaxException, lambda: RollCommand.from_args(["1d20", "z"])
+            )
+        self.assertEqual(RollCommand.cache.hits, 1)
+
+    def test_cache_clear(self):
+        RollCommand.from_args(["1d20"])
+        RollCommand.cache.clear()
+        self.assertEqual(len(RollCommand.cache), 0)
+        self.assertEqual(RollCommand.cache.hits, 0)
+
+
+class CountingBackend(RandomBackend):
+    def __init__(self, seed=None):
+        super().__init__(seed)
+        self.calls = []
+
+    def roll(self, sides):
+        self.calls.append(list(sides))
+        return super().roll(sides)
+
+
+class BackendTestCase(TestCase):
+    def test_seeded_backend_is_reproducible(self):
+        rc = RollCommand.from_args(["4d6+2", "adv", "x3"])
+        output1 = str(rc.roll(RandomBackend(42))[0])
+        output2 = str(rc.roll(RandomBackend(42))[0])
+        self.assertEqual(output1, output2)
+
+    def test_command_rolls_in_one_batch(self):
+        backend = CountingBackend(1)
+        rc = RollCommand.from_args(["1d20+2d4", "adv", "x2", "3d6"])
+        rc.roll(backend)
+        self.assertEqual(backend.calls, [[20, 4, 4, 20, 4, 4] * 2 + [6, 6, 6]])
+
+    def test_batch_matches_default_sequence(self):
+        reset_seed()
+        batched = str(RollCommand.from_args(["1d20", "adv", "x2"]))
+        reset_seed()
+        roll = Roll([Dice(1, 20)], [], Roll.ADVANTAGE)
+        separate = "\n\n".join(str(roll.roll()) for _ in range(2))
+        self.assertEqual(batched, separate)
+
+    @skipUnless(numpy, "numpy is not installed")
+    def test_numpy_backend_within_bounds(self):
+        backend = NumpyBackend(1)
+        results = backend.roll([2, 6, 20, 1000] * 100)
+        for die, result in zip([2, 6, 20, 1000] * 100, results):
+            self.assertGreaterEqual(result, 1)
+            self.assertLessEqual(result, die)
+
+
+class StatsTestCase(TestCase):
+    def test_dice_distribution(self):
+        dist = dice_distribution(2, 6)
+        self.assertEqual((dist.minimum, dist.maximum), (2, 12))
+        self.assertAlmostEqual(dist.probability(7), 6 / 36)
+        self.assertAlmostEqual(dist.mean, 7)
+        self.assertAlmostEqual(dist.variance, 35 / 6)
+
+    def test_dice_distribution_is_memoized(self):
+        dice_distribution.cache.clear()
+        dice_distribution(3, 8)
+        dice_distribution(3, 8)
+        self.assertEqual(dice_distribution.cache.hits, 1)
+
+    def test_work_is_limited(self):
+        small = [Roll.from_str("1d20+5", Roll.ADVANTAGE), Roll.from_str("10d100")]
+        check_work(small)
+        # Each roll alone is within the limit, but not all of them together.
+        large = Roll.from_str("+".join(["1d1000"] * 3))
+        self.assertLess(estimate_work(large), WORK_LIMIT)
+        with patch("stats._numpy", return_value=None):
+            self.assertRaises(OutOfRangeException, lambda: check_work([large] * 25))
+            self.assertRaises(
+                OutOfRangeException,
+                lambda: check_work([Roll.from_str("100d1000")]),
+            )
+
+    def test_work_is_limited_with_numpy(self):
+        # numpy makes single large rolls cheap, but not many of them.
+        self.assertLess(estimate_work(Roll.from_str("100d1000"), True), WORK_LIMIT)
+        huge = Roll.from_str("+".join(["100d1000"] * 25), Roll.ADVANTAGE)
+        self.assertGreater(estimate_work(huge, True), WORK_LIMIT)
+        self.assertRaises(OutOfRangeException, lambda: check_work([huge]))
+
+    def test_modifiers_and_negative_dice(self):
+        dist = roll_distribution(Roll.from_str("1d4-1d4+3"))
+        self.assertEqual((dist.minimum, dist.maximum), (0, 6))
+        self.assertAlmostEqual(dist.mean, 3)
+        self.assertAlmostEqual(dist.probability(3), 4 / 16)
+
+    def test_advantage(self):
+        adv = roll_distribution(Roll.from_str("1d20", Roll.ADVANTAGE))
+        dis = roll_distribution(Roll.from_str("1d20", Roll.DISADVANTAGE))
+        self.assertAlmostEqual(adv.mean, 13.825)
+        self.assertAlmostEqual(dis.mean, 7.175)
+        self.assertAlmostEqual(adv.probability(20), 39 / 400)
+
+    def test_advantage_compares_dice_in_order(self):
+        # The 1d2s decide the winner unless they tie, in which case it has
+        # the better of the two 1d6s. Otherwise its 1d6 is unaffected.
+        dist = roll_distribution(Roll.from_str("1d2+1d6", Roll.ADVANTAGE))
+        best_d6 = 161 / 36
+        expected = 0.5 * (2 + 3.5) + 0.25 * (1 + best_d6) + 0.25 * (2 + best_d6)
+        self.assertAlmostEqual(dist.mean, expected)
+
+    def test_percentile(self):
+        dist = roll_distribution(Roll.from_str("1d10"))
+        self.assertEqual(dist.percentile(50), 5)
+        self.assertEqual(dist.percentile(90), 9)
+        self.assertEqual(dist.percentile(100), 10)
+
+    def test_convolve(self):
+        self.assertEqual(convolve([0.5, 0.5], [0.5, 0.5]), [0.25, 0.5, 0.25])
+
+    def test_fate_distribution(self):
+        dist = roll_distribution(Roll.from_str("4dF+1"))
+        self.assertEqual((dist.minimum, dist.maximum), (-3, 5))
+        self.assertAlmostEqual(dist.mean, 1)
+        self.assertAlmostEqual(dist.probability(1), 19 / 81)
+        self.assertAlmostEqual(dist.variance, 8 / 3)
+
+    def test_custom_distribution(self):
+        dist = roll_distribution(Roll.from_str("2d{1,1,2,3}", Roll.ADVANTAGE))
+        self.assertEqual((dist.minimum, dist.maximum), (2, 6))
+        self.assertAlmostEqual(dist.mean, 531 / 128)
+
+
+class SimulateTestCase(TestCase):
+    def test_bounds(self):
+        self.assertEqual(bounds(Roll.from_str("2d6-1d4+3")), (1, 14))
+        self.assertEqual(bounds(Roll.from_str("4dF-2d{0,5}")), (-14, 4))
+
+    def test_custom_dice(self):
+        roll = Roll.from_str("2d{1,1,2,3}", Roll.ADVANTAGE)
+        dist = simulate(roll, 20000, seed=1).to_distribution()
+        self.assertEqual((dist.minimum, dist.maximum), (2, 6))
+        self.assertAlmostEqual(dist.mean, 531 / 128, delta=0.05)
+
+    def test_needs_samples(self):
+        roll = Roll.from_str("1d20")
+        self.assertRaises(ValueError, lambda: simulate(roll, 0))
+        self.assertRaises(ValueError, lambda: simulate(roll, 10, workers=0))
+
+    def test_counts_every_sample(self):
+        histogram = simulate(Roll.from_str("1d20+5"), 1000, seed=1, chunk_size=300)
+        self.assertEqual(histogram.samples, 1000)
+        self.assertEqual(histogram.offset, 6)
+
+    def test_is_reproducible(self):
+        roll = Roll.from_str("2d6-1d4", Roll.ADVANTAGE)
+        h1 = simulate(roll, 500, seed=7)
+        h2 = simulate(roll, 500, seed=7)
+        self.assertEqual(h1.counts, h2.counts)
+
+    def test_matches_exact_distribution(self):
+        roll = Roll.from_str("1d20", Roll.ADVANTAGE)
+        dist = simulate(roll, 20000, seed=1).to_distribution()
+        self.assertAlmostEqual(dist.mean, roll_distribution(roll).mean, delta=0.2)
+
+    def test_workers(self):
+        roll = Roll.from_str("3d6")
+        h1 = simulate(roll, 1001, workers=2, seed=3)
+        h2 = simulate(roll, 1001, workers=2, seed=3)
+        self.assertEqual(h1.samples, 1001)
+        self.assertEqual(h1.counts, h2.counts)
+
+
+class LRUCacheTestCase(TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+
+    def test_entries_expire(self):
+        cache = LRUCache(ttl=0.01)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertNotIn("a", cache)
+
+    def test_counts_hits_and_misses(self):
+        cache = LRUCache()
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_limits_weight(self):
+        cache = LRUCache(maxweight=5, weigh=len)
+        cache.put("a", "xx")
+        cache.put("b", "xxx")
+        cache.put("c", "x")
+        self.assertNotIn("a", cache)
+        self.assertIn("b", cache)
+        cache.put("b", "x")
+        cache.put("d", "xxx")
+        self.assertEqual(len(cache), 3)
+        cache.put("e", "xxxxxx")
+        self.assertNotIn("e", cache)
+
+
+class DurableSavedRollManagerTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "rolls.db")
+        self.srm = SavedRollManager(self.path, durable=True)
+
+    def tearDown(self):
+        self.srm.close()
+        self.directory.cleanup()
+
+    def test_uses_wal(self):
+        with self.srm.pool.connection() as connection:
+            mode = connection.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def test_get_uses_covering_index(self):
+        with self.srm.pool.connection() as connection:
+            plan = connection.execute(
+                "EXPLAIN QUERY PLAN " + self.srm.sql["get"], {"name": "a", "user": 1}
+            ).fetchall()
+        self.assertIn("COVERING INDEX", plan[0][-1])
+
+    def test_persists(self):
+        self.srm.save("test_roll", ["4d6", "x2"], 54321)
+        self.srm.close()
+        self.srm = SavedRollManager(self.path, durable=True)
+        self.assertEqual(self.srm.get("test_roll", 54321), ["4d6", "x2"])
+
+    def test_shared_without_cache(self):
+        other = SavedRollManager(self.path, durable=True, cache_size=0)
+        self.addCleanup(other.close)
+        self.assertIsNone(other.cache)
+
+        self.srm.save("test_roll", ["1d20"], 54321)
+        self.assertEqual(
+            other.get_command("test_roll", 54321).rolls, (Roll.from_str("1d20"),)
+        )
+        self.srm.save("test_roll", ["2d6"], 54321)
+        self.assertEqual(
+            other.get_command("test_roll", 54321).rolls, (Roll.from_str("2d6"),)
+        )
+        self.srm.delete("test_roll", 54321)
+        self.assertRaises(
+            DoesNotExistException, lambda: other.get_command("test_roll", 54321)
+        )
+
+
+class WriteBehindTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "rolls.db")
+        self.srm = SavedRollManager(path, durable=True, write_delay=60)
+
+    def tearDown(self):
+        self.srm.close()
+        self.directory.cleanup()
+
+    def stored(self):
+        return self.srm._select("test_roll", 54321)
+
+    def test_list_sees_pending_writes(self):
+        self.srm.save("test_roll", ["4d6"], 54321)
+        self.srm.save("other_roll", ["4d6"], 54321)
+        self.srm.flush()
+        self.srm.delete("other_roll", 54321)
+        self.srm.save("new_roll", ["1d4"], 54321)
+        self.srm.names.clear()
+        self.assertEqual(
+            self.srm.list_rolls(54321), [("new_roll", "1d4"), ("test_roll", "4d6")]
+        )
+
+    def test_reads_see_pending_writes(self):
+        self.srm.save("test_roll", ["4d6"], 54321)
+        self.assertIsNone(self.stored())
+        self.assertEqual(self.srm.get("test_roll", 54321), ["4d6"])
+
+    def test_flush(self):
+        self.srm.save("test_roll", ["4d6"], 54321)
+        self.srm.save("test_roll", ["2d8"], 54321)
+        self.srm.flush()
+        self.assertEqual(self.stored(), "2d8")
+
+    def test_delete(self):
+        self.srm.save("test_roll", ["4d6"], 54321)
+        self.srm.flush()
+        self.srm.delete("test_roll", 54321)
+        self.assertRaises(
+            DoesNotExistException, lambda: self.srm.get("test_roll", 54321)
+        )
+        self.assertRaises(
+            DoesNotExistException, lambda: self.srm.delete("test_roll", 54321)
+        )
+        self.srm.flush()
+        self.assertIsNone(self.stored())
+
+    def test_flushes_on_close(self):
+        self.srm.save("test_roll", ["4d6"], 54321)
+        self.srm.close()
+        self.srm = SavedRollManager(self.srm.db, durable=True)
+        self.assertEqual(self.stored(), "4d6")
+
+    def test_flushes_after_delay(self):
+        self.srm.write_delay = 0.01
+        self.srm.save("test_roll", ["4d6"], 54321)
+        time.sleep(0.1)
+        self.assertEqual(self.stored(), "4d6")
+
+
+class ConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(lambda: sqlite3.connect(":memory:"), 2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_reuses_connections(self):
+        with self.pool.connection() as c1:
+            pass
+        with self.pool.connection() as c2:
+            pass
+        self.assertIs(c1, c2)
+
+    def test_waits_when_exhausted(self):
+        c1 = self.pool.acquire()
+        c2 = self.pool.acquire()
+        timer = threading.Timer(0.05, self.pool.release, [c1])
+        timer.start()
+        c3 = self.pool.acquire()
+        timer.join()
+        self.assertIs(c3, c1)
+        self.assertEqual(self.pool.waits, 1)
+        self.assertGreater(self.pool.wait_time, 0)
+        self.pool.release(c2)
+        self.pool.release(c3)
+
+    def test_rolls_back_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.pool.connection() as connection:
+                connection.execute("CREATE TABLE t (x)")
+                connection.execute("INSERT INTO t VALUES (1)")
+                raise ValueError()
+        with self.pool.connection() as connection:
+            self.assertFalse(connection.in_transaction)
+
+    def test_exports_waits(self):
+        srm = SavedRollManager("file:pool_metrics?mode=memory&cache=shared")
+        connection = srm.pool.acquire()
+        timer = threading.Timer(0.05, srm.pool.release, [connection])
+        timer.start()
+        with srm.pool.connection():
+            pass
+        timer.join()
+        exposition = metrics.registry.exposition()
+        self.assertIn("# TYPE foxrollbot_db_pool_waits_total counter", exposition)
+        self.assertIn("foxrollbot_db_pool_waits_total 1\n", exposition)
+        srm.close()
+
+    def test_shared_cache_threads(self):
+        srm = SavedRollManager("file:pool_test?mode=memory&cache=shared")
+        self.assertEqual(srm.pool.size, 1)
+        errors = []
+
+        def work(user):
+            try:
+                for i in range(50):
+                    srm.save(f"roll{i}", ["1d20"], user)
+                    srm.get(f"roll{i}", user)
+                    srm.list_rolls(user)
+                    srm.history.append(100, user, "1d20", [])
+                    srm.history.by_user(user)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(u,)) for u in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        srm.close()
+        self.assertEqual(errors, [])
+
+    def test_closed_pool(self):
+        self.pool.close()
+        self.assertRaises(sqlite3.ProgrammingError, self.pool.acquire)
+
 
 class SavedRollManagerTestCase(TestCase):
     def setUp(self):
@@ -187,12 +717,17 @@ class SavedRollManagerTestCase(TestCase):
             {"name": "example_roll", "args": "1d20 adv", "user": 12345},
         )
         connection.commit()
+        connection.close()
+
+    def tearDown(self):
+        self.srm.close()
 
     def get_db_entries(self):
         connection = self.srm.connect()
         cursor = connection.cursor()
         cursor.execute(self.srm.sql["select_all"])
         results = cursor.fetchall()
+        connection.close()
         return len(results), results
 
     def test_save(self):
@@ -218,6 +753,25 @@ class SavedRollManagerTestCase(TestCase):
     def test_get_throws_on_nonexistent_roll(self):
         self.assertRaises(DoesNotExistException, lambda: self.srm.get("nothing", 12345))
 
+    def test_get_command(self):
+        command = self.srm.get_command("example_roll", 12345)
+        self.assertEqual(command.rolls[0].advantage, Roll.ADVANTAGE)
+        self.assertIs(self.srm.get_command("example_roll", 12345), command)
+        self.assertEqual(self.srm.cache.hits, 1)
+
+    def test_get_command_sees_updates(self):
+        self.srm.get_command("example_roll", 12345)
+        self.srm.save("example_roll", ["4d6"], 12345)
+        command = self.srm.get_command("example_roll", 12345)
+        self.assertEqual(command.rolls[0].rolls[0], Dice(4, 6))
+
+    def test_get_command_sees_deletes(self):
+        self.srm.get_command("example_roll", 12345)
+        self.srm.delete("example_roll", 12345)
+        self.assertRaises(
+            DoesNotExistException, lambda: self.srm.get_command("example_roll", 12345)
+        )
+
     def test_delete(self):
         self.srm.delete("example_roll", 12345)
         length = self.get_db_entries()[0]
@@ -228,6 +782,1087 @@ class SavedRollManagerTestCase(TestCase):
             DoesNotExistException, lambda: self.srm.delete("nothing", 12345)
         )
 
+    def test_export_import(self):
+        self.srm.save("test_roll", ["4d6", "x2"], 54321)
+        exported = io.StringIO()
+        self.assertEqual(self.srm.export_rolls(exported), 2)
+        lines = exported.getvalue().splitlines()
+        self.assertEqual(
+            json.loads(lines[0]),
+            {"user": 12345, "name": "example_roll", "arguments": "1d20 adv"},
+        )
+
+        other = SavedRollManager("file:import_test?mode=memory&cache=shared")
+        self.addCleanup(other.close)
+        other.save("test_roll", ["1d4"], 54321)
+        self.assertEqual(other.get_command("test_roll", 54321).rolls[0].sides(), [4])
+        self.assertEqual(other.import_rolls(io.StringIO(exported.getvalue())), (2, 0))
+        self.assertEqual(other.get("example_roll", 12345), ["1d20", "adv"])
+        self.assertEqual(
+            other.get_command("test_roll", 54321).rolls[0].sides(), [6] * 4
+        )
+
+    def test_list_rolls(self):
+        for name in ("attack", "damage", "att2", "Attack"):
+            self.srm.save(name, ["1d20"], 12345)
+        self.srm.save("attack", ["1d20+5"], 54321)
+
+        names = [name for name, _ in self.srm.list_rolls(12345)]
+        self.assertEqual(names, ["Attack", "att2", "attack", "damage", "example_roll"])
+        self.assertEqual(
+            self.srm.list_rolls(12345, "att"), [("att2", "1d20"), ("attack", "1d20")]
+        )
+
+        self.srm.save("attack", ["1d20+7"], 12345)
+        self.srm.delete("att2", 12345)
+        self.srm.save("attic", ["2d6"], 12345)
+        self.assertEqual(
+            self.srm.list_rolls(12345, "att"), [("attack", "1d20+7"), ("attic", "2d6")]
+        )
+        self.assertEqual(self.srm.list_rolls(12345, "zzz"), [])
+
+        uncached = SavedRollManager(cache_size=0)
+        self.addCleanup(uncached.close)
+        self.assertEqual(uncached.list_rolls(12345), self.srm.list_rolls(12345))
+        self.assertEqual(
+            uncached.list_rolls(12345, "att"), self.srm.list_rolls(12345, "att")
+        )
+
+    def test_list_command(self):
+        message = SimpleNamespace(
+            chat_id=100, message_id=1, from_user=SimpleNamespace(id=12345)
+        )
+        reply = list_reply(message, [], self.srm)
+        self.assertEqual(reply["text"], "`example_roll`: 1d20 adv")
+        reply = list_reply(message, ["nope"], self.srm)
+        self.assertEqual(reply["text"], "You have no saved rolls starting with `nope`.")
+
+        reply = roll_reply(message, ["exam"], self.srm)
+        self.assertTrue(reply["text"].endswith(" Did you mean `example_roll`?"))
+
+    def test_import_invalid(self):
+        lines = [
+            '{"user": 1, "name": "good", "arguments": "1d20"}',
+            '{"user": 1, "name": "bad", "arguments": "1d2000"}',
+            "not json",
+            '{"user": 1, "name": "good2", "arguments": "2d6+3"}',
+        ]
+        with self.assertRaises(InvalidSyntaxException):
+            self.srm.import_rolls(io.StringIO("\n".join(lines)))
+        self.assertRaises(DoesNotExistException, lambda: self.srm.get("good", 1))
+
+        result = self.srm.import_rolls(io.StringIO("\n".join(lines)), True)
+        self.assertEqual(result, (2, 2))
+        self.assertEqual(self.srm.get("good2", 1), ["2d6+3"])
+
+
+class FakeTelegramAPI:
+    """Local stand-in for the Bot API, serving a fixed list of updates."""
+
+    def __init__(self, updates, floods=0):
+        self.updates = updates
+        self.sent = []
+        # Number of sends to refuse as flood limited first.
+        self.floods = floods
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        self.url = "http://127.0.0.1:%d" % self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                head = (await reader.readuntil(b"\r\n\r\n")).decode()
+                lines = head.split("\r\n")
+                method = lines[0].split()[1].rsplit("/", 1)[1]
+                length = [l for l in lines if l.lower().startswith("content-length")]
+                length = int(length[0].split(":")[1])
+                params = json.loads(await reader.readexactly(length))
+
+                if method == "sendMessage" and self.floods:
+                    self.floods -= 1
+                    response = {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": "Too Many Requests",
+                        "parameters": {"retry_after": 0},
+                    }
+                else:
+                    response = {
+                        "ok": True,
+                        "result": await self.respond(method, params),
+                    }
+                body = json.dumps(response)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body)
+                    + body.encode()
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    async def respond(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "username": "FoxRollBot"}
+        elif method == "getUpdates":
+            updates, self.updates = self.updates, []
+            if not updates:
+                await asyncio.sleep(0.01)
+            return updates
+        elif method == "sendMessage":
+            self.sent.append(params)
+            return {"message_id": len(self.sent)}
+
+
+def fake_update(update_id, text, chat_id=100, user_id=12345):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "chat": {"id": chat_id},
+            "from": {"id": user_id},
+            "text": text,
+        },
+    }
+
+
+class AsyncBotTestCase(IsolatedAsyncioTestCase):
+    async def run_bot(self, updates, replies, floods=0):
+        api = FakeTelegramAPI(updates, floods)
+        await api.start()
+        srm = SavedRollManager()
+        bot = AsyncBot("token", srm, api.url, senders=2, poll_timeout=0)
+        task = asyncio.ensure_future(bot.run())
+
+        try:
+            for _ in range(200):
+                if len(api.sent) >= replies:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await api.stop()
+            srm.close()
+        return api.sent
+
+    async def test_replies_to_commands(self):
+        sent = await self.run_bot(
+            [
+                fake_update(1, "/start"),
+                fake_update(2, "/roll@FoxRollBot 1d20", chat_id=200),
+                fake_update(3, "/roll@SomeOtherBot 1d20"),
+                fake_update(4, "just chatting"),
+                fake_update(5, "/save example 1d20 adv", chat_id=300),
+            ],
+            3,
+        )
+        by_chat = {reply["chat_id"]: reply for reply in sent}
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(by_chat[100]["text"], text.start)
+        self.assertTrue(by_chat[200]["text"].startswith("1d20: "))
+        self.assertEqual(by_chat[200]["reply_to_message_id"], 2)
+        self.assertIn("example", by_chat[300]["text"])
+
+    async def test_retries_flood_limited_sends_in_order(self):
+        updates = [fake_update(i, f"/roll {i}d6") for i in range(1, 6)]
+        sent = await self.run_bot(updates, 5, floods=2)
+        self.assertEqual(
+            [reply["reply_to_message_id"] for reply in sent], [1, 2, 3, 4, 5]
+        )
+
+    def test_may_block(self):
+        self.assertTrue(may_block(stats_reply, ["1d20"]))
+        self.assertTrue(may_block(roll_reply, ["example"]))
+        self.assertFalse(may_block(roll_reply, ["1d20"]))
+        self.assertFalse(may_block(help_reply, []))
+
+
+class LatencyHistogramTestCase(TestCase):
+    def test_quantile(self):
+        histogram = LatencyHistogram(buckets=(1, 2, 4))
+        for seconds in (0.5, 1.5, 1.5, 3):
+            histogram.observe(seconds)
+        self.assertEqual(histogram.counts(), [1, 2, 1, 0])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.quantile(0.25), 1)
+        self.assertEqual(histogram.quantile(0.5), 1.5)
+        self.assertEqual(histogram.quantile(1), 4)
+
+    def test_empty(self):
+        self.assertEqual(LatencyHistogram().quantile(0.99), 0.0)
+
+
+class WebhookServerTestCase(TestCase):
+    def start(self, handle, **kwargs):
+        server = WebhookServer(handle, address=("127.0.0.1", 0), **kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def post(self, server, data, path="/", headers={}):
+        host, port = server.address
+        request = urllib.request.Request(
+            f"http://{host}:{port}{path}", json.dumps(data).encode(), headers
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_handles_updates(self):
+        received = []
+        done = threading.Event()
+
+        def handle(data):
+            received.append(data)
+            if len(received) == 3:
+                done.set()
+
+        server = self.start(handle, workers=1)
+        for update_id in range(3):
+            self.assertEqual(self.post(server, {"update_id": update_id}), 200)
+        self.assertTrue(done.wait(5))
+        self.assertEqual([u["update_id"] for u in received], [0, 1, 2])
+        self.assertEqual(server.accepted, 3)
+        self.assertEqual(server.latency["total"].count, 3)
+
+    def test_wrong_path_and_secret(self):
+        server = self.start(lambda data: None, path="/hook", secret_token="s3cret")
+        self.assertEqual(self.post(server, {}, path="/other"), 404)
+        self.assertEqual(self.post(server, {}, path="/hook"), 403)
+        self.assertEqual(server.accepted, 0)
+
+        secret = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+        self.assertEqual(self.post(server, {}, path="/hook", headers=secret), 200)
+        self.assertEqual(server.accepted, 1)
+
+    def test_reject_large_bodies(self):
+        server = self.start(lambda data: None)
+        host, port = server.address
+        for length, status in ((WebhookServer.MAX_BODY + 1, 413), ("many", 400)):
+            connection = http.client.HTTPConnection(host, port)
+            self.addCleanup(connection.close)
+            connection.putrequest("POST", "/")
+            connection.putheader("Content-Length", length)
+            connection.endheaders()
+            self.assertEqual(connection.getresponse().status, status)
+
+        self.assertEqual(self.post(server, {"text": "x" * 1000}), 200)
+        self.assertEqual(server.accepted, 1)
+
+    def test_reject_when_full(self):
+        release = threading.Event()
+        server = self.start(lambda data: release.wait(5), workers=1, queue_size=1)
+        self.addCleanup(release.set)
+
+        self.assertTrue(server.enqueue(b"{}", time.perf_counter()))
+        # Wait for the worker to take the first update, leaving the queue empty.
+        while server.depth:
+            time.sleep(0.01)
+        self.assertEqual(self.post(server, {"update_id": 2}), 200)
+        self.assertEqual(self.post(server, {"update_id": 3}), 503)
+        self.assertEqual(server.shed_count, 1)
+
+    def test_drop_oldest(self):
+        handled = []
+        release = threading.Event()
+
+        def handle(data):
+            release.wait(5)
+            handled.append(data["update_id"])
+
+        server = self.start(handle, workers=1, queue_size=2, shed="drop_oldest")
+        self.assertTrue(server.enqueue(b'{"update_id": 0}', time.perf_counter()))
+        while server.depth:
+            time.sleep(0.01)
+        for update_id in range(1, 5):
+            self.assertEqual(self.post(server, {"update_id": update_id}), 200)
+        self.assertEqual(server.shed_count, 2)
+
+        release.set()
+        server.stop()
+        self.assertEqual(handled, [0, 3, 4])
+
+    def test_invalid_shed_policy(self):
+        self.assertRaises(
+            ValueError, lambda: WebhookServer(None, ("127.0.0.1", 0), shed="lifo")
+        )
+
+
+class FloodError(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Flood control exceeded")
+        self.retry_after = retry_after
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.sent = []
+        self.first_sent = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.errors = []
+
+    def send(self, **reply):
+        self.first_sent.set()
+        self.release.wait(5)
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(reply)
+
+    def start(self, **kwargs):
+        kwargs.setdefault("rate", 1000)
+        kwargs.setdefault("backoff", 0.01)
+        outbox = Outbox(self.send, **kwargs)
+        outbox.start()
+        return outbox
+
+    def reply(self, text, chat_id=100, message_id=1):
+        return {
+            "chat_id": chat_id,
+            "reply_to_message_id": message_id,
+            "parse_mode": "Markdown",
+            "text": text,
+        }
+
+    def test_send(self):
+        outbox = self.start()
+        outbox.put(self.reply("1d20: 5"))
+        outbox.close()
+        self.assertEqual(self.sent, [self.reply("1d20: 5")])
+        self.assertEqual(outbox.depth, 0)
+        self.assertEqual(outbox.latency["send"].count, 1)
+
+    def test_coalesce(self):
+        self.release.clear()
+        outbox = self.start(senders=1)
+        outbox.put(self.reply("first"))
+        self.assertTrue(self.first_sent.wait(5))
+
+        # These pile up behind the first send. Replies to the same message go
+        # out as one message, but not replies to different ones.
+        for i in range(2, 5):
+            outbox.put(self.reply(f"roll {i}", message_id=2))
+        outbox.put(self.reply("roll 5", message_id=5))
+        outbox.put(self.reply("other chat", chat_id=200))
+        outbox.put({"chat_id": 100, "text": "not Markdown"})
+        self.release.set()
+        outbox.close()
+
+        by_chat = {}
+        for reply in self.sent:
+            by_chat.setdefault(reply["chat_id"], []).append(reply)
+        self.assertEqual(
+            by_chat[100],
+            [
+                self.reply("first"),
+                self.reply("roll 2\n\nroll 3\n\nroll 4", message_id=2),
+                self.reply("roll 5", message_id=5),
+                {"chat_id": 100, "text": "not Markdown"},
+            ],
+        )
+        self.assertEqual(by_chat[200], [self.reply("other chat", chat_id=200)])
+        self.assertEqual(outbox.coalesced, 2)
+        self.assertEqual(outbox.sent, 5)
+
+    def test_coalesce_labels_askers(self):
+        self.release.clear()
+        outbox = self.start(senders=1)
+        outbox.put(self.reply("first"))
+        self.assertTrue(self.first_sent.wait(5))
+
+        # Replies to different messages are joined only when they say whose
+        # they are.
+        for i, asker in zip(range(2, 5), ["[A](tg://user?id=1)", "[B]", "[C]"]):
+            outbox.put(self.reply(f"roll {i}", message_id=i), asker)
+        outbox.put(self.reply("roll 5", message_id=5))
+        self.release.set()
+        outbox.close()
+
+        self.assertEqual(
+            self.sent[1:],
+            [
+                self.reply(
+                    "[A](tg://user?id=1)\nroll 2\n\n[B]\nroll 3\n\n[C]\nroll 4",
+                    message_id=2,
+                ),
+                self.reply("roll 5", message_id=5),
+            ],
+        )
+
+    def test_no_coalesce_without_reply_to(self):
+        self.release.clear()
+        outbox = self.start(senders=1)
+        outbox.put(self.reply("first"))
+        self.assertTrue(self.first_sent.wait(5))
+        for _ in range(3):
+            outbox.put({"chat_id": 100, "parse_mode": "Markdown", "text": "Hi!"}, "[A]")
+        self.release.set()
+        outbox.close()
+        self.assertEqual([r["text"] for r in self.sent], ["first"] + ["Hi!"] * 3)
+        self.assertEqual(outbox.coalesced, 0)
+
+    def test_coalesce_length_limit(self):
+        self.release.clear()
+        outbox = self.start(senders=1)
+        outbox.put(self.reply("first"))
+        self.assertTrue(self.first_sent.wait(5))
+        for _ in range(3):
+            outbox.put(self.reply("x" * 2000))
+        self.release.set()
+        outbox.close()
+        self.assertEqual([len(r["text"]) for r in self.sent], [5, 4002, 2000])
+
+    def test_rate_limit(self):
+        outbox = self.start(rate=20, burst=1)
+        start = time.monotonic()
+        outbox.put(self.reply("a"))
+        self.assertTrue(self.first_sent.wait(5))
+        while outbox.depth:
+            time.sleep(0.001)
+        outbox.put(self.reply("b"))
+        outbox.close()
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual(len(self.sent), 2)
+
+    def test_retry(self):
+        self.errors = [OSError("Connection reset"), FloodError(0.01)]
+        outbox = self.start()
+        outbox.put(self.reply("1d20: 5"))
+        outbox.close()
+        self.assertEqual(self.sent, [self.reply("1d20: 5")])
+        self.assertEqual(outbox.retries, 2)
+
+    def test_give_up(self):
+        self.errors = [ValueError("Bad request"), OSError("Down")]
+        outbox = self.start(max_retries=0)
+        outbox.put(self.reply("a"))
+        outbox.put(self.reply("b", chat_id=200))
+        outbox.close()
+        self.assertEqual(self.sent, [])
+        self.assertEqual(outbox.failed, 2)
+        self.assertEqual(outbox.depth, 0)
+
+
+def record_shard(index, updates, results):
+    run_shard(updates, lambda update: results.put((index, update["update_id"])))
+
+
+class ShardSupervisorTestCase(TestCase):
+    def test_chat_id_of(self):
+        self.assertEqual(chat_id_of(fake_update(1, "/roll", chat_id=-5)), -5)
+        self.assertEqual(
+            chat_id_of(
+                {
+                    "update_id": 2,
+                    "callback_query": {
+                        "from": {"id": 7},
+                        "message": {"chat": {"id": 8}},
+                    },
+                }
+            ),
+            8,
+        )
+        self.assertEqual(
+            chat_id_of({"update_id": 3, "inline_query": {"from": {"id": 7}}}), 7
+        )
+        self.assertIsNone(chat_id_of({"update_id": 4}))
+
+    def test_routing(self):
+        results = multiprocessing.get_context("spawn").Queue()
+        supervisor = ShardSupervisor(record_shard, 3, args=(results,))
+        supervisor.start()
+        updates = [fake_update(i, "/roll", chat_id=i % 4) for i in range(20)]
+        for update in updates:
+            supervisor.route(update)
+        supervisor.stop()
+
+        handled = {}
+        for _ in updates:
+            index, update_id = results.get(timeout=10)
+            handled.setdefault(update_id % 4, []).append((index, update_id))
+
+        self.assertEqual(supervisor.routed, [10, 5, 5])
+        for chat_id, chat_updates in handled.items():
+            # Every chat is handled by one worker, in order.
+            self.assertEqual({index for index, _ in chat_updates}, {chat_id % 3})
+            self.assertEqual(
+                [u for _, u in chat_updates], sorted(u for _, u in chat_updates)
+            )
+
+
+class InlineRollerTestCase(TestCase):
+    def setUp(self):
+        reset_seed()
+        self.roller = InlineRoller()
+
+    def titles(self, query, user=1):
+        return [r["title"] for r in self.roller.answer(user, query)["results"]]
+
+    def test_saved_rolls(self):
+        srm = SavedRollManager("file:inline_test?mode=memory&cache=shared")
+        self.addCleanup(srm.close)
+        srm.save("attack", ["1d20+5"], 1)
+        srm.save("attic", ["2d6"], 1)
+        srm.save("damage", ["2d6"], 1)
+        results = self.roller.answer(1, "att", srm)["results"]
+        self.assertEqual([r["title"] for r in results], ["Roll attack", "Roll attic"])
+        self.assertEqual(results[0]["description"], "1d20+5")
+        self.assertEqual(self.roller.answer(2, "att", srm)["results"], [])
+
+    def test_is_partial(self):
+        for query in ("2", "2d", "1d20+", "1d20+1d", "1d20 x", "4d{1,", "2dF+"):
+            self.assertTrue(is_partial(query.split()), query)
+        for query in ("1d20", "1d20+5", "1d20 x2", "1d20 adv", "hello", "4dF"):
+            self.assertFalse(is_partial(query.split()), query)
+
+    def test_answer(self):
+        answer = self.roller.answer(1, "1d20+5")
+        self.assertEqual(answer["cache_time"], 0)
+        self.assertTrue(answer["is_personal"])
+        (result,) = answer["results"]
+        self.assertEqual(result["title"], "Roll 1d20+5")
+        self.assertEqual(
+            result["input_message_content"]["message_text"],
+            "`1d20+5`\nTotal: 10\n1d20: 5\nModifier: 5",
+        )
+
+    def test_empty_query(self):
+        self.assertEqual(self.titles(""), ["Roll 1d20"])
+
+    def test_keystrokes(self):
+        typed = [self.titles(query) for query in ("1d20", "1d20+", "1d20+3")]
+        self.assertEqual(typed, [["Roll 1d20"], ["Roll 1d20"], ["Roll 1d20+3"]])
+        self.assertEqual(self.roller.partial, 1)
+        # Other users' last rolls aren't offered.
+        self.assertEqual(self.titles("1d20+", user=2), [])
+
+    def test_invalid(self):
+        self.assertEqual(self.titles("hello"), [])
+        self.assertEqual(self.titles("1d1"), [])
+
+    def test_rolls_fresh(self):
+        first = self.roller.answer(1, "100d1000")["results"][0]
+        second = self.roller.answer(1, "100d1000")["results"][0]
+        self.assertNotEqual(first["id"], second["id"])
+        self.assertNotEqual(
+            first["input_message_content"], second["input_message_content"]
+        )
+
+    def test_over_budget(self):
+        roller = InlineRoller(budget=0)
+        self.assertEqual([r["title"] for r in roller.answer(1, "1d20")["results"]], [])
+        self.assertEqual(roller.over_budget, 1)
+        self.assertEqual(roller.latency.count, 1)
+
+    def test_rolling_counts_against_budget(self):
+        roller = InlineRoller(budget=0.5)
+        roller.answer(1, "1d20")
+        # Parsing takes no time, but rolling and formatting run over.
+        clock = SimpleNamespace(perf_counter=iter([0, 0, 1, 1]).__next__)
+        with patch("inline.time", clock):
+            reply = roller.answer(1, "20d1000 x20")
+        self.assertEqual([r["title"] for r in reply["results"]], ["Roll 1d20"])
+        self.assertEqual(roller.over_budget, 1)
+
+    def test_too_long(self):
+        roller = InlineRoller()
+        huge = "+".join(["100d1000"] * 10) + " x25"
+        self.assertEqual(roller.answer(1, huge)["results"], [])
+        # Just too long to tell before rolling.
+        self.assertEqual(roller.answer(1, "100d1000 x10")["results"], [])
+        self.assertEqual(roller.too_long, 2)
+
+
+class RegistryTestCase(TestCase):
+    def test_exposition(self):
+        registry = Registry()
+        registry.counter("rolls_total", "Rolls made", command="roll").inc(2)
+        registry.register("depth", "Queue depth", Gauge(lambda: 3))
+        histogram = registry.histogram("latency_seconds", 'Latency "here"')
+        histogram.observe(0.5)
+        histogram.observe(20)
+
+        lines = registry.exposition().splitlines()
+        self.assertIn("# TYPE rolls_total counter", lines)
+        self.assertIn('rolls_total{command="roll"} 2', lines)
+        self.assertIn("depth 3", lines)
+        self.assertIn('# HELP latency_seconds Latency "here"', lines)
+        self.assertIn('latency_seconds_bucket{le="0.25"} 0', lines)
+        self.assertIn('latency_seconds_bucket{le="0.5"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="10.0"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn("latency_seconds_sum 20.5", lines)
+        self.assertIn("latency_seconds_count 2", lines)
+
+    def test_label_escaping(self):
+        registry = Registry()
+        registry.counter("errors_total", "Errors", type='a"b\\c').inc()
+        self.assertIn('errors_total{type="a\\"b\\\\c"} 1', registry.exposition())
+
+    def test_same_metric(self):
+        registry = Registry()
+        counter = registry.counter("rolls_total", "Rolls made", command="roll")
+        self.assertIs(registry.counter("rolls_total", "Rolls", command="roll"), counter)
+        self.assertIsNot(registry.counter("rolls_total", "Rolls", command="r"), counter)
+        self.assertRaises(ValueError, lambda: registry.histogram("rolls_total", ""))
+
+    def test_serve(self):
+        registry = Registry()
+        registry.counter("rolls_total", "Rolls made").inc()
+        server = metrics.serve(("127.0.0.1", 0), registry)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        host, port = server.server_address
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics") as response:
+            self.assertIn(b"rolls_total 1", response.read())
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://{host}:{port}/")
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.srm = SavedRollManager()
+        self.message = SimpleNamespace(
+            chat_id=100, message_id=1, from_user=SimpleNamespace(id=12345)
+        )
+
+    def tearDown(self):
+        self.srm.close()
+
+    def value(self, name, **labels):
+        key = tuple(sorted(labels.items()))
+        for family in metrics.registry.collect():
+            if family.name == name and key in family.children:
+                metric = family.children[key]
+                return getattr(metric, "count", None) or metric.value
+        return 0
+
+    def test_commands(self):
+        calls = self.value("foxrollbot_commands_total", command="roll")
+        parses = self.value("foxrollbot_roll_phase_seconds", phase="parse")
+        errors = self.value("foxrollbot_errors_total", type="InvalidSyntaxException")
+        gets = self.value("foxrollbot_db_seconds", method="get")
+
+        roll_reply(self.message, ["1d20"], self.srm)
+        roll_reply(self.message, ["1d"], self.srm)
+        roll_reply(self.message, ["missing"], self.srm)
+
+        self.assertEqual(
+            self.value("foxrollbot_commands_total", command="roll"), calls + 3
+        )
+        self.assertEqual(
+            self.value("foxrollbot_roll_phase_seconds", phase="parse"), parses + 3
+        )
+        self.assertEqual(
+            self.value("foxrollbot_errors_total", type="InvalidSyntaxException"),
+            errors + 1,
+        )
+        self.assertEqual(self.value("foxrollbot_db_seconds", method="get"), gets + 1)
+
+    def test_botstats(self):
+        roll_reply(self.message, ["1d20"], self.srm)
+
+        os.environ["FOXROLLBOT_ADMINS"] = "1, 2"
+        self.addCleanup(os.environ.pop, "FOXROLLBOT_ADMINS")
+        reply = botstats_reply(self.message, [], self.srm)
+        self.assertEqual(reply["text"], "Only the bot's admins can see its stats.")
+
+        os.environ["FOXROLLBOT_ADMINS"] = "1, 12345"
+        reply = botstats_reply(self.message, [], self.srm)
+        self.assertIn("*Commands handled*\n", reply["text"])
+        self.assertIn("\nbotstats: ", reply["text"])
+        self.assertNotIn(": 0\n", reply["text"])
+        self.assertIn("*Time taken to handle commands*", reply["text"])
+        self.assertIn("get\\_command: ", reply["text"])
+
+
+class ProfilerTestCase(TestCase):
+    def run_roll(self, profiler, args):
+        RollCommand.cache.clear()
+        return profiler.run(
+            "roll", " ".join(args), lambda: str(RollCommand.from_args(args))
+        )
+
+    def test_disabled(self):
+        profiler = Profiler()
+        self.assertEqual(self.run_roll(profiler, ["1d20"])[:6], "1d20: ")
+        self.assertEqual(profiler.samples, {})
+        self.assertEqual(profiler.folded(), "")
+
+    def test_samples(self):
+        profiler = Profiler(rate=1, memory=True)
+        for _ in range(2):
+            self.run_roll(profiler, ["100d1000", "x25"])
+        self.run_roll(profiler, ["1d20"])
+
+        (command, expression, sample), _ = profiler.top()
+        self.assertEqual((command, expression), ("roll", "100d1000 x25"))
+        self.assertEqual(sample.count, 2)
+        self.assertGreater(sample.peak, 0)
+
+        lines = profiler.folded().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, microseconds = line.rsplit(" ", 1)
+            self.assertTrue(stack.startswith(("/roll 100d1000 x25;", "/roll 1d20;")))
+            self.assertGreater(int(microseconds), 0)
+        self.assertTrue(any("_parse_args (roll.py:" in line for line in lines))
+
+        profiler.clear()
+        self.assertEqual(profiler.top(), [])
+
+    def test_tracing_holds_back_other_calls(self):
+        profiler = Profiler(rate=1, memory=True)
+        order = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def traced():
+            started.set()
+            release.wait(5)
+            order.append("traced")
+
+        def other():
+            order.append("other")
+            return bytearray(10_000_000)
+
+        tracer = threading.Thread(target=profiler.run, args=("roll", "a", traced))
+        tracer.start()
+        self.assertTrue(started.wait(5))
+        beside = threading.Thread(target=profiler.run, args=("roll", "b", other))
+        beside.start()
+        time.sleep(0.1)
+        self.assertEqual(order, [])
+
+        release.set()
+        tracer.join()
+        beside.join()
+        self.assertEqual(order, ["traced", "other"])
+        self.assertLess(profiler.samples[("roll", "a")].peak, 1_000_000)
+
+    def test_folded_stacks_share_time(self):
+        def leaf():
+            sum(range(20000))
+
+        def a():
+            leaf()
+
+        def b():
+            leaf()
+            leaf()
+
+        def main():
+            a()
+            b()
+
+        profile = cProfile.Profile()
+        profile.runcall(main)
+        folded = folded_stacks(pstats.Stats(profile), "root")
+        under_a = sum(v for k, v in folded.items() if ";a (" in k and "leaf" in k)
+        under_b = sum(v for k, v in folded.items() if ";b (" in k and "leaf" in k)
+        self.assertGreater(under_b, under_a)
+
+    def test_profile_command(self):
+        message = SimpleNamespace(
+            chat_id=100, message_id=1, from_user=SimpleNamespace(id=12345)
+        )
+        os.environ["FOXROLLBOT_ADMINS"] = "12345"
+        self.addCleanup(os.environ.pop, "FOXROLLBOT_ADMINS")
+        self.addCleanup(profiler.clear)
+        self.addCleanup(setattr, profiler, "rate", profiler.rate)
+        srm = SavedRollManager()
+        self.addCleanup(srm.close)
+        reply = profile_reply(message, ["on", "1"], None)
+        self.assertEqual(profiler.rate, 1)
+        roll_reply(message, ["2d6"], srm)
+        reply = profile_reply(message, [], None)
+        self.assertIn("`/roll 2d6`: 1 sampled", reply["text"])
+
+        profile_reply(message, ["off"], None)
+        self.assertEqual(profiler.rate, 0)
+        reply = profile_reply(message, ["on", "2"], None)
+        self.assertTrue(reply["text"].startswith("Syntax:"))
+        self.assertEqual(profiler.rate, 0)
+
+
+class BundleTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "bundle.json")
+
+    def test_build_and_load(self):
+        bundle.build(self.path)
+        loaded = bundle.load(self.path)
+        self.assertEqual(loaded["sql"]["saved_rolls"], bundle.render_sql("saved_rolls"))
+        self.assertIn("create_table", loaded["sql"]["saved_rolls"])
+        self.assertEqual(loaded["text"]["help"], text.help)
+
+    def test_stale_bundle(self):
+        bundle.build(self.path)
+        with open(self.path) as f:
+            built = json.load(f)
+        built["sources"]["text/help"][0] -= 1
+        with open(self.path, "w") as f:
+            json.dump(built, f)
+        self.assertEqual(bundle.load(self.path), {})
+
+    def test_missing_bundle(self):
+        self.assertEqual(bundle.load(self.path), {})
+
+    def test_statements(self):
+        statements = bundle.sql(SavedRollManager.TABLE)
+        for name in ("pragmas", "create_table", "create_index", "save", "get"):
+            self.assertIn(name, statements)
+        self.assertIn("saved_rolls", statements["save"])
+
+
+class StaticRepliesTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.write("greeting", "Hello")
+        self.write("motd", "*Roll* well")
+
+    def write(self, name, content):
+        with open(os.path.join(self.directory, name), "w") as f:
+            f.write(content)
+
+    def test_payload(self):
+        message = SimpleNamespace(chat_id=-100123, message_id=1)
+        reply = help_reply(message, [], None)
+        self.assertEqual(
+            reply, {"chat_id": -100123, "parse_mode": "Markdown", "text": text.help}
+        )
+        self.assertEqual(json.loads(reply.payload), reply)
+
+        replies = StaticReplies(Text(self.directory), {"greeting": None})
+        reply = replies.reply("greeting", 5)
+        self.assertEqual(reply, {"chat_id": 5, "text": "Hello"})
+        self.assertEqual(reply.payload, json.dumps(reply).encode())
+
+    def test_reload(self):
+        replies = StaticReplies(
+            Text(self.directory), {"motd": "Markdown"}, check_interval=0
+        )
+        self.assertEqual(replies.reply("motd", 1)["text"], "*Roll* well")
+        self.write("motd", "*Roll* badly")
+        reply = replies.reply("motd", 1)
+        self.assertEqual(reply["text"], "*Roll* badly")
+        self.assertEqual(json.loads(reply.payload)["text"], "*Roll* badly")
+        self.assertEqual(replies.text.motd, "*Roll* badly")
+
+    def test_no_reload(self):
+        replies = StaticReplies(Text(self.directory), {"greeting": None}, None)
+        self.write("greeting", "Goodbye")
+        self.assertEqual(replies.reply("greeting", 1)["text"], "Hello")
+        self.assertTrue(replies.text.reload())
+        self.assertFalse(replies.text.reload())
+
+
+class RollHistoryTestCase(TestCase):
+    def setUp(self):
+        self.srm = SavedRollManager("file:history_test?mode=memory&cache=shared")
+        self.history = RollHistory(self.srm.pool, flush_delay=60)
+
+    def tearDown(self):
+        self.history.close()
+        self.srm.close()
+
+    def message(self, chat_id=100, user_id=12345):
+        return SimpleNamespace(
+            chat_id=chat_id, message_id=1, from_user=SimpleNamespace(id=user_id)
+        )
+
+    def count(self):
+        with self.srm.pool.connection() as connection:
+            return connection.execute("SELECT count(*) FROM roll_history").fetchone()[0]
+
+    def test_pack(self):
+        values = [0, 1, -5, 1000, 32767, -32768]
+        self.assertEqual(unpack("h", pack("h", values)), values)
+        self.assertEqual(len(pack("h", values)), 2 * len(values))
+
+    def test_batched_append(self):
+        command = RollCommand.from_args(["1d20+5", "2d6", "x2"])
+        self.history.append(100, 12345, "1d20+5 2d6 x2", command.roll())
+        self.assertEqual(self.count(), 0)
+
+        [entry] = self.history.by_user(12345)
+        self.assertEqual(self.count(), 1)
+        self.assertEqual(entry.chat, 100)
+        self.assertEqual(entry.expression, "1d20+5 2d6 x2")
+        self.assertEqual(len(entry.totals), 3)
+        self.assertEqual(len(entry.dice), 5)
+        self.assertEqual(entry.totals[0], entry.dice[0] + 5)
+        self.assertEqual(entry.totals[1], entry.dice[1] + entry.dice[2])
+
+    def test_pages(self):
+        for i in range(25):
+            self.history.append(
+                100 + i % 2, 12345, f"{i + 1}d6", [Dice(i + 1, 6).roll()]
+            )
+        self.history.append(100, 54321, "1d20", [Dice(1, 20).roll()])
+
+        seen = []
+        after = None
+        for size in (10, 10, 5, 0):
+            page = self.history.by_user(12345, after)
+            self.assertEqual(len(page), size)
+            seen += [entry.expression for entry in page]
+            if page:
+                after = page[-1].id
+        self.assertEqual(seen, [f"{i}d6" for i in range(25, 0, -1)])
+
+        chat = self.history.by_chat(101, limit=100)
+        self.assertEqual(len(chat), 12)
+        self.assertEqual({entry.user for entry in chat}, {12345})
+
+    def test_prune(self):
+        for _ in range(3):
+            self.history.append(100, 12345, "1d20", [Dice(1, 20).roll()])
+        self.history.flush()
+        self.assertEqual(self.history.prune(time.time() - 60), 0)
+        self.assertEqual(self.history.prune(time.time() + 60), 3)
+        self.assertEqual(self.count(), 0)
+
+    def test_history_command(self):
+        message = self.message()
+        reply = history_reply(message, [], self.srm)
+        self.assertEqual(reply["text"], "No rolls found.")
+
+        for _ in range(12):
+            roll_reply(message, ["1d20+5"], self.srm)
+        roll_reply(message, [], self.srm)
+        roll_reply(self.message(user_id=54321), ["2d6"], self.srm)
+
+        reply = history_reply(message, [], self.srm)
+        lines = reply["text"].split("\n")
+        self.assertEqual(lines[0], "*Your rolls in this chat* (UTC)")
+        self.assertIn("`1d20`: ", lines[1])
+        self.assertIn("`1d20+5`: ", lines[2])
+        self.assertTrue(lines[-1].startswith("Older: `/history "))
+
+        after = lines[-1].split()[-1].strip("`")
+        reply = history_reply(message, [after], self.srm)
+        self.assertEqual(len(reply["text"].split("\n")), 4)
+
+        reply = history_reply(message, ["chat"], self.srm)
+        self.assertIn("`2d6`: ", reply["text"])
+        reply = history_reply(message, ["everything"], self.srm)
+        self.assertTrue(reply["text"].startswith("Syntax:"))
+
+    def test_history_command_scope(self):
+        group = self.message()
+        private = self.message(chat_id=12345)
+        roll_reply(group, ["1d20"], self.srm)
+        roll_reply(private, ["1d6"], self.srm)
+
+        # Rolls made privately don't show up in groups.
+        reply = history_reply(group, [], self.srm)
+        self.assertNotIn("`1d6`", reply["text"])
+        reply = history_reply(private, [], self.srm)
+        self.assertTrue(reply["text"].startswith("*Your rolls* (UTC)"))
+        self.assertIn("`1d6`", reply["text"])
+        self.assertIn("`1d20`", reply["text"])
+
+
+class LuckTrackerTestCase(TestCase):
+    def setUp(self):
+        self.srm = SavedRollManager("file:luck_test?mode=memory&cache=shared")
+        self.luck = LuckTracker(self.srm.pool, checkpoint_interval=60)
+        self.message = SimpleNamespace(
+            chat_id=100, message_id=1, from_user=SimpleNamespace(id=12345)
+        )
+
+    def tearDown(self):
+        self.luck.close()
+        self.srm.close()
+
+    def test_tally(self):
+        tally = Tally(20)
+        tally.add([1, 20, 20, 11])
+        self.assertEqual((tally.count, tally.total, tally.squares), (4, 52, 922))
+        self.assertEqual((tally.lows, tally.highs), (1, 2))
+        self.assertEqual(tally.mean, 13)
+        self.assertEqual(tally.expected, 10.5)
+        self.assertAlmostEqual(tally.luck, 2.5 * 2 / math.sqrt(399 / 12))
+
+        fate = Tally(FATE)
+        fate.add([-1, 0, 1, 1])
+        self.assertEqual(fate.faces, [1, 1, 2])
+        self.assertEqual(fate.expected, 0)
+
+    def test_checkpoint(self):
+        self.luck.record(100, 12345, 20, [1, 2, 3])
+        self.assertEqual(self.luck.get(100, 12345, 20).count, 3)
+        self.luck.checkpoint()
+        self.assertEqual(self.luck.get(100, 12345, 20).count, 3)
+
+        # Another process adding to the same tally.
+        other = LuckTracker(self.srm.pool)
+        other.record(100, 12345, 20, [20])
+        other.checkpoint()
+        self.luck.record(100, 12345, 20, [4])
+
+        tally = self.luck.get(100, 12345, 20)
+        self.assertEqual(tally.count, 5)
+        self.assertEqual(tally.faces[:4] + tally.faces[-1:], [1, 1, 1, 1, 1])
+        self.luck.checkpoint()
+        self.assertEqual(self.luck.get(100, 12345, 20).total, 30)
+        self.assertIsNone(self.luck.get(100, 12345, 6))
+
+    def test_by_user_and_chat(self):
+        self.luck.record(100, 1, 20, [20] * 5)
+        self.luck.record(100, 1, 6, [6])
+        self.luck.checkpoint()
+        self.luck.record(100, 1, 20, [1])
+        self.luck.record(100, 2, 20, [10])
+        self.luck.record(200, 1, 20, [10])
+
+        self.assertEqual(self.luck.by_user(100, 1)[20].count, 6)
+        self.assertEqual(set(self.luck.by_user(100, 1)), {6, 20})
+        chat = self.luck.by_chat(100, 20)
+        self.assertEqual({user: t.count for user, t in chat.items()}, {1: 6, 2: 1})
+
+    def test_luck_command(self):
+        for _ in range(5):
+            roll_reply(self.message, ["2d20"], self.srm)
+        roll_reply(self.message, ["1d20", "adv"], self.srm)
+        fate_reply(self.message, [], self.srm)
+
+        reply = luck_reply(self.message, [], self.srm)
+        lines = reply["text"].split("\n")
+        self.assertEqual(lines[0], "*Your dice in this chat*")
+        self.assertTrue(lines[1].startswith("dF: 4 rolled"))
+        self.assertTrue(lines[2].startswith("d20: 10 rolled"))
+
+        reply = luck_reply(self.message, ["d20"], self.srm)
+        self.assertIn(" | 20: ", reply["text"])
+        reply = luck_reply(self.message, ["chat"], self.srm)
+        self.assertIn("1. [12345](tg://user?id=12345)", reply["text"])
+        reply = luck_reply(self.message, ["chat", "d6"], self.srm)
+        self.assertTrue(reply["text"].startswith("Nobody has rolled d6"))
+        reply = luck_reply(self.message, ["d1"], self.srm)
+        self.assertTrue(reply["text"].startswith("Syntax:"))
+
+    def test_records_fate_dice(self):
+        roll_reply(self.message, ["2dF+1d{1,1,2}"], self.srm)
+        fate_reply(self.message, ["+1", "x2"], self.srm)
+        tallies = self.srm.luck.by_user(100, 12345)
+        self.assertEqual(set(tallies), {FATE})
+        self.assertEqual(tallies[FATE].count, 10)
+
 
 if __name__ == "__main__":
     main()
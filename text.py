@@ -1,4 +1,7 @@
+import json
 import os
+import threading
+import time
 
 
 class Text:
@@ -20,13 +23,153 @@ class Text:
         Args:
             directory (str): Directory in which to find text files
         """
+        self.directory = directory
         self._texts = {}
-        for file_name in os.listdir(directory):
-            with open(os.path.join(directory, file_name)) as f:
-                self._texts[file_name] = f.read().strip()
+        self._sources = None
+        self.reload()
+
+    @classmethod
+    def from_texts(cls, texts, directory=None):
+        """
+        Create a Text object from texts already read.
+
+        Args:
+            texts (dict): Texts keyed by name
+            directory (str): Directory the texts were read from, which reload
+                checks for changes. The texts are assumed to match the files
+                in it as they are now.
+        """
+        instance = cls.__new__(cls)
+        instance.directory = directory
+        instance._texts = dict(texts)
+        instance._sources = instance._stat() if directory is not None else None
+        return instance
+
+    def _stat(self):
+        sources = {}
+        for file_name in os.listdir(self.directory):
+            stat = os.stat(os.path.join(self.directory, file_name))
+            sources[file_name] = (stat.st_mtime_ns, stat.st_size)
+        return sources
+
+    def reload(self):
+        """
+        Read the texts again if any of their files have changed.
+
+        Returns:
+            bool: True if the texts were read again
+        """
+        if self.directory is None:
+            return False
+        try:
+            sources = self._stat()
+            if sources == self._sources:
+                return False
+            texts = {}
+            for file_name in sources:
+                with open(os.path.join(self.directory, file_name)) as f:
+                    texts[file_name] = f.read().strip()
+        except OSError:
+            # Files are probably being replaced; try again next time.
+            if self._sources is None:
+                raise
+            return False
+        self._texts = texts
+        self._sources = sources
+        return True
 
     def __getattr__(self, attr):
         if attr in self._texts:
             return self._texts[attr]
         else:
             raise AttributeError()
+
+
+class StaticReply(dict):
+    """
+    Reply whose keyword arguments are already encoded for the Bot API.
+
+    It's an ordinary dict of sendMessage's keyword arguments, and its payload
+    is the same arguments as the JSON body of a request.
+
+    Attributes:
+        payload (bytes): JSON encoding of the reply
+    """
+
+    __slots__ = ("payload",)
+
+
+class StaticReplies:
+    """
+    Replies to commands that always answer with the same text.
+
+    Each reply's arguments and JSON encoding are built once, leaving only the
+    chat ID to fill in for every reply. The texts' files are checked for
+    changes at most every check_interval seconds, when a reply is asked for,
+    and the replies are rebuilt if they have.
+    """
+
+    CHECK_INTERVAL = 1.0
+    """float: Seconds between checks for changed texts"""
+
+    def __init__(self, text, parse_modes, check_interval=CHECK_INTERVAL):
+        """
+        Create a StaticReplies instance.
+
+        Args:
+            text (Text): Texts to reply with
+            parse_modes (dict): Parse mode of each text replies are built for,
+                keyed by the text's name, or None for plain text
+            check_interval (float): Seconds between checks for changed texts;
+                None never checks
+        """
+        self.text = text
+        self._parse_modes = dict(parse_modes)
+        self._check_interval = check_interval
+        self._next_check = time.monotonic() + (check_interval or 0)
+        self._lock = threading.Lock()
+        self._build()
+
+    def _build(self):
+        replies = {}
+        for name, parse_mode in self._parse_modes.items():
+            arguments = {"text": getattr(self.text, name)}
+            if parse_mode is not None:
+                arguments = {"parse_mode": parse_mode, **arguments}
+            # Everything after the chat ID, which always comes first.
+            rest = json.dumps(arguments)[1:].encode()
+            replies[name] = (arguments, b", " + rest)
+        self._replies = replies
+
+    def _check(self):
+        now = time.monotonic()
+        if self._check_interval is None or now < self._next_check:
+            return
+        # Only one thread checks, and the others carry on with the replies
+        # they have.
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + self._check_interval
+            if self.text.reload():
+                self._build()
+        finally:
+            self._lock.release()
+
+    def reply(self, name, chat_id):
+        """
+        Get the reply with a text.
+
+        Args:
+            name (str): Name of text
+            chat_id (int): ID of chat to send it to
+
+        Returns:
+            StaticReply: Reply's keyword arguments for sendMessage
+        """
+        self._check()
+        arguments, rest = self._replies[name]
+        reply = StaticReply(chat_id=chat_id)
+        reply.update(arguments)
+        reply.payload = b'{"chat_id": %d' % chat_id + rest
+        return reply
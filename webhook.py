@@ -0,0 +1,248 @@
+"""
+Webhook ingestion for the bot.
+
+WebhookServer accepts updates POSTed by Telegram and puts them in a bounded
+queue, and a pool of worker threads takes them off it and handles them. The
+HTTP side does nothing but queue, so it keeps up with bursts, and a full
+queue either turns updates away (so Telegram retries them later) or drops the
+oldest queued ones.
+
+The server speaks plain HTTP. Telegram only delivers webhooks over HTTPS, so
+it's meant to sit behind a proxy that terminates TLS.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import LatencyHistogram
+
+
+class WebhookServer:
+    """
+    HTTP server that queues incoming updates for a pool of workers.
+
+    Attributes:
+        workers (int): Number of worker threads
+        shed (str): What to do with updates when the queue is full: "reject"
+            them with a 503, or "drop_oldest" to make room
+        accepted (int): Number of updates queued
+        shed_count (int): Number of updates rejected or dropped
+        errors (int): Number of updates whose handler raised
+        latency (dict): LatencyHistogram for each stage an update goes
+            through: "ingest" (reading and queueing the request), "queue"
+            (waiting for a worker), "handle" (running the handler) and "total"
+    """
+
+    SHED_POLICIES = ("reject", "drop_oldest")
+
+    MAX_BODY = 1 << 20
+    """int: Largest request body accepted, in bytes; Telegram's updates are far smaller"""
+
+    def __init__(
+        self,
+        handle,
+        address=("127.0.0.1", 8080),
+        path="/",
+        workers=4,
+        queue_size=1000,
+        shed="reject",
+        secret_token=None,
+    ):
+        """
+        Create a WebhookServer instance, bound to its address but not yet
+        serving.
+
+        Args:
+            handle (callable): Function called with each update's JSON data
+            address (tuple): Host and port to listen on
+            path (str): Path that updates are POSTed to
+            workers (int): Number of worker threads
+            queue_size (int): Maximum number of queued updates
+            shed (str): Shed policy, one of SHED_POLICIES
+            secret_token (str): If given, requests must carry it in the
+                X-Telegram-Bot-Api-Secret-Token header
+        """
+        if shed not in self.SHED_POLICIES:
+            raise ValueError(f"shed must be one of {', '.join(self.SHED_POLICIES)}")
+
+        self.workers = workers
+        self.shed = shed
+        self.accepted = 0
+        self.shed_count = 0
+        self.errors = 0
+        self.latency = {
+            stage: LatencyHistogram()
+            for stage in ("ingest", "queue", "handle", "total")
+        }
+
+        self._handle = handle
+        self._path = path
+        self._secret_token = secret_token
+        self._queue = queue.Queue(queue_size)
+        self._counter_lock = threading.Lock()
+        self._threads = []
+
+        self._server = ThreadingHTTPServer(address, self._make_request_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def address(self):
+        """tuple: Host and port the server is actually bound to"""
+        return self._server.server_address
+
+    @property
+    def depth(self):
+        """int: Number of updates currently queued"""
+        return self._queue.qsize()
+
+    def start(self):
+        """Start the workers and serve requests in a background thread."""
+        self._start_workers()
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def serve_forever(self):
+        """Start the workers and serve requests until stop() is called."""
+        self._start_workers()
+        self._server.serve_forever()
+
+    def stop(self):
+        """Stop accepting updates, then finish handling queued ones."""
+        self._server.shutdown()
+        self._server.server_close()
+        for _ in range(self.workers):
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def enqueue(self, body, received):
+        """
+        Queue a raw update, shedding load if the queue is full.
+
+        Args:
+            body (bytes): Update JSON as received
+            received (float): perf_counter() time the request arrived
+
+        Returns:
+            bool: False if the update was rejected
+        """
+        item = (received, body)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if self.shed == "reject":
+                self._count("shed_count")
+                return False
+
+            # Make room by dropping the oldest update. Other threads may be
+            # doing the same, so keep trying until this one fits.
+            while True:
+                try:
+                    self._queue.get_nowait()
+                    self._count("shed_count")
+                except queue.Empty:
+                    pass
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    continue
+
+        self._count("accepted")
+        return True
+
+    def summary(self):
+        """
+        Describe the server's counters and latencies on one line.
+
+        Returns:
+            str: Summary, with latencies in milliseconds
+        """
+        stages = " ".join(
+            f"{stage}="
+            + "/".join(f"{h.quantile(q) * 1000:.1f}" for q in (0.5, 0.95, 0.99))
+            for stage, h in self.latency.items()
+        )
+        return (
+            f"depth={self.depth} accepted={self.accepted} shed={self.shed_count} "
+            f"errors={self.errors} p50/p95/p99 ms: {stages}"
+        )
+
+    def _count(self, attribute):
+        with self._counter_lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def _start_workers(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            received, body = item
+            started = time.perf_counter()
+            self.latency["queue"].observe(started - received)
+            try:
+                self._handle(json.loads(body))
+            except Exception:
+                self._count("errors")
+                logging.exception("Error handling update")
+
+            finished = time.perf_counter()
+            self.latency["handle"].observe(finished - started)
+            self.latency["total"].observe(finished - received)
+
+    def _make_request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                received = time.perf_counter()
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                except ValueError:
+                    length = -1
+                if not 0 <= length <= server.MAX_BODY:
+                    # The body is left unread, so the connection can't be reused.
+                    self.close_connection = True
+                    self._respond(400 if length < 0 else 413)
+                    return
+                body = self.rfile.read(length)
+
+                if self.path != server._path:
+                    self._respond(404)
+                elif server._secret_token is not None and (
+                    self.headers.get("X-Telegram-Bot-Api-Secret-Token")
+                    != server._secret_token
+                ):
+                    self._respond(403)
+                elif server.enqueue(body, received):
+                    self._respond(200)
+                    server.latency["ingest"].observe(time.perf_counter() - received)
+                else:
+                    self._respond(503)
+
+            def _respond(self, status):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                if self.close_connection:
+                    self.send_header("Connection", "close")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler